@@ -1,5 +1,6 @@
 
 import csv
+import os
 
 start_id = 959
 
@@ -105,9 +106,19 @@ green_line = [
 
 all_new = kengeri_pois + purple_line + yellow_line + green_line
 
-filename = "c:/Users/HP/dsaelantigrav/backend/c_core/data/pois.csv"
+filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pois.csv")
+
+# A file without a trailing newline would glue the first new row onto its
+# last one
+needs_newline = False
+with open(filename, 'rb') as f:
+    if f.seek(0, os.SEEK_END) > 0:
+        f.seek(-1, os.SEEK_END)
+        needs_newline = f.read(1) != b'\n'
 
 with open(filename, 'a', newline='') as f:
+    if needs_newline:
+        f.write('\n')
     writer = csv.writer(f)
     for p in all_new:
         writer.writerow([start_id, p['name'], p['type'], p['lat'], p['lon']])
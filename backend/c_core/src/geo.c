@@ -0,0 +1,66 @@
+#include "geo.h"
+
+double geo_haversine_km(double lat1, double lon1, double lat2, double lon2) {
+  return geo_haversine_cos_km(lat1, lon1, geo_cos_lat(lat1), lat2, lon2,
+                              geo_cos_lat(lat2));
+}
+
+// Haversine with cos(lat) of both points supplied by the caller, which saves
+// two of the four trig calls when one side is precomputed per point.
+double geo_haversine_cos_km(double lat1, double lon1, double cos1, double lat2,
+                            double lon2, double cos2) {
+  double s_lat = sin((lat2 - lat1) * GEO_DEG_TO_RAD / 2);
+  double s_lon = sin((lon2 - lon1) * GEO_DEG_TO_RAD / 2);
+  double a = s_lat * s_lat + cos1 * cos2 * s_lon * s_lon;
+  if (a > 1.0)
+    a = 1.0;
+  return 2 * GEO_EARTH_RADIUS_KM * asin(sqrt(a));
+}
+
+// Planar distance with the longitude gap scaled by the mean of the two
+// cosines. No trig at all; see the GEO_FAST_PATH_* contract in geo.h.
+double geo_equirect_km(double lat1, double lon1, double cos1, double lat2,
+                       double lon2, double cos2) {
+  double y = lat2 - lat1;
+  double x = (lon2 - lon1) * (cos1 + cos2) / 2;
+  return GEO_KM_PER_DEG * sqrt(x * x + y * y);
+}
+
+// Exact haversine unless the caller only cares about distances up to
+// bound_km and the pair is inside the fast path's validity range.
+double geo_distance_km(double lat1, double lon1, double cos1, double lat2,
+                       double lon2, double cos2, double bound_km) {
+  if (bound_km <= GEO_FAST_PATH_MAX_KM &&
+      fabs(lat1) <= GEO_FAST_PATH_MAX_LAT &&
+      fabs(lat2) <= GEO_FAST_PATH_MAX_LAT && fabs(lon2 - lon1) < 1.0) {
+    double d = geo_equirect_km(lat1, lon1, cos1, lat2, lon2, cos2);
+    if (d <= GEO_FAST_PATH_MAX_KM)
+      return d;
+  }
+  return geo_haversine_cos_km(lat1, lon1, cos1, lat2, lon2, cos2);
+}
+
+// One origin against n points. The loop bodies have no branches or calls
+// besides libm so compilers can vectorize them (e.g. -O3 -ffast-math with
+// glibc's libmvec). coslats may be NULL.
+void geo_haversine_batch(double lat, double lon, const double *lats,
+                         const double *lons, const double *coslats, int n,
+                         double *out) {
+  double cos0 = geo_cos_lat(lat);
+  if (coslats) {
+    for (int i = 0; i < n; i++) {
+      double s_lat = sin((lats[i] - lat) * GEO_DEG_TO_RAD / 2);
+      double s_lon = sin((lons[i] - lon) * GEO_DEG_TO_RAD / 2);
+      double a = s_lat * s_lat + cos0 * coslats[i] * s_lon * s_lon;
+      out[i] = 2 * GEO_EARTH_RADIUS_KM * asin(sqrt(fmin(a, 1.0)));
+    }
+  } else {
+    for (int i = 0; i < n; i++) {
+      double c = cos(lats[i] * GEO_DEG_TO_RAD);
+      double s_lat = sin((lats[i] - lat) * GEO_DEG_TO_RAD / 2);
+      double s_lon = sin((lons[i] - lon) * GEO_DEG_TO_RAD / 2);
+      double a = s_lat * s_lat + cos0 * c * s_lon * s_lon;
+      out[i] = 2 * GEO_EARTH_RADIUS_KM * asin(sqrt(fmin(a, 1.0)));
+    }
+  }
+}
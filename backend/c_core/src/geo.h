@@ -0,0 +1,39 @@
+#ifndef GEO_H
+#define GEO_H
+
+#include <math.h>
+
+#ifndef M_PI
+#define M_PI 3.14159265358979323846
+#endif
+
+// Spherical Earth model shared by the C core and python_api/geo.py
+#define GEO_EARTH_RADIUS_KM 6371.0
+#define GEO_DEG_TO_RAD (M_PI / 180.0)
+#define GEO_KM_PER_DEG (GEO_EARTH_RADIUS_KM * GEO_DEG_TO_RAD)
+
+// Equirectangular fast path contract: for distances up to
+// GEO_FAST_PATH_MAX_KM between points with |lat| <= GEO_FAST_PATH_MAX_LAT,
+// geo_equirect_km stays within GEO_FAST_PATH_REL_ERR (relative) of
+// geo_haversine_km, i.e. under 40 cm at 20 km. Checked by
+// test_geo.py in python_api.
+#define GEO_FAST_PATH_MAX_KM 20.0
+#define GEO_FAST_PATH_MAX_LAT 80.0
+#define GEO_FAST_PATH_REL_ERR 2e-5
+
+static inline double geo_cos_lat(double lat) {
+  return cos(lat * GEO_DEG_TO_RAD);
+}
+
+double geo_haversine_km(double lat1, double lon1, double lat2, double lon2);
+double geo_haversine_cos_km(double lat1, double lon1, double cos1, double lat2,
+                            double lon2, double cos2);
+double geo_equirect_km(double lat1, double lon1, double cos1, double lat2,
+                       double lon2, double cos2);
+double geo_distance_km(double lat1, double lon1, double cos1, double lat2,
+                       double lon2, double cos2, double bound_km);
+void geo_haversine_batch(double lat, double lon, const double *lats,
+                         const double *lons, const double *coslats, int n,
+                         double *out);
+
+#endif
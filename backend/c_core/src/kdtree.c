@@ -28,257 +28,1614 @@ char *my_strcasestr(const char *haystack, const char *needle) {
   return NULL;
 }
 
-#define R_EARTH 6371.0
+static double coord(const KdIndex *index, int i, int axis) {
+  return axis == 0 ? index->lat[i] : index->lon[i];
+}
+
+// Quickselect: rearranges idx[lo..hi] so that idx[k] is the point with the
+// k-th smallest coordinate on axis, with no larger values before it and no
+// smaller values after it. Expected linear time.
+static void select_kth(const KdIndex *index, int *idx, int lo, int hi, int k,
+                       int axis) {
+  while (hi > lo) {
+    int mid = lo + (hi - lo) / 2;
+    double a = coord(index, idx[lo], axis);
+    double b = coord(index, idx[mid], axis);
+    double c = coord(index, idx[hi], axis);
+    double pivot = (a < b) ? ((b < c) ? b : (a < c) ? c : a)
+                           : ((a < c) ? a : (b < c) ? c : b);
+
+    int i = lo, j = hi;
+    while (i <= j) {
+      while (coord(index, idx[i], axis) < pivot)
+        i++;
+      while (coord(index, idx[j], axis) > pivot)
+        j--;
+      if (i <= j) {
+        int tmp = idx[i];
+        idx[i] = idx[j];
+        idx[j] = tmp;
+        i++;
+        j--;
+      }
+    }
 
-int compare_lat(const void *a, const void *b) {
-  POI *p1 = (POI *)a;
-  POI *p2 = (POI *)b;
-  return (p1->lat > p2->lat) - (p1->lat < p2->lat);
+    if (k <= j)
+      hi = j;
+    else if (k >= i)
+      lo = i;
+    else
+      return;
+  }
 }
 
-int compare_lon(const void *a, const void *b) {
-  POI *p1 = (POI *)a;
-  POI *p2 = (POI *)b;
-  return (p1->lon > p2->lon) - (p1->lon < p2->lon);
+static int new_node(KdIndex *index) {
+  if (index->node_count == index->node_capacity) {
+    int capacity = index->node_capacity ? index->node_capacity * 2 : 64;
+    index->nodes = realloc(index->nodes, capacity * sizeof(KdNode));
+    index->node_capacity = capacity;
+  }
+  return index->node_count++;
+}
+
+static int build_recursive(KdIndex *index, int *idx, int lo, int hi) {
+  int n = new_node(index);
+  KdNode node;
+  node.lo = lo;
+  node.hi = hi;
+  node.left = -1;
+  node.right = -1;
+  node.min_lat = node.max_lat = index->lat[idx[lo]];
+  node.min_lon = node.max_lon = index->lon[idx[lo]];
+  node.cat_mask = 0;
+  node.sum_lat = node.sum_lon = 0;
+  for (int i = lo; i < hi; i++) {
+    node.cat_mask |= KD_CAT_BIT(index->cat[idx[i]]);
+    node.sum_lat += index->lat[idx[i]];
+    node.sum_lon += index->lon[idx[i]];
+  }
+  for (int i = lo + 1; i < hi; i++) {
+    double lat = index->lat[idx[i]], lon = index->lon[idx[i]];
+    if (lat < node.min_lat)
+      node.min_lat = lat;
+    if (lat > node.max_lat)
+      node.max_lat = lat;
+    if (lon < node.min_lon)
+      node.min_lon = lon;
+    if (lon > node.max_lon)
+      node.max_lon = lon;
+  }
+  node.cos_lo = geo_cos_lat(fmax(fabs(node.min_lat), fabs(node.max_lat)));
+
+  if (hi - lo > KD_LEAF_SIZE) {
+    // Split the wider side of the box, measured in projected distance
+    double mid_lat = (node.min_lat + node.max_lat) / 2;
+    double lon_extent = (node.max_lon - node.min_lon) * geo_cos_lat(mid_lat);
+    int axis = (node.max_lat - node.min_lat) >= lon_extent ? 0 : 1;
+    int mid = lo + (hi - lo) / 2;
+    select_kth(index, idx, lo, hi - 1, mid, axis);
+
+    node.left = build_recursive(index, idx, lo, mid);
+    node.right = build_recursive(index, idx, mid, hi);
+  }
+
+  index->nodes[n] = node;
+  return n;
 }
 
-Node *build_kdtree(POI *points, int n, int depth) {
+#define PERMUTE(type, field)                                                   \
+  do {                                                                         \
+    type *tmp = (type *)malloc(n * sizeof(type));                              \
+    for (int i = 0; i < n; i++)                                                \
+      tmp[i] = index->field[idx[i]];                                           \
+    free(index->field);                                                        \
+    index->field = tmp;                                                        \
+  } while (0)
+
+// Computes the tree-order permutation with one linear-time median selection
+// per level (O(n log n) overall), then gathers every column into that order.
+void build_kdtree(KdIndex *index) {
+  int n = index->count;
+  index->node_count = 0;
   if (n <= 0)
-    return NULL;
+    return;
 
-  int axis = depth % 2;
+  int *idx = (int *)malloc(n * sizeof(int));
+  for (int i = 0; i < n; i++)
+    idx[i] = i;
 
-  if (axis == 0) {
-    qsort(points, n, sizeof(POI), compare_lat);
-  } else {
-    qsort(points, n, sizeof(POI), compare_lon);
+  build_recursive(index, idx, 0, n);
+
+  PERMUTE(double, lat);
+  PERMUTE(double, lon);
+  PERMUTE(int, ids);
+  PERMUTE(uint32_t, name_off);
+  PERMUTE(uint16_t, cat);
+  free(idx);
+
+  index->coslat = realloc(index->coslat, n * sizeof(double));
+  for (int i = 0; i < n; i++)
+    index->coslat[i] = geo_cos_lat(index->lat[i]);
+
+  build_text_index(index);
+}
+
+// Quotes s as a JSON string. Bytes >= 0x80 are copied through, so UTF-8
+// names stay UTF-8.
+static void print_json_string(const char *s) {
+  putchar('"');
+  for (const unsigned char *p = (const unsigned char *)s; *p; p++) {
+    if (*p == '"' || *p == '\\')
+      printf("\\%c", *p);
+    else if (*p < 0x20)
+      printf("\\u%04x", *p);
+    else
+      putchar(*p);
   }
+  putchar('"');
+}
 
-  int mid = n / 2;
-  Node *node = (Node *)malloc(sizeof(Node));
-  node->data = points[mid];
+void print_poi_json(const KdIndex *index, int pos, double dist,
+                    int is_last) {
+  printf("    {\"id\": %d, \"name\": ", index->ids[pos]);
+  print_json_string(poi_name(index, pos));
+  printf(", \"type\": ");
+  print_json_string(poi_type(index, pos));
+  printf(", \"lat\": %.6f, \"lon\": %.6f, \"dist\": %.6f}%s\n",
+         index->lat[pos], index->lon[pos], dist, is_last ? "" : ",");
+}
 
-  node->left = build_kdtree(points, mid, depth + 1);
-  node->right = build_kdtree(points + mid + 1, n - mid - 1, depth + 1);
+void print_results_json(const KdIndex *index, const ResultSet *results) {
+  printf("[\n");
+  for (int i = 0; i < results->count; i++) {
+    print_poi_json(index, results->items[i], results->dists[i],
+                   i == results->count - 1);
+  }
+  printf("]\n");
+}
 
-  return node;
+static void result_push(ResultSet *out, int pos, double dist) {
+  out->total++;
+  if (out->count == out->capacity) {
+    if (out->fixed)
+      return;
+    int capacity = out->capacity ? out->capacity * 2 : 64;
+    out->items = realloc(out->items, capacity * sizeof(*out->items));
+    out->dists = realloc(out->dists, capacity * sizeof(*out->dists));
+    out->capacity = capacity;
+  }
+  out->items[out->count] = pos;
+  out->dists[out->count] = dist;
+  out->count++;
 }
 
-double to_rad(double deg) { return deg * ((3.15192) / 180.0); }
+// Shared per-query state for the traversals. The type filter is resolved
+// to category ids once per query; type_mask is their union of KD_CAT_BITs.
+// A text query is resolved to the categories whose name contains it
+// (text_cats / text_cat_mask) plus, through the trigram index, the sorted
+// positions whose name may contain it (text_cands; -1 count = not indexed).
+typedef struct {
+  const KdIndex *index;
+  double lat, lon;
+  double cos_lat;
+  int all_types;
+  int type_count;
+  uint16_t types[KD_MAX_TYPE_FILTERS];
+  uint64_t type_mask;
+  const char *query;
+  uint8_t *text_cats;
+  uint64_t text_cat_mask;
+  int *text_cands;
+  int text_cand_count;
+  KdStats *stats;
+} SearchCtx;
 
-double haversine_km(double lat1, double lon1, double lat2, double lon2) {
-  double dlat = to_rad(lat2 - lat1);
-  double dlon = to_rad(lon2 - lon1);
-  double a = sin(dlat / 2) * sin(dlat / 2) + cos(to_rad(lat1)) *
-                                                 cos(to_rad(lat2)) *
-                                                 sin(dlon / 2) * sin(dlon / 2);
-  double c = 2 * atan2(sqrt(a), sqrt(1 - a));
-  return R_EARTH * c;
+int kd_category(const KdIndex *index, const char *name) {
+  for (int c = 0; c < index->cat_count; c++) {
+    if (strcasecmp(index->strings + index->cat_name_off[c], name) == 0)
+      return c;
+  }
+  return -1;
 }
 
-void print_poi_json(POI p, int is_last) {
-  printf("    {\"id\": %d, \"name\": \"%s\", \"type\": \"%s\", \"lat\": %.6f, "
-         "\"lon\": %.6f}%s\n",
-         p.id, p.name, p.type, p.lat, p.lon, is_last ? "" : ",");
+// Parses a comma-separated type filter ("all", "hospital" or
+// "hospital,clinic"). Unknown names match nothing.
+static void resolve_types(SearchCtx *ctx, const char *type_filter) {
+  ctx->all_types = 0;
+  ctx->type_count = 0;
+  ctx->type_mask = 0;
+
+  const char *p = type_filter ? type_filter : "all";
+  while (*p) {
+    char name[MAX_TYPE_LEN];
+    size_t len = strcspn(p, ",");
+    while (len > 0 && isspace((unsigned char)*p)) {
+      p++;
+      len--;
+    }
+    size_t n = len;
+    while (n > 0 && isspace((unsigned char)p[n - 1]))
+      n--;
+
+    if (n > 0 && n < sizeof(name)) {
+      memcpy(name, p, n);
+      name[n] = '\0';
+      if (strcasecmp(name, "all") == 0) {
+        ctx->all_types = 1;
+      } else {
+        int c = kd_category(ctx->index, name);
+        if (c >= 0 && ctx->type_count < KD_MAX_TYPE_FILTERS) {
+          ctx->types[ctx->type_count++] = (uint16_t)c;
+          ctx->type_mask |= KD_CAT_BIT(c);
+        }
+      }
+    }
+
+    p += len;
+    if (*p == ',')
+      p++;
+  }
+  if (ctx->all_types)
+    ctx->type_mask = ~0ULL;
 }
 
-int first_result = 1;
+static void resolve_text(SearchCtx *ctx, const char *query) {
+  const KdIndex *index = ctx->index;
+  ctx->text_cats = NULL;
+  ctx->text_cat_mask = 0;
+  ctx->text_cands = NULL;
+  ctx->text_cand_count = -1;
+  ctx->query = NULL;
+  if (!query || strcmp(query, "NULL_QUERY") == 0 || !*query)
+    return;
+
+  ctx->query = query;
+  ctx->text_cats = (uint8_t *)calloc(index->cat_count + 1, 1);
+  for (int c = 0; c < index->cat_count; c++) {
+    if (my_strcasestr(index->strings + index->cat_name_off[c], query)) {
+      ctx->text_cats[c] = 1;
+      ctx->text_cat_mask |= KD_CAT_BIT(c);
+    }
+  }
+  ctx->text_cand_count = text_candidates(index, query, &ctx->text_cands);
+}
+
+static void set_origin(SearchCtx *ctx, double lat, double lon) {
+  ctx->lat = lat;
+  ctx->lon = lon;
+  ctx->cos_lat = geo_cos_lat(lat);
+}
+
+static void init_ctx(SearchCtx *ctx, const KdIndex *index, double lat,
+                     double lon, const char *type, const char *query,
+                     KdStats *stats) {
+  ctx->index = index;
+  ctx->stats = stats;
+  set_origin(ctx, lat, lon);
+  resolve_types(ctx, type);
+  resolve_text(ctx, query);
+}
+
+static void free_ctx(SearchCtx *ctx) {
+  free(ctx->text_cats);
+  free(ctx->text_cands);
+}
+
+static int type_matches(const SearchCtx *ctx, int pos) {
+  if (ctx->all_types)
+    return 1;
+  uint16_t cat = ctx->index->cat[pos];
+  for (int i = 0; i < ctx->type_count; i++) {
+    if (ctx->types[i] == cat)
+      return 1;
+  }
+  return 0;
+}
+
+static int text_matches(const SearchCtx *ctx, int pos) {
+  if (!ctx->query || ctx->text_cats[ctx->index->cat[pos]])
+    return 1;
+  if (ctx->text_cand_count >= 0) {
+    int i = lower_bound_int(ctx->text_cands, ctx->text_cand_count, pos);
+    if (i == ctx->text_cand_count || ctx->text_cands[i] != pos)
+      return 0;
+  }
+  return my_strcasestr(poi_name(ctx->index, pos), ctx->query) != NULL;
+}
+
+static int poi_matches(const SearchCtx *ctx, int pos) {
+  return type_matches(ctx, pos) && text_matches(ctx, pos);
+}
 
-void range_search_recursive(Node *node, double target_lat, double target_lon,
-                            double radius, const char *type, const char *query,
-                            int depth) {
-  if (!node)
+// Whether any point in the subtree can pass the type and text filters.
+// Nodes cover contiguous positions, so one binary search over the text
+// candidates answers the text side.
+static int node_may_match(const SearchCtx *ctx, const KdNode *node) {
+  if ((node->cat_mask & ctx->type_mask) == 0)
+    return 0;
+  if (!ctx->query || ctx->text_cand_count < 0 ||
+      (node->cat_mask & ctx->text_cat_mask))
+    return 1;
+  int i = lower_bound_int(ctx->text_cands, ctx->text_cand_count, node->lo);
+  return i < ctx->text_cand_count && ctx->text_cands[i] < node->hi;
+}
+
+// Lower bound on the great-circle distance for the given latitude/longitude
+// gaps (in degrees) in an equirectangular projection. cos_lo must be the
+// smallest cos(lat) over the area being bounded; PRUNE_SLACK absorbs the
+// curvature the planar metric ignores and the fast path's error.
+#define PRUNE_SLACK 0.995
+
+static double planar_lower_bound(const SearchCtx *ctx, double dlat,
+                                 double dlon, double cos_lo) {
+  double c = ctx->cos_lat < cos_lo ? ctx->cos_lat : cos_lo;
+  double dy = dlat * GEO_KM_PER_DEG;
+  double dx = dlon * GEO_KM_PER_DEG * c;
+  return sqrt(dx * dx + dy * dy) * PRUNE_SLACK;
+}
+
+static double box_lower_bound(const SearchCtx *ctx, const KdNode *node) {
+  double dlat = 0, dlon = 0;
+  if (ctx->lat < node->min_lat)
+    dlat = node->min_lat - ctx->lat;
+  else if (ctx->lat > node->max_lat)
+    dlat = ctx->lat - node->max_lat;
+  if (ctx->lon < node->min_lon)
+    dlon = node->min_lon - ctx->lon;
+  else if (ctx->lon > node->max_lon)
+    dlon = ctx->lon - node->max_lon;
+  return planar_lower_bound(ctx, dlat, dlon, node->cos_lo);
+}
+
+// Cheap planar rejection against reject_km, then the filters, then the
+// distance, measured for a search bounded by bound_km (see
+// geo_distance_km). Returns a negative value when the point is rejected.
+static double point_distance(const SearchCtx *ctx, int pos, double reject_km,
+                             double bound_km) {
+  const KdIndex *index = ctx->index;
+  double lat = index->lat[pos], lon = index->lon[pos];
+  double cos_p = index->coslat[pos];
+  if (planar_lower_bound(ctx, fabs(lat - ctx->lat), fabs(lon - ctx->lon),
+                         cos_p) > reject_km)
+    return -1;
+  if (!poi_matches(ctx, pos))
+    return -1;
+  if (ctx->stats)
+    ctx->stats->distance_evals++;
+  return geo_distance_km(ctx->lat, ctx->lon, ctx->cos_lat, lat, lon, cos_p,
+                         bound_km);
+}
+
+static void range_recursive(const SearchCtx *ctx, int n, double radius,
+                            ResultSet *out) {
+  const KdNode *node = &ctx->index->nodes[n];
+  if (ctx->stats)
+    ctx->stats->nodes_visited++;
+
+  if (!node_may_match(ctx, node) || box_lower_bound(ctx, node) > radius)
     return;
 
-  double dist =
-      haversine_km(target_lat, target_lon, node->data.lat, node->data.lon);
+  if (node->left < 0) {
+    for (int pos = node->lo; pos < node->hi; pos++) {
+      double dist = point_distance(ctx, pos, radius, radius);
+      if (dist >= 0 && dist <= radius)
+        result_push(out, pos, dist);
+    }
+    return;
+  }
 
-  int type_match =
-      (strcmp(type, "all") == 0) || (strcasecmp(node->data.type, type) == 0);
+  range_recursive(ctx, node->left, radius, out);
+  range_recursive(ctx, node->right, radius, out);
+}
 
-  int query_match = 1;
-  if (query && strcmp(query, "NULL_QUERY") != 0 && strlen(query) > 0) {
-    query_match = (my_strcasestr(node->data.name, query) != NULL) ||
-                  (my_strcasestr(node->data.type, query) != NULL);
+void range_search(const KdIndex *index, double lat, double lon,
+                  double radius_km, const char *type_filter, const char *query,
+                  ResultSet *out, KdStats *stats) {
+  if (index->node_count == 0)
+    return;
+
+  SearchCtx ctx;
+  init_ctx(&ctx, index, lat, lon, type_filter, query, stats);
+  range_recursive(&ctx, 0, radius_km, out);
+  free_ctx(&ctx);
+}
+
+// Sorted results are ordered by distance, then POI id, so pages are stable
+static int hit_less(double da, int ida, double db, int idb) {
+  return da < db || (da == db && ida < idb);
+}
+
+static void hit_swap(int *pos, double *dist, int a, int b) {
+  int p = pos[a];
+  pos[a] = pos[b];
+  pos[b] = p;
+  double d = dist[a];
+  dist[a] = dist[b];
+  dist[b] = d;
+}
+
+// Max-heap on (dist, id) kept in the caller's result arrays
+static void hit_sift_up(const KdIndex *index, int *pos, double *dist, int i) {
+  while (i > 0) {
+    int parent = (i - 1) / 2;
+    if (!hit_less(dist[parent], index->ids[pos[parent]], dist[i],
+                  index->ids[pos[i]]))
+      break;
+    hit_swap(pos, dist, parent, i);
+    i = parent;
   }
+}
 
-  if (dist <= radius && type_match && query_match) {
-    if (!first_result)
-      printf(",\n");
-    print_poi_json(node->data, 1);
-    first_result = 0;
+static void hit_sift_down(const KdIndex *index, int *pos, double *dist, int n,
+                          int i) {
+  for (;;) {
+    int largest = i;
+    for (int c = 2 * i + 1; c <= 2 * i + 2 && c < n; c++) {
+      if (hit_less(dist[largest], index->ids[pos[largest]], dist[c],
+                   index->ids[pos[c]]))
+        largest = c;
+    }
+    if (largest == i)
+      return;
+    hit_swap(pos, dist, i, largest);
+    i = largest;
   }
+}
 
-  int axis = depth % 2;
-  double dist_axis = 0;
+// Heap sorts a max-heap of n hits in place into ascending order
+static void hit_sort(const KdIndex *index, int *pos, double *dist, int n) {
+  for (int end = n - 1; end > 0; end--) {
+    hit_swap(pos, dist, 0, end);
+    hit_sift_down(index, pos, dist, end, 0);
+  }
+}
 
-  if (axis == 0) {
-    dist_axis = (node->data.lat - target_lat) * 111.0;
-  } else {
-    dist_axis = (node->data.lon - target_lon) * 111.0 * cos(to_rad(target_lat));
+// Min-heap of nodes still to expand, keyed by their distance lower bound
+typedef struct {
+  double bound;
+  int node;
+} NodeEntry;
+
+typedef struct {
+  NodeEntry *items;
+  int count;
+  int capacity;
+} NodeHeap;
+
+static void node_heap_push(NodeHeap *h, int node, double bound) {
+  if (h->count == h->capacity) {
+    h->capacity = h->capacity ? h->capacity * 2 : 64;
+    h->items = realloc(h->items, h->capacity * sizeof(NodeEntry));
+  }
+  int i = h->count++;
+  while (i > 0 && h->items[(i - 1) / 2].bound > bound) {
+    h->items[i] = h->items[(i - 1) / 2];
+    i = (i - 1) / 2;
+  }
+  h->items[i].bound = bound;
+  h->items[i].node = node;
+}
+
+static NodeEntry node_heap_pop(NodeHeap *h) {
+  NodeEntry top = h->items[0];
+  NodeEntry last = h->items[--h->count];
+  int i = 0;
+  for (;;) {
+    int c = 2 * i + 1;
+    if (c >= h->count)
+      break;
+    if (c + 1 < h->count && h->items[c + 1].bound < h->items[c].bound)
+      c++;
+    if (h->items[c].bound >= last.bound)
+      break;
+    h->items[i] = h->items[c];
+    i = c;
+  }
+  if (h->count > 0)
+    h->items[i] = last;
+  return top;
+}
+
+// Range search for the first `limit` matches in (distance, id) order that
+// come strictly after the keyset cursor (after_dist, after_id); a negative
+// after_dist starts from the nearest. Nodes are expanded nearest first and
+// the search stops once no unexpanded node can beat the limit-th result, so
+// at most `limit` matches are held, in the caller's positions/dists arrays.
+// Returns the number written, nearest first.
+int kd_range_sorted(const KdIndex *index, double lat, double lon,
+                    double radius_km, const char *type_filter,
+                    const char *query, int limit, double after_dist,
+                    int after_id, int *positions, double *dists,
+                    KdStats *stats) {
+  if (limit <= 0 || index->node_count == 0)
+    return 0;
+
+  SearchCtx ctx;
+  init_ctx(&ctx, index, lat, lon, type_filter, query, stats);
+  NodeHeap open = {0};
+  node_heap_push(&open, 0, box_lower_bound(&ctx, &index->nodes[0]));
+
+  int n = 0;
+  while (open.count > 0) {
+    NodeEntry e = node_heap_pop(&open);
+    if (e.bound > (n == limit ? fmin(radius_km, dists[0]) : radius_km))
+      break;
+
+    const KdNode *node = &index->nodes[e.node];
+    if (stats)
+      stats->nodes_visited++;
+    if (!node_may_match(&ctx, node))
+      continue;
+
+    if (node->left >= 0) {
+      double lb = box_lower_bound(&ctx, &index->nodes[node->left]);
+      if (lb <= radius_km)
+        node_heap_push(&open, node->left, lb);
+      lb = box_lower_bound(&ctx, &index->nodes[node->right]);
+      if (lb <= radius_km)
+        node_heap_push(&open, node->right, lb);
+      continue;
+    }
+
+    for (int pos = node->lo; pos < node->hi; pos++) {
+      // Reject against the page so far but always measure for the radius,
+      // so that a point gets the same distance on every page
+      double bound = n == limit ? fmin(radius_km, dists[0]) : radius_km;
+      double dist = point_distance(&ctx, pos, bound, radius_km);
+      if (dist < 0 || dist > radius_km)
+        continue;
+      int id = index->ids[pos];
+      if (after_dist >= 0 && !hit_less(after_dist, after_id, dist, id))
+        continue;
+      if (n < limit) {
+        positions[n] = pos;
+        dists[n] = dist;
+        hit_sift_up(index, positions, dists, n++);
+      } else if (hit_less(dist, id, dists[0], index->ids[positions[0]])) {
+        positions[0] = pos;
+        dists[0] = dist;
+        hit_sift_down(index, positions, dists, n, 0);
+      }
+    }
+  }
+  free(open.items);
+  free_ctx(&ctx);
+  hit_sort(index, positions, dists, n);
+  return n;
+}
+
+// Even-odd test with latitude as y and longitude as x
+static int polygon_contains(const KdRegion *r, double lat, double lon) {
+  int inside = 0;
+  for (int i = 0, j = r->poly_n - 1; i < r->poly_n; j = i++) {
+    double yi = r->poly_lat[i], yj = r->poly_lat[j];
+    if ((yi > lat) != (yj > lat)) {
+      double xi = r->poly_lon[i], xj = r->poly_lon[j];
+      if (lon < xi + (lat - yi) * (xj - xi) / (yj - yi))
+        inside = !inside;
+    }
+  }
+  return inside;
+}
+
+// Whether segment (lat0, lon0)-(lat1, lon1) touches the node's box
+// (Liang-Barsky clipping)
+static int segment_hits_box(double lat0, double lon0, double lat1,
+                            double lon1, const KdNode *b) {
+  double p[4] = {lon0 - lon1, lon1 - lon0, lat0 - lat1, lat1 - lat0};
+  double q[4] = {lon0 - b->min_lon, b->max_lon - lon0, lat0 - b->min_lat,
+                 b->max_lat - lat0};
+  double t0 = 0, t1 = 1;
+  for (int i = 0; i < 4; i++) {
+    if (p[i] == 0) {
+      if (q[i] < 0)
+        return 0;
+      continue;
+    }
+    double t = q[i] / p[i];
+    if (p[i] < 0 && t > t0)
+      t0 = t;
+    else if (p[i] > 0 && t < t1)
+      t1 = t;
+    if (t0 > t1)
+      return 0;
+  }
+  return 1;
+}
+
+static int region_contains(const KdRegion *r, double lat, double lon) {
+  if (lat < r->min_lat || lat > r->max_lat || lon < r->min_lon ||
+      lon > r->max_lon)
+    return 0;
+  return r->poly_n < 3 || polygon_contains(r, lat, lon);
+}
+
+#define REGION_OUTSIDE 0
+#define REGION_PARTIAL 1
+#define REGION_INSIDE 2
+
+// Classifies a node's box against the region. A box that no polygon edge
+// touches is either wholly inside or wholly outside the polygon, so one
+// corner decides which.
+static int region_overlap(const KdRegion *r, const KdNode *node) {
+  if (node->max_lat < r->min_lat || node->min_lat > r->max_lat ||
+      node->max_lon < r->min_lon || node->min_lon > r->max_lon)
+    return REGION_OUTSIDE;
+  if (node->min_lat < r->min_lat || node->max_lat > r->max_lat ||
+      node->min_lon < r->min_lon || node->max_lon > r->max_lon)
+    return REGION_PARTIAL;
+  if (r->poly_n < 3)
+    return REGION_INSIDE;
+  for (int i = 0, j = r->poly_n - 1; i < r->poly_n; j = i++) {
+    if (segment_hits_box(r->poly_lat[j], r->poly_lon[j], r->poly_lat[i],
+                         r->poly_lon[i], node))
+      return REGION_PARTIAL;
+  }
+  return polygon_contains(r, node->min_lat, node->min_lon) ? REGION_INSIDE
+                                                           : REGION_OUTSIDE;
+}
+
+static void region_recursive(const SearchCtx *ctx, const KdRegion *r, int n,
+                             int overlap, ResultSet *out) {
+  const KdNode *node = &ctx->index->nodes[n];
+  if (ctx->stats)
+    ctx->stats->nodes_visited++;
+  if (!node_may_match(ctx, node))
+    return;
+  if (overlap != REGION_INSIDE) {
+    overlap = region_overlap(r, node);
+    if (overlap == REGION_OUTSIDE)
+      return;
+  }
+
+  if (node->left < 0) {
+    for (int pos = node->lo; pos < node->hi; pos++) {
+      if ((overlap == REGION_INSIDE ||
+           region_contains(r, ctx->index->lat[pos], ctx->index->lon[pos])) &&
+          poi_matches(ctx, pos))
+        result_push(out, pos, 0);
+    }
+    return;
   }
+  region_recursive(ctx, r, node->left, overlap, out);
+  region_recursive(ctx, r, node->right, overlap, out);
+}
+
+// Every match inside the region, in tree order (spatially grouped). Up to
+// capacity tree positions are written; returns the total number of
+// matches.
+int kd_region(const KdIndex *index, const KdRegion *region,
+              const char *type_filter, const char *query, int *positions,
+              int capacity, KdStats *stats) {
+  if (index->node_count == 0)
+    return 0;
+
+  double *dists = (double *)malloc((capacity > 0 ? capacity : 1) *
+                                   sizeof(double));
+  ResultSet out = {positions, dists, 0, capacity, 0, 1};
+  SearchCtx ctx;
+  init_ctx(&ctx, index, (region->min_lat + region->max_lat) / 2,
+           (region->min_lon + region->max_lon) / 2, type_filter, query,
+           stats);
+  region_recursive(&ctx, region, 0, REGION_PARTIAL, &out);
+  free_ctx(&ctx);
+  free(dists);
+  return out.total;
+}
+
+// Grid cells of cell_deg degrees, keyed by (row, col) in an open-addressing
+// table whose slots index the caller's output arrays. Cells past the
+// caller's capacity keep a GRID_DROPPED slot, so each is counted once.
+#define GRID_EMPTY -1
+#define GRID_DROPPED -2
 
-  double r_deg_lat = radius / 111.0;
-  double r_deg_lon = radius / (111.0 * cos(to_rad(target_lat)));
+typedef struct {
+  double cell_deg;
+  int64_t *keys;
+  int *slots;
+  int mask;
+  double *lat, *lon;
+  int *counts, *samples;
+  int count, capacity;
+} ClusterGrid;
+
+static int64_t cell_key(const ClusterGrid *g, double lat, double lon) {
+  int64_t row = (int64_t)floor(lat / g->cell_deg);
+  int64_t col = (int64_t)floor(lon / g->cell_deg);
+  return row * 4294967296LL + col;
+}
+
+static int grid_find(const int64_t *keys, const int *slots, int mask,
+                     int64_t key) {
+  uint64_t h = (uint64_t)key * 0x9E3779B97F4A7C15ULL;
+  int i = (int)(h >> 40) & mask;
+  while (slots[i] != GRID_EMPTY && keys[i] != key)
+    i = (i + 1) & mask;
+  return i;
+}
+
+static void grid_init(ClusterGrid *g, int size) {
+  g->keys = (int64_t *)malloc(size * sizeof(int64_t));
+  g->slots = (int *)malloc(size * sizeof(int));
+  g->mask = size - 1;
+  memset(g->slots, GRID_EMPTY, size * sizeof(int));
+}
+
+// Doubles the table once it is half full; only dropped cells get it there
+static void grid_grow(ClusterGrid *g) {
+  int64_t *keys = g->keys;
+  int *slots = g->slots;
+  int size = g->mask + 1;
+  grid_init(g, 2 * size);
+  for (int i = 0; i < size; i++) {
+    if (slots[i] == GRID_EMPTY)
+      continue;
+    int j = grid_find(g->keys, g->slots, g->mask, keys[i]);
+    g->keys[j] = keys[i];
+    g->slots[j] = slots[i];
+  }
+  free(keys);
+  free(slots);
+}
+
+static void grid_add(ClusterGrid *g, int64_t key, int count, double sum_lat,
+                     double sum_lon, int sample) {
+  int i = grid_find(g->keys, g->slots, g->mask, key);
+  int slot = g->slots[i];
+  if (slot == GRID_EMPTY) {
+    slot = g->count < g->capacity ? g->count : GRID_DROPPED;
+    g->count++;
+    g->keys[i] = key;
+    g->slots[i] = slot;
+    if (2 * g->count > g->mask + 1)
+      grid_grow(g);
+    if (slot == GRID_DROPPED)
+      return;
+    g->lat[slot] = g->lon[slot] = 0;
+    g->counts[slot] = 0;
+    g->samples[slot] = sample;
+  } else if (slot == GRID_DROPPED) {
+    return;
+  }
+  g->lat[slot] += sum_lat;
+  g->lon[slot] += sum_lon;
+  g->counts[slot] += count;
+}
 
-  if (axis == 0) {
-    if (target_lat - r_deg_lat <= node->data.lat)
-      range_search_recursive(node->left, target_lat, target_lon, radius, type,
-                             query, depth + 1);
-    if (target_lat + r_deg_lat >= node->data.lat)
-      range_search_recursive(node->right, target_lat, target_lon, radius, type,
-                             query, depth + 1);
+static void cluster_recursive(const SearchCtx *ctx, const KdRegion *r, int n,
+                              int overlap, ClusterGrid *g) {
+  const KdIndex *index = ctx->index;
+  const KdNode *node = &index->nodes[n];
+  if (ctx->stats)
+    ctx->stats->nodes_visited++;
+  if (!node_may_match(ctx, node))
+    return;
+  if (overlap != REGION_INSIDE) {
+    overlap = region_overlap(r, node);
+    if (overlap == REGION_OUTSIDE)
+      return;
+  }
+
+  // Unfiltered subtrees inside the region and inside one cell are added
+  // from their counts and coordinate sums alone
+  int64_t key = cell_key(g, node->min_lat, node->min_lon);
+  if (overlap == REGION_INSIDE && ctx->all_types && !ctx->query &&
+      cell_key(g, node->max_lat, node->max_lon) == key) {
+    grid_add(g, key, node->hi - node->lo, node->sum_lat, node->sum_lon,
+             node->lo);
+    return;
+  }
+
+  if (node->left < 0) {
+    for (int pos = node->lo; pos < node->hi; pos++) {
+      double lat = index->lat[pos], lon = index->lon[pos];
+      if ((overlap == REGION_INSIDE || region_contains(r, lat, lon)) &&
+          poi_matches(ctx, pos))
+        grid_add(g, cell_key(g, lat, lon), 1, lat, lon, pos);
+    }
+    return;
+  }
+  cluster_recursive(ctx, r, node->left, overlap, g);
+  cluster_recursive(ctx, r, node->right, overlap, g);
+}
+
+// Counts the matches inside the region per grid cell of cell_deg degrees.
+// Each of up to capacity cells gets the centroid of its matches, their
+// count and one of their tree positions. Returns the number of non-empty
+// cells, more than capacity if some were left out; the grid rows times
+// columns the region spans always fit.
+int kd_clusters(const KdIndex *index, const KdRegion *region,
+                double cell_deg, const char *type_filter, const char *query,
+                double *lat, double *lon, int *counts, int *samples,
+                int capacity, KdStats *stats) {
+  if (index->node_count == 0 || capacity <= 0 || cell_deg <= 0)
+    return 0;
+
+  int size = 16;
+  while (size < 2 * capacity)
+    size *= 2;
+  ClusterGrid g = {cell_deg, NULL, NULL, 0, lat, lon,
+                   counts, samples, 0, capacity};
+  grid_init(&g, size);
+
+  SearchCtx ctx;
+  init_ctx(&ctx, index, (region->min_lat + region->max_lat) / 2,
+           (region->min_lon + region->max_lon) / 2, type_filter, query,
+           stats);
+  cluster_recursive(&ctx, region, 0, REGION_PARTIAL, &g);
+  free_ctx(&ctx);
+  free(g.keys);
+  free(g.slots);
+
+  int cells = g.count < capacity ? g.count : capacity;
+  for (int i = 0; i < cells; i++) {
+    lat[i] /= counts[i];
+    lon[i] /= counts[i];
+  }
+  return g.count;
+}
+
+static uint32_t intern_string(KdIndex *index, const char *s) {
+  size_t n = strlen(s) + 1;
+  if (index->strings_len + n > index->strings_cap) {
+    size_t cap = index->strings_cap ? index->strings_cap : 4096;
+    while (cap < index->strings_len + n)
+      cap *= 2;
+    index->strings = realloc(index->strings, cap);
+    index->strings_cap = cap;
+  }
+  uint32_t off = (uint32_t)index->strings_len;
+  memcpy(index->strings + off, s, n);
+  index->strings_len += n;
+  return off;
+}
+
+static uint32_t hash_lower(const char *s) {
+  uint32_t h = 2166136261u;
+  for (; *s; s++) {
+    h ^= (uint32_t)tolower((unsigned char)*s);
+    h *= 16777619u;
+  }
+  return h;
+}
+
+static void cat_hash_insert(KdIndex *index, int cat) {
+  uint32_t mask = (uint32_t)index->cat_hash_size - 1;
+  uint32_t h = hash_lower(index->strings + index->cat_name_off[cat]) & mask;
+  while (index->cat_hash[h] >= 0)
+    h = (h + 1) & mask;
+  index->cat_hash[h] = cat;
+}
+
+// Returns the category id for a type name, adding it on first sight.
+// Matching is case-insensitive; the first spelling seen is kept.
+static int intern_category(KdIndex *index, const char *type) {
+  if (index->cat_hash_size) {
+    uint32_t mask = (uint32_t)index->cat_hash_size - 1;
+    for (uint32_t h = hash_lower(type) & mask; index->cat_hash[h] >= 0;
+         h = (h + 1) & mask) {
+      int c = index->cat_hash[h];
+      if (strcasecmp(index->strings + index->cat_name_off[c], type) == 0)
+        return c;
+    }
+  }
+
+  if (index->cat_count == KD_MAX_CATEGORIES) {
+    fprintf(stderr, "Too many POI categories, skipping type %s\n", type);
+    return -1;
+  }
+  if (index->cat_count == index->cat_capacity) {
+    index->cat_capacity = index->cat_capacity ? index->cat_capacity * 2 : 64;
+    index->cat_name_off =
+        realloc(index->cat_name_off, index->cat_capacity * sizeof(uint32_t));
+  }
+  int cat = index->cat_count++;
+  index->cat_name_off[cat] = intern_string(index, type);
+
+  if (index->cat_count * 2 > index->cat_hash_size) {
+    index->cat_hash_size = index->cat_hash_size ? index->cat_hash_size * 2 : 64;
+    free(index->cat_hash);
+    index->cat_hash = (int *)malloc(index->cat_hash_size * sizeof(int));
+    for (int i = 0; i < index->cat_hash_size; i++)
+      index->cat_hash[i] = -1;
+    for (int c = 0; c < index->cat_count; c++)
+      cat_hash_insert(index, c);
   } else {
-    if (target_lon - r_deg_lon <= node->data.lon)
-      range_search_recursive(node->left, target_lat, target_lon, radius, type,
-                             query, depth + 1);
-    if (target_lon + r_deg_lon >= node->data.lon)
-      range_search_recursive(node->right, target_lat, target_lon, radius, type,
-                             query, depth + 1);
+    cat_hash_insert(index, cat);
   }
+  return cat;
 }
 
-void range_search(Node *root, double lat, double lon, double radius_km,
-                  const char *type_filter, const char *query) {
-  first_result = 1;
-  printf("[\n");
-  range_search_recursive(root, lat, lon, radius_km, type_filter, query, 0);
-  printf("\n]\n");
+static void index_reserve(KdIndex *index, int capacity) {
+  if (capacity <= index->capacity)
+    return;
+  index->lat = realloc(index->lat, capacity * sizeof(double));
+  index->lon = realloc(index->lon, capacity * sizeof(double));
+  index->ids = realloc(index->ids, capacity * sizeof(int));
+  index->name_off = realloc(index->name_off, capacity * sizeof(uint32_t));
+  index->cat = realloc(index->cat, capacity * sizeof(uint16_t));
+  index->capacity = capacity;
+}
+
+// Appends one POI to the unbuilt index; fails when its type cannot be
+// interned
+static int index_append(KdIndex *index, int id, double lat, double lon,
+                        const char *name, const char *type) {
+  int cat = intern_category(index, type);
+  if (cat < 0)
+    return -1;
+
+  if (index->count == index->capacity)
+    index_reserve(index, index->capacity ? index->capacity * 2 : 1024);
+
+  int i = index->count++;
+  index->ids[i] = id;
+  index->lat[i] = lat;
+  index->lon[i] = lon;
+  index->name_off[i] = intern_string(index, name);
+  index->cat[i] = (uint16_t)cat;
+  return 0;
+}
+
+// Splits one CSV record in place into at most max fields and returns how
+// many it found. Quoted fields may hold commas and doubled quotes; the
+// line ending is dropped.
+static int split_csv(char *line, char **fields, int max) {
+  int n = 0;
+  char *p = line;
+  while (n < max) {
+    char *out = p;
+    fields[n++] = p;
+    if (*p == '"') {
+      p++;
+      while (*p) {
+        if (*p == '"' && p[1] == '"') {
+          *out++ = '"';
+          p += 2;
+        } else if (*p == '"') {
+          p++;
+          break;
+        } else {
+          *out++ = *p++;
+        }
+      }
+      while (*p && *p != ',' && *p != '\n' && *p != '\r')
+        p++;
+    } else {
+      while (*p && *p != ',' && *p != '\n' && *p != '\r')
+        p++;
+      out = p;
+    }
+    char end = *p;
+    *out = '\0';
+    if (end != ',')
+      break;
+    p++;
+  }
+  return n;
 }
 
-void load_pois(const char *filename, POI **points, int *count) {
+#define CSV_ID 0
+#define CSV_NAME 1
+#define CSV_TYPE 2
+#define CSV_LAT 3
+#define CSV_LON 4
+#define CSV_COLUMNS 5
+#define CSV_MAX_FIELDS 64
+
+// Header names accepted for each column, e.g. the campus file's
+// name,category,latitude,longitude,eco_score
+static const char *const csv_aliases[CSV_COLUMNS][4] = {
+    {"id", NULL},
+    {"name", NULL},
+    {"type", "category", NULL},
+    {"lat", "latitude", NULL},
+    {"lon", "lng", "longitude", NULL},
+};
+
+// Maps header fields to columns. Returns 0 when name, type, lat and lon
+// were all found (id may be missing), else -1.
+static int map_header(char **fields, int n, int *cols) {
+  for (int c = 0; c < CSV_COLUMNS; c++)
+    cols[c] = -1;
+  for (int f = 0; f < n; f++) {
+    char *name = fields[f];
+    while (isspace((unsigned char)*name))
+      name++;
+    size_t len = strlen(name);
+    while (len && isspace((unsigned char)name[len - 1]))
+      name[--len] = '\0';
+    for (int c = 0; c < CSV_COLUMNS; c++)
+      for (int a = 0; csv_aliases[c][a]; a++)
+        if (cols[c] < 0 && strcasecmp(name, csv_aliases[c][a]) == 0)
+          cols[c] = f;
+  }
+  for (int c = CSV_NAME; c < CSV_COLUMNS; c++)
+    if (cols[c] < 0)
+      return -1;
+  return 0;
+}
+
+static int parse_double(const char *s, double *out) {
+  char *end;
+  *out = strtod(s, &end);
+  while (isspace((unsigned char)*end))
+    end++;
+  return end != s && *end == '\0' && isfinite(*out);
+}
+
+// Appends every row of a POI CSV to the (unbuilt) index in a single pass.
+// Columns are found by header name (id,name,type,lat,lon plus the aliases
+// above); a header without them is read as id,name,type,lat,lon. Files
+// without an id column get ids after the largest one already loaded.
+// Blank lines, # comments and rows that do not parse are skipped.
+int load_pois(const char *filename, KdIndex *index) {
   FILE *file = fopen(filename, "r");
   if (!file) {
     fprintf(stderr, "Error opening file %s\n", filename);
-    exit(1);
+    return -1;
   }
 
   char line[MAX_LINE_LEN];
-  fgets(line, sizeof(line), file);
+  char *fields[CSV_MAX_FIELDS];
+  int cols[CSV_COLUMNS] = {-1};
+  int have_header = 0;
+  int next_id = 0;
 
-  int n = 0;
   while (fgets(line, sizeof(line), file)) {
-    n++;
+    // An overlong line is dropped whole rather than read as several rows
+    if (!strchr(line, '\n') && !feof(file)) {
+      int ch;
+      while ((ch = fgetc(file)) != EOF && ch != '\n')
+        ;
+      continue;
+    }
+    if (line[0] == '#' || line[0] == '\n' || line[0] == '\r')
+      continue;
+
+    int n = split_csv(line, fields, CSV_MAX_FIELDS);
+    if (!have_header) {
+      have_header = 1;
+      if (map_header(fields, n, cols) != 0)
+        for (int c = 0; c < CSV_COLUMNS; c++)
+          cols[c] = c;
+      if (cols[CSV_ID] < 0)
+        for (int i = 0; i < index->count; i++)
+          if (index->ids[i] > next_id)
+            next_id = index->ids[i];
+      continue;
+    }
+
+    int id;
+    double lat, lon;
+    const char *name = cols[CSV_NAME] < n ? fields[cols[CSV_NAME]] : "";
+    const char *type = cols[CSV_TYPE] < n ? fields[cols[CSV_TYPE]] : "";
+    if (!*name || !*type || cols[CSV_LAT] >= n || cols[CSV_LON] >= n ||
+        !parse_double(fields[cols[CSV_LAT]], &lat) ||
+        !parse_double(fields[cols[CSV_LON]], &lon))
+      continue;
+    if (cols[CSV_ID] < 0) {
+      id = ++next_id;
+    } else {
+      double value;
+      if (cols[CSV_ID] >= n || !parse_double(fields[cols[CSV_ID]], &value) ||
+          value != floor(value) || value <= 0 || value > INT32_MAX)
+        continue;
+      id = (int)value;
+    }
+    index_append(index, id, lat, lon, name, type);
   }
 
-  *points = (POI *)malloc(n * sizeof(POI));
-  *count = n;
+  fclose(file);
+  return 0;
+}
 
-  rewind(file);
-  fgets(line, sizeof(line), file);
+// Best-first kNN: nodes are expanded nearest bound first and the k best
+// matches so far are kept as a max-heap on (dist, id) in positions/dists,
+// so no node whose bound exceeds the k-th distance is ever opened. With
+// epsilon > 0 a node must beat the k-th distance by a factor of 1 + epsilon
+// to be opened, which keeps every result within 1 + epsilon of the true
+// k-th neighbour. max_nodes > 0 stops after that many nodes with the best
+// matches found so far. Returns the number of results, nearest first.
+static int knn_best_first(const SearchCtx *ctx, int k, double epsilon,
+                          int max_nodes, int *positions, double *dists) {
+  const KdIndex *index = ctx->index;
+  if (k <= 0 || index->node_count == 0)
+    return 0;
 
-  int i = 0;
-  while (fgets(line, sizeof(line), file)) {
-    POI *p = &(*points)[i];
-    sscanf(line, "%d,%[^,],%[^,],%lf,%lf", &p->id, p->name, p->type, &p->lat,
-           &p->lon);
-    i++;
+  double scale = epsilon > 0 ? 1.0 + epsilon : 1.0;
+  NodeHeap open = {0};
+  node_heap_push(&open, 0, box_lower_bound(ctx, &index->nodes[0]));
+
+  int n = 0, expanded = 0;
+  while (open.count > 0) {
+    NodeEntry e = node_heap_pop(&open);
+    if (n == k && e.bound * scale > dists[0])
+      break;
+    if (max_nodes > 0 && expanded == max_nodes)
+      break;
+    expanded++;
+
+    const KdNode *node = &index->nodes[e.node];
+    if (ctx->stats)
+      ctx->stats->nodes_visited++;
+    if (!node_may_match(ctx, node))
+      continue;
+
+    if (node->left >= 0) {
+      int children[2] = {node->left, node->right};
+      for (int c = 0; c < 2; c++) {
+        double lb = box_lower_bound(ctx, &index->nodes[children[c]]);
+        if (n < k || lb * scale <= dists[0])
+          node_heap_push(&open, children[c], lb);
+      }
+      continue;
+    }
+
+    for (int pos = node->lo; pos < node->hi; pos++) {
+      double bound = n == k ? dists[0] : INFINITY;
+      double dist = point_distance(ctx, pos, bound, bound);
+      if (dist < 0)
+        continue;
+      int id = index->ids[pos];
+      if (n < k) {
+        positions[n] = pos;
+        dists[n] = dist;
+        hit_sift_up(index, positions, dists, n++);
+      } else if (hit_less(dist, id, dists[0], index->ids[positions[0]])) {
+        positions[0] = pos;
+        dists[0] = dist;
+        hit_sift_down(index, positions, dists, n, 0);
+      }
+    }
   }
+  free(open.items);
+  hit_sort(index, positions, dists, n);
+  return n;
+}
 
-  fclose(file);
+static void knn_run(const SearchCtx *ctx, int k, ResultSet *out) {
+  // There are never more results than POIs, however large k is
+  if (k > ctx->index->count)
+    k = ctx->index->count;
+  if (k <= 0 || ctx->index->node_count == 0)
+    return;
+
+  int *positions = (int *)malloc((size_t)k * sizeof(int));
+  double *dists = (double *)malloc((size_t)k * sizeof(double));
+  int n = knn_best_first(ctx, k, 0, 0, positions, dists);
+  for (int i = 0; i < n; i++)
+    result_push(out, positions[i], dists[i]);
+  free(positions);
+  free(dists);
 }
 
-void free_tree(Node *root) {
-  if (!root)
+void knn_search(const KdIndex *index, double lat, double lon, int k,
+                const char *type_filter, const char *query, ResultSet *out,
+                KdStats *stats) {
+  if (k <= 0 || index->node_count == 0)
     return;
-  free_tree(root->left);
-  free_tree(root->right);
-  free(root);
+
+  SearchCtx ctx;
+  init_ctx(&ctx, index, lat, lon, type_filter, query, stats);
+  knn_run(&ctx, k, out);
+  free_ctx(&ctx);
+}
+
+// Reads the CSVs without building the tree; kd_open is kd_load followed by
+// build_kdtree, split so callers can time the two apart
+KdIndex *kd_load(const char *poi_file, const char *campus_file) {
+  KdIndex *index = (KdIndex *)calloc(1, sizeof(KdIndex));
+  if (!index)
+    return NULL;
+
+  if (load_pois(poi_file, index) != 0) {
+    kd_close(index);
+    return NULL;
+  }
+  if (campus_file)
+    load_pois(campus_file, index);
+  return index;
+}
+
+KdIndex *kd_open(const char *poi_file, const char *campus_file) {
+  KdIndex *index = kd_load(poi_file, campus_file);
+  if (index)
+    build_kdtree(index);
+  return index;
+}
+
+// Builds an index from columns instead of CSV files, e.g. to compact a base
+// index and its pending edits into a fresh tree
+KdIndex *kd_build(int n, const int *ids, const double *lat, const double *lon,
+                  const char **names, const char **types) {
+  KdIndex *index = kd_create();
+  if (!index)
+    return NULL;
+
+  kd_append(index, n, ids, lat, lon, names, types);
+  build_kdtree(index);
+  return index;
+}
+
+// An empty index to fill in chunks with kd_append, then finish with
+// build_kdtree
+KdIndex *kd_create(void) { return (KdIndex *)calloc(1, sizeof(KdIndex)); }
+
+// Appends n POIs to an unbuilt index and returns how many were added;
+// rows whose type cannot be interned are skipped
+int kd_append(KdIndex *index, int n, const int *ids, const double *lat,
+              const double *lon, const char **names, const char **types) {
+  if (index->count + n > index->capacity) {
+    int capacity = index->capacity * 2;
+    index_reserve(index, capacity > index->count + n ? capacity
+                                                     : index->count + n);
+  }
+  int added = 0;
+  for (int i = 0; i < n; i++)
+    if (index_append(index, ids[i], lat[i], lon[i], names[i], types[i]) == 0)
+      added++;
+  return added;
 }
 
 typedef struct {
-  POI poi;
-  double dist;
-} BpqItem;
+  int id;
+  int pos;
+} IdPos;
 
 typedef struct {
-  BpqItem *items;
-  int count;
-  int k;
-} Bpq;
-
-void bpq_insert(Bpq *q, POI p, double dist) {
-  if (q->count < q->k) {
-    q->items[q->count].poi = p;
-    q->items[q->count].dist = dist;
-    q->count++;
-  } else if (dist < q->items[q->count - 1].dist) {
-    q->items[q->count - 1].poi = p;
-    q->items[q->count - 1].dist = dist;
-  } else {
-    return;
+  const char *name;
+  double lat;
+  int cat;
+  int pos;
+} NamePos;
+
+static int cmp_id_pos(const void *a, const void *b) {
+  const IdPos *x = (const IdPos *)a, *y = (const IdPos *)b;
+  if (x->id != y->id)
+    return x->id < y->id ? -1 : 1;
+  return x->pos - y->pos;
+}
+
+static int cmp_name_pos(const void *a, const void *b) {
+  const NamePos *x = (const NamePos *)a, *y = (const NamePos *)b;
+  if (x->cat != y->cat)
+    return x->cat - y->cat;
+  int c = strcasecmp(x->name, y->name);
+  if (c)
+    return c;
+  if (x->lat != y->lat)
+    return x->lat < y->lat ? -1 : 1;
+  return x->pos - y->pos;
+}
+
+// Drops POIs that repeat an earlier POI's id, or that have the same type
+// and name (ignoring case) as an earlier POI within radius_km of it; the
+// first appended copy is kept. Runs on an unbuilt index, before
+// build_kdtree. Returns the number of POIs removed, or -1.
+int kd_dedup(KdIndex *index, double radius_km) {
+  int n = index->count;
+  if (index->nodes || index->map_base)
+    return -1;
+  if (n <= 0)
+    return 0;
+
+  unsigned char *drop = (unsigned char *)calloc((size_t)n, 1);
+  IdPos *by_id = (IdPos *)malloc((size_t)n * sizeof(IdPos));
+  if (!drop || !by_id) {
+    free(drop);
+    free(by_id);
+    return -1;
   }
-  for (int i = q->count - 1; i > 0; i--) {
-    if (q->items[i].dist < q->items[i - 1].dist) {
-      BpqItem temp = q->items[i];
-      q->items[i] = q->items[i - 1];
-      q->items[i - 1] = temp;
-    } else {
-      break;
+  for (int i = 0; i < n; i++) {
+    by_id[i].id = index->ids[i];
+    by_id[i].pos = i;
+  }
+  qsort(by_id, n, sizeof(IdPos), cmp_id_pos);
+  for (int i = 1; i < n; i++)
+    if (by_id[i].id == by_id[i - 1].id)
+      drop[by_id[i].pos] = 1;
+  free(by_id);
+
+  // Same-name POIs of one type, by latitude: only neighbours within the
+  // radius in latitude can be close enough to compare
+  NamePos *by_name =
+      radius_km > 0 ? (NamePos *)malloc((size_t)n * sizeof(NamePos)) : NULL;
+  if (by_name) {
+    int m = 0;
+    for (int i = 0; i < n; i++) {
+      if (drop[i])
+        continue;
+      by_name[m].name = poi_name(index, i);
+      by_name[m].lat = index->lat[i];
+      by_name[m].cat = index->cat[i];
+      by_name[m].pos = i;
+      m++;
+    }
+    qsort(by_name, m, sizeof(NamePos), cmp_name_pos);
+    double radius_deg = radius_km / GEO_KM_PER_DEG;
+    for (int i = 0; i < m; i++) {
+      const NamePos *a = &by_name[i];
+      for (int j = i + 1; j < m && !drop[a->pos]; j++) {
+        const NamePos *b = &by_name[j];
+        if (b->cat != a->cat || b->lat - a->lat > radius_deg ||
+            strcasecmp(b->name, a->name) != 0)
+          break;
+        if (drop[b->pos] ||
+            geo_haversine_km(a->lat, index->lon[a->pos], b->lat,
+                             index->lon[b->pos]) > radius_km)
+          continue;
+        drop[a->pos < b->pos ? b->pos : a->pos] = 1;
+      }
     }
+    free(by_name);
+  }
+
+  int kept = 0;
+  for (int i = 0; i < n; i++) {
+    if (drop[i])
+      continue;
+    index->ids[kept] = index->ids[i];
+    index->lat[kept] = index->lat[i];
+    index->lon[kept] = index->lon[i];
+    index->name_off[kept] = index->name_off[i];
+    index->cat[kept] = index->cat[i];
+    kept++;
+  }
+  free(drop);
+  index->count = kept;
+  return n - kept;
+}
+
+int kd_size(const KdIndex *index) { return index->count; }
+
+// Tree position of the POI with this id, or -1. A linear scan, meant for
+// occasional lookups such as admin edits.
+int kd_find_id(const KdIndex *index, int id) {
+  for (int pos = 0; pos < index->count; pos++) {
+    if (index->ids[pos] == id)
+      return pos;
   }
+  return -1;
 }
 
-double current_max_dist(Bpq *q) {
-  if (q->count < q->k)
-    return 1e9;
-  return q->items[q->count - 1].dist;
+int kd_range(const KdIndex *index, double lat, double lon, double radius_km,
+             const char *type_filter, const char *query, ResultSet *out,
+             KdStats *stats) {
+  range_search(index, lat, lon, radius_km, type_filter, query, out, stats);
+  return out->count;
 }
 
-void knn_recursive(Node *node, double t_lat, double t_lon, Bpq *q,
-                   const char *type, const char *query, int depth) {
-  if (!node)
-    return;
+int kd_knn(const KdIndex *index, double lat, double lon, int k,
+           const char *type_filter, const char *query, ResultSet *out,
+           KdStats *stats) {
+  knn_search(index, lat, lon, k, type_filter, query, out, stats);
+  return out->count;
+}
 
-  int type_match =
-      (strcmp(type, "all") == 0) || (strcasecmp(node->data.type, type) == 0);
-  int query_match = 1;
-  if (query && strcmp(query, "NULL_QUERY") != 0 && strlen(query) > 0) {
-    query_match = (my_strcasestr(node->data.name, query) != NULL) ||
-                  (my_strcasestr(node->data.type, query) != NULL);
+// Interleaves the top 16 bits of the normalised lat and lon so that queries
+// close on the map get close sort keys (Z-order)
+static uint32_t morton_key(double lat, double lon) {
+  double y = (lat + 90.0) / 180.0, x = (lon + 180.0) / 360.0;
+  uint32_t qy = (uint32_t)(fmin(fmax(y, 0.0), 1.0) * 65535.0);
+  uint32_t qx = (uint32_t)(fmin(fmax(x, 0.0), 1.0) * 65535.0);
+  uint32_t key = 0;
+  for (int b = 0; b < 16; b++) {
+    key |= ((qx >> b) & 1u) << (2 * b);
+    key |= ((qy >> b) & 1u) << (2 * b + 1);
   }
+  return key;
+}
 
-  double dist = haversine_km(t_lat, t_lon, node->data.lat, node->data.lon);
+typedef struct {
+  const KdQuery *q;
+  uint32_t key;
+  int i;
+} BatchItem;
+
+static int cmp_opt_str(const char *a, const char *b) {
+  if (a == b)
+    return 0;
+  if (!a || !b)
+    return a ? 1 : -1;
+  return strcmp(a, b);
+}
+
+// Groups queries sharing a filter so it is resolved once per group, then
+// orders each group along the Z-curve so consecutive traversals touch the
+// same nodes
+static int cmp_batch_item(const void *pa, const void *pb) {
+  const BatchItem *a = (const BatchItem *)pa, *b = (const BatchItem *)pb;
+  int c = cmp_opt_str(a->q->type_filter, b->q->type_filter);
+  if (c == 0)
+    c = cmp_opt_str(a->q->query, b->q->query);
+  if (c == 0)
+    c = (a->key > b->key) - (a->key < b->key);
+  return c != 0 ? c : a->i - b->i;
+}
 
-  if (type_match && query_match) {
-    bpq_insert(q, node->data, dist);
+// Runs n queries in one pass. The results of queries[i] are written to
+// out->items / out->dists [offsets[i], offsets[i + 1]), in input order;
+// offsets must hold n + 1 entries. Returns the total result count.
+int kd_batch(const KdIndex *index, const KdQuery *queries, int n,
+             ResultSet *out, int *offsets, KdStats *stats) {
+  offsets[0] = 0;
+  if (n <= 0)
+    return 0;
+
+  BatchItem *order = (BatchItem *)malloc(n * sizeof(BatchItem));
+  for (int i = 0; i < n; i++) {
+    order[i].q = &queries[i];
+    order[i].key = morton_key(queries[i].lat, queries[i].lon);
+    order[i].i = i;
   }
+  qsort(order, n, sizeof(BatchItem), cmp_batch_item);
 
-  int axis = depth % 2;
-  double diff = 0;
-  if (axis == 0) {
-    diff = (t_lat - node->data.lat) * 111.0;
-  } else {
-    diff = (t_lon - node->data.lon) * 111.0 * cos(to_rad(t_lat));
+  // Results are collected in execution order, then laid out in input order
+  ResultSet run = {0};
+  int *start = (int *)malloc(n * sizeof(int));
+  SearchCtx ctx;
+  const KdQuery *resolved = NULL;
+  for (int j = 0; j < n; j++) {
+    const KdQuery *q = order[j].q;
+    if (!resolved || cmp_opt_str(q->type_filter, resolved->type_filter) != 0 ||
+        cmp_opt_str(q->query, resolved->query) != 0) {
+      if (resolved)
+        free_ctx(&ctx);
+      init_ctx(&ctx, index, q->lat, q->lon, q->type_filter, q->query, stats);
+      resolved = q;
+    } else {
+      set_origin(&ctx, q->lat, q->lon);
+    }
+
+    start[order[j].i] = run.count;
+    if (index->node_count == 0)
+      continue;
+    if (q->mode == KD_MODE_KNN)
+      knn_run(&ctx, (int)q->val, &run);
+    else
+      range_recursive(&ctx, 0, q->val, &run);
+  }
+  if (resolved)
+    free_ctx(&ctx);
+
+  // Result counts per input query follow from the execution-order starts
+  int *len = (int *)malloc(n * sizeof(int));
+  for (int j = 0; j < n; j++) {
+    int i = order[j].i;
+    int end = j + 1 < n ? start[order[j + 1].i] : run.count;
+    len[i] = end - start[i];
+  }
+
+  for (int i = 0; i < n; i++)
+    offsets[i + 1] = offsets[i] + len[i];
+  for (int i = 0; i < n; i++) {
+    for (int r = 0; r < len[i]; r++)
+      result_push(out, run.items[start[i] + r], run.dists[start[i] + r]);
   }
 
-  Node *near = (diff <= 0) ? node->left : node->right;
-  Node *far = (diff <= 0) ? node->right : node->left;
+  kd_results_free(&run);
+  free(len);
+  free(start);
+  free(order);
+  return out->count;
+}
 
-  knn_recursive(near, t_lat, t_lon, q, type, query, depth + 1);
+// kd_batch over columns of points that share one mode, value and filter,
+// e.g. straight from NumPy arrays
+int kd_batch_points(const KdIndex *index, const double *lat,
+                    const double *lon, int n, int mode, double val,
+                    const char *type_filter, const char *query,
+                    ResultSet *out, int *offsets, KdStats *stats) {
+  offsets[0] = 0;
+  if (n <= 0)
+    return 0;
 
-  if (fabs(diff) < current_max_dist(q)) {
-    knn_recursive(far, t_lat, t_lon, q, type, query, depth + 1);
+  KdQuery *queries = (KdQuery *)malloc(n * sizeof(KdQuery));
+  for (int i = 0; i < n; i++) {
+    queries[i].lat = lat[i];
+    queries[i].lon = lon[i];
+    queries[i].val = val;
+    queries[i].mode = mode;
+    queries[i].type_filter = type_filter;
+    queries[i].query = query;
   }
+  int total = kd_batch(index, queries, n, out, offsets, stats);
+  free(queries);
+  return total;
+}
+
+// Reentrant searches into caller-owned buffers. Nothing is allocated for
+// the results and the index is only read, so any number of threads may
+// search one index at once. Up to capacity results are written as tree
+// positions (for kd_fetch) with their distances, nearest first for knn. The
+// return value is the total number of matches; when it exceeds capacity the
+// caller can retry with larger buffers.
+int kd_range_into(const KdIndex *index, double lat, double lon,
+                  double radius_km, const char *type_filter, const char *query,
+                  int *positions, double *dists, int capacity,
+                  KdStats *stats) {
+  ResultSet out = {positions, dists, 0, capacity, 0, 1};
+  range_search(index, lat, lon, radius_km, type_filter, query, &out, stats);
+  return out.total;
 }
 
-void knn_search(Node *root, double lat, double lon, int k,
-                const char *type_filter, const char *query) {
-  Bpq q;
-  q.k = k;
-  q.count = 0;
-  q.items = (BpqItem *)malloc(sizeof(BpqItem) * k);
+int kd_knn_into(const KdIndex *index, double lat, double lon, int k,
+                const char *type_filter, const char *query, int *positions,
+                double *dists, int capacity, KdStats *stats) {
+  ResultSet out = {positions, dists, 0, capacity, 0, 1};
+  knn_search(index, lat, lon, k, type_filter, query, &out, stats);
+  return out.total;
+}
 
-  knn_recursive(root, lat, lon, &q, type_filter, query, 0);
+// kNN straight into caller buffers of k entries, nearest first with ties
+// broken by POI id; epsilon and max_nodes trade exactness for speed as in
+// knn_best_first (0 for both is exact). Returns the number written.
+int kd_knn_sorted(const KdIndex *index, double lat, double lon, int k,
+                  const char *type_filter, const char *query, double epsilon,
+                  int max_nodes, int *positions, double *dists,
+                  KdStats *stats) {
+  if (k <= 0 || index->node_count == 0)
+    return 0;
 
-  first_result = 1;
-  printf("[\n");
-  for (int i = 0; i < q.count; i++) {
-    if (!first_result)
-      printf(",\n");
-    print_poi_json(q.items[i].poi, 1);
-    first_result = 0;
-  }
-  printf("\n]\n");
-  free(q.items);
-}
\ No newline at end of file
+  SearchCtx ctx;
+  init_ctx(&ctx, index, lat, lon, type_filter, query, stats);
+  int n = knn_best_first(&ctx, k, epsilon, max_nodes, positions, dists);
+  free_ctx(&ctx);
+  return n;
+}
+
+void kd_fetch(const KdIndex *index, const int *positions, int n, int *ids,
+              double *lat, double *lon, const char **names,
+              const char **types) {
+  // Any column may be NULL when the caller does not need it
+  for (int i = 0; i < n; i++) {
+    int pos = positions[i];
+    if (ids)
+      ids[i] = index->ids[pos];
+    if (lat)
+      lat[i] = index->lat[pos];
+    if (lon)
+      lon[i] = index->lon[pos];
+    if (names)
+      names[i] = poi_name(index, pos);
+    if (types)
+      types[i] = poi_type(index, pos);
+  }
+}
+
+void kd_results_free(ResultSet *results) {
+  if (!results->fixed) {
+    free(results->items);
+    free(results->dists);
+    results->items = NULL;
+    results->dists = NULL;
+    results->capacity = 0;
+  }
+  results->count = 0;
+  results->total = 0;
+}
+
+void kd_close(KdIndex *index) {
+  if (!index)
+    return;
+  if (index->map_base) {
+    unmap_snapshot(index->map_base, index->map_len);
+    free(index);
+    return;
+  }
+  free(index->nodes);
+  free(index->lat);
+  free(index->lon);
+  free(index->coslat);
+  free(index->ids);
+  free(index->name_off);
+  free(index->cat);
+  free(index->cat_name_off);
+  free(index->cat_hash);
+  free(index->tri_keys);
+  free(index->tri_start);
+  free(index->tri_postings);
+  free(index->strings);
+  free(index);
+}
@@ -2,37 +2,193 @@
 #define KDTREE_H
 
 #include <math.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 
+#include "geo.h"
+
 #define MAX_NAME_LEN 256
 #define MAX_TYPE_LEN 100
 #define MAX_LINE_LEN 1024
+#define KD_LEAF_SIZE 8
+#define KD_MAX_CATEGORIES 65535
+#define KD_MAX_TYPE_FILTERS 32
+
+// Category ids fold onto the 64 bits of a node's cat_mask. Distinct
+// categories may share a bit, which only makes pruning less tight.
+#define KD_CAT_BIT(cat) (1ULL << ((cat) & 63))
 
-// POI Structure
+// Tree node covering the points at tree positions [lo, hi). Internal nodes
+// split that range at its median into two children; leaves (left == -1)
+// hold at most KD_LEAF_SIZE points. cos_lo is the smallest cos(lat) inside
+// the bounding box, used to keep planar pruning bounds conservative, and
+// cat_mask has KD_CAT_BIT set for every category present in the subtree.
+// sum_lat / sum_lon add up the subtree's coordinates, so a whole subtree of
+// hi - lo points can be folded into a map cluster without visiting them.
 typedef struct {
-  int id;
-  char name[MAX_NAME_LEN];
-  char type[MAX_TYPE_LEN];
-  double lat;
-  double lon;
-} POI;
-
-// KD-Tree Node
-typedef struct Node {
-  POI data;
-  struct Node *left;
-  struct Node *right;
-} Node;
+  double min_lat, max_lat;
+  double min_lon, max_lon;
+  double cos_lo;
+  double sum_lat, sum_lon;
+  uint64_t cat_mask;
+  int lo, hi;
+  int left, right;
+} KdNode;
+
+// Flat KD-tree. Points are stored in tree order as parallel arrays so that
+// every node's points are contiguous, and nodes live in one array with
+// children referenced by index (node 0 is the root). Types are interned
+// into integer category ids at load time. Names and category names live in
+// one string table and are referenced by byte offset.
+typedef struct {
+  int count;
+  int capacity;
+  KdNode *nodes;
+  int node_count;
+  int node_capacity;
+  double *lat;
+  double *lon;
+  double *coslat;
+  int *ids;
+  uint32_t *name_off;
+  uint16_t *cat;
+  char *strings;
+  size_t strings_len;
+  size_t strings_cap;
+  uint32_t *cat_name_off;
+  int cat_count;
+  int cat_capacity;
+  int *cat_hash;
+  int cat_hash_size;
+  int tri_count;
+  uint32_t *tri_keys;
+  uint32_t *tri_start;
+  int *tri_postings;
+  void *map_base; // non-NULL when the arrays live in a mapped snapshot
+  size_t map_len;
+} KdIndex;
+
+// Search results as tree positions, owned by the caller and released with
+// kd_results_free. A fixed set writes into caller buffers and never grows:
+// results past capacity are dropped but still counted in total.
+typedef struct {
+  int *items;
+  double *dists;
+  int count;
+  int capacity;
+  int total;
+  int fixed;
+} ResultSet;
+
+// Per-query work counters, so pruning changes can be measured
+typedef struct {
+  int64_t nodes_visited;
+  int64_t distance_evals;
+} KdStats;
+
+#define KD_MODE_RADIUS 0
+#define KD_MODE_KNN 1
+
+// One query of a batch; val is the radius in km or k
+typedef struct {
+  double lat, lon;
+  double val;
+  int mode;
+  const char *type_filter;
+  const char *query;
+} KdQuery;
+
+// Area for kd_region / kd_clusters: a latitude/longitude box, optionally
+// narrowed to a simple polygon given by poly_n vertices (poly_n < 3 = the
+// box alone). The box should enclose the polygon.
+typedef struct {
+  double min_lat, max_lat;
+  double min_lon, max_lon;
+  const double *poly_lat;
+  const double *poly_lon;
+  int poly_n;
+} KdRegion;
+
+static inline const char *poi_name(const KdIndex *index, int pos) {
+  return index->strings + index->name_off[pos];
+}
+
+static inline const char *poi_type(const KdIndex *index, int pos) {
+  return index->strings + index->cat_name_off[index->cat[pos]];
+}
 
 // Prototypes
-Node *build_kdtree(POI *points, int n, int depth);
-void range_search(Node *root, double lat, double lon, double radius_km,
-                  const char *type_filter, const char *query);
-void knn_search(Node *root, double lat, double lon, int k,
-                const char *type_filter, const char *query);
-void load_pois(const char *filename, POI **points, int *count);
-void free_tree(Node *root);
+void build_kdtree(KdIndex *index);
+void range_search(const KdIndex *index, double lat, double lon,
+                  double radius_km, const char *type_filter, const char *query,
+                  ResultSet *out, KdStats *stats);
+void knn_search(const KdIndex *index, double lat, double lon, int k,
+                const char *type_filter, const char *query, ResultSet *out,
+                KdStats *stats);
+int load_pois(const char *filename, KdIndex *index);
+int kd_category(const KdIndex *index, const char *name);
+void build_text_index(KdIndex *index);
+int text_candidates(const KdIndex *index, const char *query, int **out);
+int lower_bound_int(const int *a, int n, int value);
+void print_results_json(const KdIndex *index, const ResultSet *results);
+
+// Shared library entry points
+KdIndex *kd_load(const char *poi_file, const char *campus_file);
+KdIndex *kd_open(const char *poi_file, const char *campus_file);
+KdIndex *kd_build(int n, const int *ids, const double *lat, const double *lon,
+                  const char **names, const char **types);
+KdIndex *kd_create(void);
+int kd_append(KdIndex *index, int n, const int *ids, const double *lat,
+              const double *lon, const char **names, const char **types);
+int kd_dedup(KdIndex *index, double radius_km);
+int kd_size(const KdIndex *index);
+int kd_find_id(const KdIndex *index, int id);
+int kd_range(const KdIndex *index, double lat, double lon, double radius_km,
+             const char *type_filter, const char *query, ResultSet *out,
+             KdStats *stats);
+int kd_knn(const KdIndex *index, double lat, double lon, int k,
+           const char *type_filter, const char *query, ResultSet *out,
+           KdStats *stats);
+int kd_batch(const KdIndex *index, const KdQuery *queries, int n,
+             ResultSet *out, int *offsets, KdStats *stats);
+int kd_batch_points(const KdIndex *index, const double *lat,
+                    const double *lon, int n, int mode, double val,
+                    const char *type_filter, const char *query,
+                    ResultSet *out, int *offsets, KdStats *stats);
+int kd_range_into(const KdIndex *index, double lat, double lon,
+                  double radius_km, const char *type_filter, const char *query,
+                  int *positions, double *dists, int capacity,
+                  KdStats *stats);
+int kd_knn_into(const KdIndex *index, double lat, double lon, int k,
+                const char *type_filter, const char *query, int *positions,
+                double *dists, int capacity, KdStats *stats);
+int kd_range_sorted(const KdIndex *index, double lat, double lon,
+                    double radius_km, const char *type_filter,
+                    const char *query, int limit, double after_dist,
+                    int after_id, int *positions, double *dists,
+                    KdStats *stats);
+int kd_knn_sorted(const KdIndex *index, double lat, double lon, int k,
+                  const char *type_filter, const char *query, double epsilon,
+                  int max_nodes, int *positions, double *dists,
+                  KdStats *stats);
+int kd_region(const KdIndex *index, const KdRegion *region,
+              const char *type_filter, const char *query, int *positions,
+              int capacity, KdStats *stats);
+int kd_clusters(const KdIndex *index, const KdRegion *region,
+                double cell_deg, const char *type_filter, const char *query,
+                double *lat, double *lon, int *counts, int *samples,
+                int capacity, KdStats *stats);
+void kd_fetch(const KdIndex *index, const int *positions, int n, int *ids,
+              double *lat, double *lon, const char **names,
+              const char **types);
+void kd_results_free(ResultSet *results);
+void kd_close(KdIndex *index);
+
+// Binary snapshots (snapshot.c)
+int kd_save_snapshot(const KdIndex *index, const char *path);
+KdIndex *kd_open_snapshot(const char *path);
+void unmap_snapshot(void *base, size_t len);
 
 #endif
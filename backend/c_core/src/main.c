@@ -1,10 +1,239 @@
 #include "kdtree.h"
 
+#include <limits.h>
+#include <stdint.h>
+#include <sys/stat.h>
+
+#ifdef _WIN32
+#include <fcntl.h>
+#include <io.h>
+#endif
+
+// Server mode protocol. Every message is a uint32 payload length followed by
+// the payload, all integers and doubles in host byte order.
+//
+// Request:  uint8 mode (0 = radius, 1 = knn), double lat, double lon,
+//           double radius_or_k, uint16 type_len, uint16 query_len,
+//           type bytes, query bytes (query_len 0 means no text filter)
+// Response: int32 count (-1 for a malformed request), then per result:
+//           int32 id, double lat, double lon, double dist_km,
+//           uint16 name_len, name bytes, uint16 type_len, type bytes
+#define REQ_HEADER_LEN 29
+#define MODE_RADIUS 0
+#define MODE_KNN 1
+
+typedef struct {
+  char *data;
+  size_t len;
+  size_t cap;
+} Buffer;
+
+static void buf_put(Buffer *b, const void *src, size_t n) {
+  if (b->len + n > b->cap) {
+    size_t cap = b->cap ? b->cap : 4096;
+    while (cap < b->len + n)
+      cap *= 2;
+    b->data = realloc(b->data, cap);
+    b->cap = cap;
+  }
+  memcpy(b->data + b->len, src, n);
+  b->len += n;
+}
+
+static void buf_put_str(Buffer *b, const char *s) {
+  uint16_t n = (uint16_t)strlen(s);
+  buf_put(b, &n, sizeof(n));
+  buf_put(b, s, n);
+}
+
+static int read_full(void *dst, size_t n) {
+  return fread(dst, 1, n, stdin) == n;
+}
+
+// k arrives as a double; anything outside int range cannot be cast
+static int valid_k(double val) { return val >= 1 && val <= INT_MAX; }
+
+static int handle_request(const KdIndex *index, const char *req, uint32_t len,
+                          Buffer *out) {
+  uint8_t mode;
+  double lat, lon, val;
+  uint16_t type_len, query_len;
+  char type[MAX_LINE_LEN];
+  char query[MAX_NAME_LEN];
+
+  if (len < REQ_HEADER_LEN)
+    return -1;
+  memcpy(&mode, req, 1);
+  memcpy(&lat, req + 1, 8);
+  memcpy(&lon, req + 9, 8);
+  memcpy(&val, req + 17, 8);
+  memcpy(&type_len, req + 25, 2);
+  memcpy(&query_len, req + 27, 2);
+  if (type_len >= MAX_LINE_LEN || query_len >= MAX_NAME_LEN ||
+      (uint32_t)(REQ_HEADER_LEN + type_len + query_len) != len)
+    return -1;
+  memcpy(type, req + REQ_HEADER_LEN, type_len);
+  type[type_len] = '\0';
+  memcpy(query, req + REQ_HEADER_LEN + type_len, query_len);
+  query[query_len] = '\0';
+
+  ResultSet results = {0};
+  const char *q = query_len ? query : NULL;
+  if (mode == MODE_KNN) {
+    if (!valid_k(val))
+      return -1;
+    kd_knn(index, lat, lon, (int)val, type, q, &results, NULL);
+  } else if (mode == MODE_RADIUS) {
+    kd_range(index, lat, lon, val, type, q, &results, NULL);
+  } else {
+    return -1;
+  }
+
+  int32_t count = results.count;
+  buf_put(out, &count, sizeof(count));
+  for (int i = 0; i < results.count; i++) {
+    int pos = results.items[i];
+    int32_t id = index->ids[pos];
+    buf_put(out, &id, sizeof(id));
+    buf_put(out, &index->lat[pos], sizeof(double));
+    buf_put(out, &index->lon[pos], sizeof(double));
+    buf_put(out, &results.dists[i], sizeof(double));
+    buf_put_str(out, poi_name(index, pos));
+    buf_put_str(out, poi_type(index, pos));
+  }
+  kd_results_free(&results);
+  return 0;
+}
+
+static int serve(const KdIndex *index) {
+  char *req = NULL;
+  uint32_t req_cap = 0;
+  Buffer out = {0};
+  uint32_t len;
+
+#ifdef _WIN32
+  _setmode(_fileno(stdin), _O_BINARY);
+  _setmode(_fileno(stdout), _O_BINARY);
+#endif
+
+  while (read_full(&len, sizeof(len))) {
+    if (len > req_cap) {
+      req = realloc(req, len);
+      req_cap = len;
+    }
+    if (len && !read_full(req, len))
+      break;
+
+    out.len = 0;
+    buf_put(&out, &len, sizeof(len)); // placeholder for the payload length
+    if (handle_request(index, req, len, &out) != 0) {
+      int32_t bad = -1;
+      out.len = sizeof(len);
+      buf_put(&out, &bad, sizeof(bad));
+    }
+    uint32_t payload_len = (uint32_t)(out.len - sizeof(len));
+    memcpy(out.data, &payload_len, sizeof(payload_len));
+
+    if (fwrite(out.data, 1, out.len, stdout) != out.len || fflush(stdout))
+      break;
+  }
+
+  free(req);
+  free(out.data);
+  return 0;
+}
+
+// A file in KDTREE_DATA_DIR, by default ../data relative to src/
+static const char *data_path(char *buf, size_t size, const char *name) {
+  const char *dir = getenv("KDTREE_DATA_DIR");
+  snprintf(buf, size, "%s/%s", dir && *dir ? dir : "../data", name);
+  return buf;
+}
+
+static int ends_with(const char *s, const char *suffix) {
+  size_t n = strlen(s), m = strlen(suffix);
+  return n >= m && strcmp(s + n - m, suffix) == 0;
+}
+
+// The snapshot, if it exists and is newer than both CSVs; else the CSV path
+static const char *prefer_snapshot(const char *snapshot, const char *datafile,
+                                   const char *campus_file) {
+  struct stat snap, src;
+  if (stat(snapshot, &snap) != 0)
+    return datafile;
+  if ((stat(datafile, &src) == 0 && src.st_mtime > snap.st_mtime) ||
+      (stat(campus_file, &src) == 0 && src.st_mtime > snap.st_mtime)) {
+    fprintf(stderr, "Snapshot %s is out of date, loading CSV data\n",
+            snapshot);
+    return datafile;
+  }
+  return snapshot;
+}
+
+// A .kdb data file is a compiled snapshot; anything else is POI CSV. A
+// snapshot that cannot be opened (e.g. written by an older build) falls back
+// to the fallback CSV when there is one.
+static KdIndex *open_index(const char *datafile, const char *campus_file,
+                           const char *fallback) {
+  if (ends_with(datafile, ".kdb")) {
+    KdIndex *index = kd_open_snapshot(datafile);
+    if (!index && fallback)
+      return kd_open(fallback, campus_file);
+    return index;
+  }
+  return kd_open(datafile, campus_file);
+}
+
 int main(int argc, char *argv[]) {
+  char poi_buf[4096], campus_buf[4096], snapshot_buf[4096];
+  const char *datafile = data_path(poi_buf, sizeof(poi_buf), "pois.csv");
+  const char *campus_file =
+      data_path(campus_buf, sizeof(campus_buf), "rv_university_campus.csv");
+  const char *snapshot = getenv("KDTREE_SNAPSHOT");
+  if (!snapshot || !*snapshot)
+    snapshot = data_path(snapshot_buf, sizeof(snapshot_buf), "pois.kdb");
+
+  if (argc >= 3 && strcmp(argv[1], "--compile") == 0) {
+    if (argc >= 4)
+      datafile = argv[3];
+    if (argc >= 5)
+      campus_file = argv[4];
+
+    KdIndex *index = kd_open(datafile, campus_file);
+    if (!index)
+      return 1;
+    int rc = kd_save_snapshot(index, argv[2]);
+    if (rc == 0)
+      fprintf(stderr, "Compiled %d POIs into %s\n", index->count, argv[2]);
+    kd_close(index);
+    return rc == 0 ? 0 : 1;
+  }
+
+  const char *fallback = datafile;
+  datafile = prefer_snapshot(snapshot, datafile, campus_file);
+
+  if (argc >= 2 && strcmp(argv[1], "--serve") == 0) {
+    if (argc >= 3) {
+      datafile = argv[2];
+      fallback = NULL;
+    }
+    if (argc >= 4)
+      campus_file = argv[3];
+
+    KdIndex *index = open_index(datafile, campus_file, fallback);
+    if (!index)
+      return 1;
+    int rc = serve(index);
+    kd_close(index);
+    return rc;
+  }
+
   if (argc < 5 || argc > 7) {
     fprintf(stderr,
-            "Usage: %s <lat> <lon> <type> <radius_or_k> [query] [mode]\n",
-            argv[0]);
+            "Usage: %s <lat> <lon> <type> <radius_or_k> [query] [mode]\n"
+            "       %s --serve [pois.csv|pois.kdb] [campus.csv]\n"
+            "       %s --compile <out.kdb> [pois.csv] [campus.csv]\n",
+            argv[0], argv[0], argv[0]);
     return 1;
   }
 
@@ -23,52 +252,32 @@ int main(int argc, char *argv[]) {
     mode = argv[6];
   }
 
-  POI *points = NULL;
-  int n = 0;
-
-  const char *datafile = "../data/pois.csv";
-  FILE *f = fopen(datafile, "r");
-  if (!f) {
-    datafile = "c:/Users/HP/dsaelantigrav/backend/c_core/data/pois.csv";
-  } else {
-    fclose(f);
-  }
-  load_pois(datafile, &points, &n);
-
-  POI *campus_points = NULL;
-  int campus_n = 0;
-  const char *campus_file = "../data/rv_university_campus.csv";
-  f = fopen(campus_file, "r");
-  if (!f) {
-    campus_file = "c:/Users/HP/dsaelantigrav/backend/c_core/data/"
-                  "rv_university_campus.csv";
-  } else {
-    fclose(f);
-  }
-
-  f = fopen(campus_file, "r");
-  if (f) {
-    fclose(f);
-    load_pois(campus_file, &campus_points, &campus_n);
-
-    if (campus_n > 0) {
-      points = realloc(points, (n + campus_n) * sizeof(POI));
-      memcpy(points + n, campus_points, campus_n * sizeof(POI));
-      n += campus_n;
-      free(campus_points);
-    }
+  int knn = strcmp(mode, "knn") == 0;
+  if (knn && !valid_k(val)) {
+    fprintf(stderr, "k must be between 1 and %d\n", INT_MAX);
+    return 1;
   }
 
-  Node *root = build_kdtree(points, n, 0);
+  KdIndex *index = open_index(datafile, campus_file, fallback);
+  if (!index)
+    return 1;
 
-  if (strcmp(mode, "knn") == 0) {
-    knn_search(root, target_lat, target_lon, (int)val, type, query);
+  ResultSet results = {0};
+  KdStats stats = {0};
+  if (knn) {
+    kd_knn(index, target_lat, target_lon, (int)val, type, query, &results,
+           &stats);
   } else {
-    range_search(root, target_lat, target_lon, val, type, query);
+    kd_range(index, target_lat, target_lon, val, type, query, &results,
+             &stats);
   }
+  print_results_json(index, &results);
+  if (getenv("KDTREE_STATS"))
+    fprintf(stderr, "nodes_visited=%lld distance_evals=%lld\n",
+            (long long)stats.nodes_visited, (long long)stats.distance_evals);
 
-  free_tree(root);
-  free(points);
+  kd_results_free(&results);
+  kd_close(index);
 
   return 0;
 }
@@ -0,0 +1,300 @@
+#include "kdtree.h"
+
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
+
+// Binary snapshot of a built index. The file is a fixed header followed by
+// the index arrays exactly as they sit in memory, each section 8-byte
+// aligned, so opening it is a single read-only mmap with no parsing. Byte
+// order and struct layout are those of the machine that compiled it; the
+// header records enough to reject a file from a different layout.
+#define SNAPSHOT_MAGIC "KDSNAP\0\0"
+#define SNAPSHOT_VERSION 2
+#define SNAPSHOT_ENDIAN 0x01020304u
+
+enum {
+  SEC_NODES,
+  SEC_LAT,
+  SEC_LON,
+  SEC_COSLAT,
+  SEC_IDS,
+  SEC_NAME_OFF,
+  SEC_CAT,
+  SEC_CAT_NAME_OFF,
+  SEC_STRINGS,
+  SEC_TRI_KEYS,
+  SEC_TRI_START,
+  SEC_TRI_POSTINGS,
+  SEC_COUNT
+};
+
+typedef struct {
+  char magic[8];
+  uint32_t version;
+  uint32_t endian;
+  uint32_t node_size;
+  int32_t count;
+  int32_t node_count;
+  int32_t cat_count;
+  int32_t tri_count;
+  int32_t reserved;
+  uint64_t strings_len;
+  uint64_t offset[SEC_COUNT];
+  uint64_t length[SEC_COUNT];
+} SnapshotHeader;
+
+static uint64_t align8(uint64_t n) { return (n + 7) & ~(uint64_t)7; }
+
+int kd_save_snapshot(const KdIndex *index, const char *path) {
+  const void *data[SEC_COUNT] = {
+      index->nodes,    index->lat,          index->lon,
+      index->coslat,   index->ids,          index->name_off,
+      index->cat,      index->cat_name_off, index->strings,
+      index->tri_keys, index->tri_start,    index->tri_postings,
+  };
+  uint64_t n = (uint64_t)index->count;
+  uint64_t length[SEC_COUNT] = {
+      (uint64_t)index->node_count * sizeof(KdNode),
+      n * sizeof(double),
+      n * sizeof(double),
+      n * sizeof(double),
+      n * sizeof(int),
+      n * sizeof(uint32_t),
+      n * sizeof(uint16_t),
+      (uint64_t)index->cat_count * sizeof(uint32_t),
+      index->strings_len,
+      (uint64_t)index->tri_count * sizeof(uint32_t),
+      (uint64_t)(index->tri_count + 1) * sizeof(uint32_t),
+      (index->tri_start ? index->tri_start[index->tri_count] : 0) *
+          (uint64_t)sizeof(int),
+  };
+
+  SnapshotHeader header;
+  memset(&header, 0, sizeof(header));
+  memcpy(header.magic, SNAPSHOT_MAGIC, 8);
+  header.version = SNAPSHOT_VERSION;
+  header.endian = SNAPSHOT_ENDIAN;
+  header.node_size = sizeof(KdNode);
+  header.count = index->count;
+  header.node_count = index->node_count;
+  header.cat_count = index->cat_count;
+  header.tri_count = index->tri_count;
+  header.strings_len = index->strings_len;
+
+  uint64_t off = align8(sizeof(header));
+  for (int s = 0; s < SEC_COUNT; s++) {
+    if (!data[s])
+      length[s] = 0;
+    header.offset[s] = off;
+    header.length[s] = length[s];
+    off = align8(off + length[s]);
+  }
+
+  FILE *f = fopen(path, "wb");
+  if (!f) {
+    fprintf(stderr, "Error opening file %s\n", path);
+    return -1;
+  }
+  static const char zeros[8] = {0};
+  int ok = fwrite(&header, sizeof(header), 1, f) == 1;
+  uint64_t written = sizeof(header);
+  for (int s = 0; s < SEC_COUNT && ok; s++) {
+    ok = fwrite(zeros, 1, header.offset[s] - written, f) ==
+         header.offset[s] - written;
+    if (ok && length[s])
+      ok = fwrite(data[s], 1, length[s], f) == length[s];
+    written = header.offset[s] + length[s];
+  }
+  if (fclose(f) != 0)
+    ok = 0;
+  if (!ok) {
+    fprintf(stderr, "Error writing snapshot %s\n", path);
+    return -1;
+  }
+  return 0;
+}
+
+static void *map_file(const char *path, size_t *len) {
+#ifdef _WIN32
+  HANDLE file = CreateFileA(path, GENERIC_READ, FILE_SHARE_READ, NULL,
+                            OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, NULL);
+  if (file == INVALID_HANDLE_VALUE)
+    return NULL;
+  LARGE_INTEGER size;
+  GetFileSizeEx(file, &size);
+  HANDLE mapping = CreateFileMappingA(file, NULL, PAGE_READONLY, 0, 0, NULL);
+  CloseHandle(file);
+  if (!mapping)
+    return NULL;
+  void *base = MapViewOfFile(mapping, FILE_MAP_READ, 0, 0, 0);
+  CloseHandle(mapping);
+  *len = (size_t)size.QuadPart;
+  return base;
+#else
+  int fd = open(path, O_RDONLY);
+  if (fd < 0)
+    return NULL;
+  struct stat st;
+  if (fstat(fd, &st) != 0 || st.st_size == 0) {
+    close(fd);
+    return NULL;
+  }
+  void *base = mmap(NULL, (size_t)st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+  close(fd);
+  if (base == MAP_FAILED)
+    return NULL;
+  *len = (size_t)st.st_size;
+  return base;
+#endif
+}
+
+void unmap_snapshot(void *base, size_t len) {
+#ifdef _WIN32
+  (void)len;
+  UnmapViewOfFile(base);
+#else
+  munmap(base, len);
+#endif
+}
+
+// Every section must have exactly the size its counts imply, and every
+// stored offset and child index must point inside its array, so that a
+// truncated or corrupt file is refused instead of read out of bounds.
+static int snapshot_valid(const SnapshotHeader *h, const char *base,
+                          size_t len) {
+  if (h->count < 0 || h->node_count < 0 || h->cat_count < 0 ||
+      h->tri_count < 0)
+    return 0;
+  uint64_t n = (uint64_t)h->count;
+  uint64_t tri = (uint64_t)h->tri_count;
+  uint64_t want[SEC_COUNT] = {
+      (uint64_t)h->node_count * sizeof(KdNode),
+      n * sizeof(double),
+      n * sizeof(double),
+      n * sizeof(double),
+      n * sizeof(int),
+      n * sizeof(uint32_t),
+      n * sizeof(uint16_t),
+      (uint64_t)h->cat_count * sizeof(uint32_t),
+      h->strings_len,
+      tri * sizeof(uint32_t),
+      (tri + 1) * sizeof(uint32_t),
+      0,
+  };
+  // An index saved without a text index has no trigram sections at all
+  if (tri == 0 && h->length[SEC_TRI_START] == 0)
+    want[SEC_TRI_START] = 0;
+  for (int s = 0; s < SEC_COUNT; s++) {
+    if (h->offset[s] % 8 != 0 || h->offset[s] > len ||
+        h->length[s] > len - h->offset[s])
+      return 0;
+    if (s != SEC_TRI_POSTINGS && h->length[s] != want[s])
+      return 0;
+  }
+
+  const char *strings = base + h->offset[SEC_STRINGS];
+  if (h->strings_len > 0 && strings[h->strings_len - 1] != '\0')
+    return 0;
+  const uint32_t *name_off = (const uint32_t *)(base + h->offset[SEC_NAME_OFF]);
+  const uint16_t *cat = (const uint16_t *)(base + h->offset[SEC_CAT]);
+  for (uint64_t i = 0; i < n; i++)
+    if (name_off[i] >= h->strings_len || cat[i] >= (uint64_t)h->cat_count)
+      return 0;
+  const uint32_t *cat_name_off =
+      (const uint32_t *)(base + h->offset[SEC_CAT_NAME_OFF]);
+  for (int i = 0; i < h->cat_count; i++)
+    if (cat_name_off[i] >= h->strings_len)
+      return 0;
+
+  // Children come after their parent, so checked indexes cannot loop
+  const KdNode *nodes = (const KdNode *)(base + h->offset[SEC_NODES]);
+  for (int i = 0; i < h->node_count; i++) {
+    const KdNode *node = &nodes[i];
+    if (node->lo < 0 || node->lo > node->hi || node->hi > h->count)
+      return 0;
+    if (node->left >= 0 &&
+        (node->left <= i || node->left >= h->node_count ||
+         node->right <= i || node->right >= h->node_count))
+      return 0;
+  }
+
+  uint64_t postings = 0;
+  const uint32_t *start = (const uint32_t *)(base + h->offset[SEC_TRI_START]);
+  if (h->length[SEC_TRI_START] > 0) {
+    for (uint64_t i = 0; i < tri; i++)
+      if (start[i] > start[i + 1])
+        return 0;
+    postings = start[tri];
+  }
+  if (h->length[SEC_TRI_POSTINGS] != postings * sizeof(int))
+    return 0;
+  const int *post = (const int *)(base + h->offset[SEC_TRI_POSTINGS]);
+  for (uint64_t i = 0; i < postings; i++)
+    if (post[i] < 0 || post[i] >= h->count)
+      return 0;
+  return 1;
+}
+
+// Opens a snapshot written by kd_save_snapshot. The returned index points
+// straight into the read-only mapping, so processes opening the same file
+// share one page-cache copy. It must not be loaded into or rebuilt.
+KdIndex *kd_open_snapshot(const char *path) {
+  size_t len = 0;
+  char *base = (char *)map_file(path, &len);
+  if (!base) {
+    fprintf(stderr, "Error opening snapshot %s\n", path);
+    return NULL;
+  }
+
+  SnapshotHeader header;
+  int ok = len >= sizeof(header);
+  if (ok) {
+    memcpy(&header, base, sizeof(header));
+    ok = memcmp(header.magic, SNAPSHOT_MAGIC, 8) == 0 &&
+         header.version == SNAPSHOT_VERSION &&
+         header.endian == SNAPSHOT_ENDIAN &&
+         header.node_size == sizeof(KdNode);
+  }
+  ok = ok && snapshot_valid(&header, base, len);
+  if (!ok) {
+    fprintf(stderr, "Invalid or incompatible snapshot %s\n", path);
+    unmap_snapshot(base, len);
+    return NULL;
+  }
+
+  KdIndex *index = (KdIndex *)calloc(1, sizeof(KdIndex));
+  index->map_base = base;
+  index->map_len = len;
+  index->count = header.count;
+  index->capacity = header.count;
+  index->node_count = header.node_count;
+  index->node_capacity = header.node_count;
+  index->cat_count = header.cat_count;
+  index->cat_capacity = header.cat_count;
+  index->tri_count = header.tri_count;
+  index->strings_len = (size_t)header.strings_len;
+  index->strings_cap = (size_t)header.strings_len;
+
+#define SECTION(type, s) ((type *)(base + header.offset[s]))
+  index->nodes = SECTION(KdNode, SEC_NODES);
+  index->lat = SECTION(double, SEC_LAT);
+  index->lon = SECTION(double, SEC_LON);
+  index->coslat = SECTION(double, SEC_COSLAT);
+  index->ids = SECTION(int, SEC_IDS);
+  index->name_off = SECTION(uint32_t, SEC_NAME_OFF);
+  index->cat = SECTION(uint16_t, SEC_CAT);
+  index->cat_name_off = SECTION(uint32_t, SEC_CAT_NAME_OFF);
+  index->strings = SECTION(char, SEC_STRINGS);
+  index->tri_keys = SECTION(uint32_t, SEC_TRI_KEYS);
+  index->tri_start = SECTION(uint32_t, SEC_TRI_START);
+  index->tri_postings = SECTION(int, SEC_TRI_POSTINGS);
+#undef SECTION
+
+  return index;
+}
@@ -0,0 +1,185 @@
+#include "kdtree.h"
+
+#include <ctype.h>
+
+// Trigram inverted index over lowercased POI names. Keys are three bytes
+// packed into 24 bits, kept sorted in tri_keys; the postings of key i are
+// the tree positions tri_postings[tri_start[i] .. tri_start[i + 1]), in
+// ascending order. Category names are matched per category instead (see
+// kdtree.c), so they are not indexed here.
+
+static uint32_t trigram_at(const char *s) {
+  return ((uint32_t)(unsigned char)tolower((unsigned char)s[0]) << 16) |
+         ((uint32_t)(unsigned char)tolower((unsigned char)s[1]) << 8) |
+         (uint32_t)(unsigned char)tolower((unsigned char)s[2]);
+}
+
+static int cmp_u32(const void *a, const void *b) {
+  uint32_t x = *(const uint32_t *)a, y = *(const uint32_t *)b;
+  return (x > y) - (x < y);
+}
+
+// Distinct trigrams of s, sorted; returns how many were written to out
+static int distinct_trigrams(const char *s, uint32_t *out, int max) {
+  int len = (int)strlen(s);
+  int n = 0;
+  for (int i = 0; i + 3 <= len && n < max; i++)
+    out[n++] = trigram_at(s + i);
+  qsort(out, n, sizeof(uint32_t), cmp_u32);
+
+  int m = 0;
+  for (int i = 0; i < n; i++) {
+    if (m == 0 || out[m - 1] != out[i])
+      out[m++] = out[i];
+  }
+  return m;
+}
+
+// Stable LSD radix sort of (key << 32 | pos) pairs on the 24-bit key in two
+// 12-bit passes. Pairs arrive in ascending pos order, so the result is
+// ordered by key and then by position.
+static void radix_sort_pairs(uint64_t *pairs, uint64_t *tmp, size_t n) {
+  size_t *count = (size_t *)malloc(4097 * sizeof(size_t));
+  for (int shift = 32; shift <= 44; shift += 12) {
+    memset(count, 0, 4097 * sizeof(size_t));
+    for (size_t i = 0; i < n; i++)
+      count[((pairs[i] >> shift) & 0xFFF) + 1]++;
+    for (int d = 0; d < 4096; d++)
+      count[d + 1] += count[d];
+    for (size_t i = 0; i < n; i++)
+      tmp[count[(pairs[i] >> shift) & 0xFFF]++] = pairs[i];
+    memcpy(pairs, tmp, n * sizeof(uint64_t));
+  }
+  free(count);
+}
+
+void build_text_index(KdIndex *index) {
+  free(index->tri_keys);
+  free(index->tri_start);
+  free(index->tri_postings);
+  index->tri_keys = NULL;
+  index->tri_start = NULL;
+  index->tri_postings = NULL;
+  index->tri_count = 0;
+
+  size_t cap = (size_t)index->count * 16 + 16, n = 0;
+  uint64_t *pairs = (uint64_t *)malloc(cap * sizeof(uint64_t));
+  uint32_t grams[MAX_LINE_LEN];
+
+  for (int pos = 0; pos < index->count; pos++) {
+    int m = distinct_trigrams(poi_name(index, pos), grams, MAX_LINE_LEN);
+    if (n + m > cap) {
+      while (n + m > cap)
+        cap *= 2;
+      pairs = realloc(pairs, cap * sizeof(uint64_t));
+    }
+    for (int i = 0; i < m; i++)
+      pairs[n++] = ((uint64_t)grams[i] << 32) | (uint32_t)pos;
+  }
+
+  uint64_t *tmp = (uint64_t *)malloc((n ? n : 1) * sizeof(uint64_t));
+  radix_sort_pairs(pairs, tmp, n);
+  free(tmp);
+
+  int keys = 0;
+  for (size_t i = 0; i < n; i++) {
+    if (i == 0 || (pairs[i] >> 32) != (pairs[i - 1] >> 32))
+      keys++;
+  }
+
+  index->tri_keys = (uint32_t *)malloc((keys ? keys : 1) * sizeof(uint32_t));
+  index->tri_start = (uint32_t *)malloc((keys + 1) * sizeof(uint32_t));
+  index->tri_postings = (int *)malloc((n ? n : 1) * sizeof(int));
+  int k = -1;
+  for (size_t i = 0; i < n; i++) {
+    uint32_t key = (uint32_t)(pairs[i] >> 32);
+    if (k < 0 || index->tri_keys[k] != key) {
+      k++;
+      index->tri_keys[k] = key;
+      index->tri_start[k] = (uint32_t)i;
+    }
+    index->tri_postings[i] = (int)(uint32_t)pairs[i];
+  }
+  index->tri_start[keys] = (uint32_t)n;
+  index->tri_count = keys;
+  free(pairs);
+}
+
+static int find_trigram(const KdIndex *index, uint32_t key) {
+  int lo = 0, hi = index->tri_count - 1;
+  while (lo <= hi) {
+    int mid = lo + (hi - lo) / 2;
+    if (index->tri_keys[mid] < key)
+      lo = mid + 1;
+    else if (index->tri_keys[mid] > key)
+      hi = mid - 1;
+    else
+      return mid;
+  }
+  return -1;
+}
+
+// First element of the sorted array a[0..n) that is >= value
+int lower_bound_int(const int *a, int n, int value) {
+  int lo = 0, hi = n;
+  while (lo < hi) {
+    int mid = lo + (hi - lo) / 2;
+    if (a[mid] < value)
+      lo = mid + 1;
+    else
+      hi = mid;
+  }
+  return lo;
+}
+
+typedef struct {
+  const int *list;
+  int len;
+} Postings;
+
+static int cmp_postings(const void *a, const void *b) {
+  return ((const Postings *)a)->len - ((const Postings *)b)->len;
+}
+
+// Positions whose name may contain query: the intersection of the postings
+// of all of its trigrams, smallest list first. Every hit still has to be
+// confirmed with a substring check. Returns the number of candidates and
+// stores the sorted array in *out (caller frees), or -1 when the query is
+// shorter than a trigram and the index cannot help.
+int text_candidates(const KdIndex *index, const char *query, int **out) {
+  *out = NULL;
+  if (strlen(query) < 3)
+    return -1;
+
+  uint32_t grams[MAX_LINE_LEN];
+  int m = distinct_trigrams(query, grams, MAX_LINE_LEN);
+  Postings *lists = (Postings *)malloc(m * sizeof(Postings));
+  for (int i = 0; i < m; i++) {
+    int k = find_trigram(index, grams[i]);
+    if (k < 0) {
+      free(lists);
+      return 0;
+    }
+    lists[i].list = index->tri_postings + index->tri_start[k];
+    lists[i].len = (int)(index->tri_start[k + 1] - index->tri_start[k]);
+  }
+  qsort(lists, m, sizeof(Postings), cmp_postings);
+
+  int n = lists[0].len;
+  int *cands = (int *)malloc((n ? n : 1) * sizeof(int));
+  memcpy(cands, lists[0].list, n * sizeof(int));
+  for (int i = 1; i < m && n > 0; i++) {
+    int kept = 0, from = 0;
+    for (int j = 0; j < n; j++) {
+      from += lower_bound_int(lists[i].list + from, lists[i].len - from,
+                              cands[j]);
+      if (from < lists[i].len && lists[i].list[from] == cands[j])
+        cands[kept++] = cands[j];
+    }
+    n = kept;
+  }
+
+  free(lists);
+  *out = cands;
+  return n;
+}
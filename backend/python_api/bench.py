@@ -0,0 +1,768 @@
+"""Benchmarks and differential checks for the search and routing hot paths.
+
+    python bench.py run --sizes 1000,100000,1000000 --out before.json
+    python bench.py compare before.json after.json
+    python bench.py check --size 20000
+
+`run` generates synthetic datasets (clustered around Zipf-weighted hot
+spots, with Zipf-skewed categories), cached as CSV under --data-dir, and
+replays fixed radius, kNN, type-filtered, text-filtered, paged and batch
+workloads against each engine in --engines. Every dataset size runs in its
+own child process, so its peak RSS is reported separately. The JSON report
+records build time, p50/p99 latency and throughput per (size, engine,
+workload), plus campus routing and, when FastAPI is installed, the /search
+endpoint.
+
+`compare` lists the rows of a newer report that are slower than an older
+one by more than --threshold and exits non-zero when there are any.
+
+`check` compares every fast path against a brute-force reference on one
+dataset, prints a count per kind of mismatch and exits non-zero if any.
+"""
+import argparse
+import bisect
+import csv
+import ctypes
+import heapq
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from cache import CachedEngine
+from campus_graph import CampusGraph
+from engine import (
+    C_EXE_PATH, MAX_QUERY_BYTES, EngineError, NativeEngine, WorkerPoolEngine, cell_of, region_box,
+)
+from geo import KM_PER_DEG, haversine
+from ingest import ingest
+from live import LiveEngine, _in_region
+from shards import ShardedEngine
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_QUERIES = 2000
+BATCH_SIZE = 100
+SEED = 42
+# Cuts the synthetic area into 8 x 8 shards
+SHARD_DEG = 0.25
+
+# Bounding box of the synthetic region (about 220 x 215 km)
+MIN_LAT, MAX_LAT = 12.0, 14.0
+MIN_LON, MAX_LON = 76.5, 78.5
+BACKGROUND_SHARE = 0.1
+
+CATEGORIES = [
+    "restaurant", "cafe", "atm", "bank", "pharmacy", "school", "office",
+    "hospital", "clinic", "supermarket", "bus_stop", "temple", "park",
+    "parking", "hotel", "bakery", "fuel", "post_office", "library", "gym",
+    "mall", "cinema", "college", "police", "station", "museum", "stadium",
+    "university", "zoo", "airport",
+]
+WORDS = [
+    "Central", "Royal", "Green", "City", "Lake", "Garden", "Metro", "Sri",
+    "New", "Old", "Grand", "Silver", "Sunrise", "Lotus", "Park", "Hill",
+]
+TEXT_QUERIES = ["central", "lake", "metro", "sri", "gard", "silver hill"]
+
+# Distances from the C core's fast path may differ from haversine by this
+# relative amount, so boundary points within it are not counted as mismatches
+DIST_TOL = 3e-5
+
+
+def _zipf_weights(n, s=1.1):
+    weights = [1.0 / (i + 1) ** s for i in range(n)]
+    total = sum(weights)
+    cumulative, acc = [], 0.0
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+    return cumulative
+
+
+def _pick(rng, cumulative):
+    return min(bisect.bisect_left(cumulative, rng.random()), len(cumulative) - 1)
+
+
+def _hot_spots(n, seed):
+    """(lat, lon, spread_km) cluster centres; more data gets more clusters."""
+    rng = random.Random(seed)
+    count = max(8, int(math.sqrt(n) / 4))
+    return [
+        (rng.uniform(MIN_LAT + 0.1, MAX_LAT - 0.1), rng.uniform(MIN_LON + 0.1, MAX_LON - 0.1),
+         rng.uniform(0.3, 4.0))
+        for _ in range(count)
+    ]
+
+
+def generate(n, seed=SEED):
+    """Yields (id, name, type, lat, lon) rows with coordinates rounded like the CSVs."""
+    rng = random.Random(seed * 1000003 + n)
+    spots = _hot_spots(n, seed)
+    spot_weights = _zipf_weights(len(spots))
+    cat_weights = _zipf_weights(len(CATEGORIES))
+    for poi_id in range(1, n + 1):
+        if rng.random() < BACKGROUND_SHARE:
+            lat, lon = rng.uniform(MIN_LAT, MAX_LAT), rng.uniform(MIN_LON, MAX_LON)
+        else:
+            lat0, lon0, spread = spots[_pick(rng, spot_weights)]
+            lat = lat0 + rng.gauss(0, spread) / KM_PER_DEG
+            lon = lon0 + rng.gauss(0, spread) / (KM_PER_DEG * math.cos(math.radians(lat0)))
+        category = CATEGORIES[_pick(rng, cat_weights)]
+        name = f"{rng.choice(WORDS)} {rng.choice(WORDS)} {category.replace('_', ' ').title()}"
+        yield poi_id, name, category, round(lat, 6), round(lon, 6)
+
+
+def dataset(n, data_dir, seed=SEED):
+    """Path of the CSV for n POIs, generated on first use, and the seconds that took."""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"pois_{n}_{seed}.csv")
+    if os.path.exists(path):
+        return path, 0.0
+    start = time.perf_counter()
+    tmp = path + ".tmp"
+    with open(tmp, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "type", "lat", "lon"])
+        writer.writerows(generate(n, seed))
+    os.replace(tmp, path)
+    return path, time.perf_counter() - start
+
+
+def _empty_campus(data_dir):
+    path = os.path.join(data_dir, "campus_empty.csv")
+    if not os.path.exists(path):
+        with open(path, "w") as f:
+            f.write("id,name,type,lat,lon\n")
+    return path
+
+
+def workloads(n, count, seed=SEED):
+    """{name: [search() kwargs]}; repeated hot locations mimic real traffic."""
+    rng = random.Random(seed)
+    spots = _hot_spots(n, seed)
+    hot = [(lat + rng.gauss(0, spread) / KM_PER_DEG, lon + rng.gauss(0, spread) / KM_PER_DEG)
+           for lat, lon, spread in spots for _ in range(4)]
+    hot_weights = _zipf_weights(len(hot))
+
+    def point():
+        if rng.random() < 0.2:
+            return rng.uniform(MIN_LAT, MAX_LAT), rng.uniform(MIN_LON, MAX_LON)
+        lat, lon = hot[_pick(rng, hot_weights)]
+        return lat + rng.gauss(0, 0.0005), lon + rng.gauss(0, 0.0005)
+
+    def queries(make):
+        return [dict(zip(("lat", "lon"), point()), **make()) for _ in range(count)]
+
+    return {
+        "radius": queries(lambda: {"val": rng.choice([0.5, 1.0, 2.0, 5.0])}),
+        "knn": queries(lambda: {"mode": "knn", "val": rng.choice([1, 10, 50])}),
+        "type": queries(lambda: {"val": 2.0, "type": rng.choice(
+            ["hospital", "cafe,restaurant", "atm,bank", "museum"])}),
+        "text": queries(lambda: {"val": 5.0, "query": rng.choice(TEXT_QUERIES)}),
+        "paged": queries(lambda: {"val": 10.0, "limit": 20}),
+        "batch": queries(lambda: rng.choice([{"val": 1.0}, {"mode": "knn", "val": 10}])),
+    }
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _time_calls(calls, per_call=1):
+    latencies = []
+    start = time.perf_counter()
+    for call in calls:
+        t = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "calls": len(latencies),
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "qps": len(latencies) * per_call / elapsed if elapsed else 0.0,
+    }
+
+
+def replay(engine, loads):
+    """Latency and throughput of each workload against one engine."""
+    rows = {}
+    for name, queries in loads.items():
+        if name == "batch":
+            batches = [queries[i:i + BATCH_SIZE] for i in range(0, len(queries), BATCH_SIZE)]
+            rows[name] = _time_calls([lambda b=b: engine.search_batch(b) for b in batches],
+                                     BATCH_SIZE)
+        else:
+            rows[name] = _time_calls([lambda q=q: engine.search(**q) for q in queries])
+    return rows
+
+
+def bench_cache_paging(native, queries):
+    """Paged queries against a warm cache and against the raw engine."""
+    cached = CachedEngine(native)
+    for q in queries:
+        cached.search(**q)
+    return (_time_calls([lambda q=q: cached.search(**q) for q in queries]),
+            _time_calls([lambda q=q: native.search(**q) for q in queries]))
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return (own + children) * 1024 / scale / 1024
+
+
+def bench_size(n, args):
+    """Everything measured for one dataset size; runs in a child process."""
+    poi_file, generate_s = dataset(n, args.data_dir, args.seed)
+    campus_file = _empty_campus(args.data_dir)
+    loads = workloads(n, args.queries, args.seed)
+    report = {"size": n, "generate_s": generate_s, "engines": {}}
+    unknown = set(args.engines) - {"native", "snapshot", "live", "cached", "workers", "sharded"}
+    if unknown:
+        raise SystemExit(f"unknown engines: {', '.join(sorted(unknown))}")
+
+    start = time.perf_counter()
+    native = NativeEngine(poi_file=poi_file, campus_file=campus_file, snapshot_file=None)
+    report["build_s"] = time.perf_counter() - start
+
+    mapped = None
+    if os.path.exists(C_EXE_PATH):
+        snapshot = os.path.join(args.data_dir, f"pois_{n}_{args.seed}.kdb")
+        subprocess.run([C_EXE_PATH, "--compile", snapshot, poi_file, campus_file], check=True,
+                       capture_output=True)
+        start = time.perf_counter()
+        mapped = NativeEngine(poi_file=poi_file, campus_file=campus_file, snapshot_file=snapshot)
+        report["snapshot_open_s"] = time.perf_counter() - start
+
+    engines = {
+        "native": lambda: native,
+        "snapshot": lambda: mapped,
+        "live": lambda: _live_with_edits(LiveEngine(native, compact_threshold=10 ** 9,
+                                                    compact_interval=0), args.seed),
+        "cached": lambda: CachedEngine(native),
+        "workers": lambda: WorkerPoolEngine(args.workers, poi_file=poi_file,
+                                            campus_file=campus_file, snapshot_file=None),
+        "sharded": lambda: _sharded(poi_file, n, args),
+    }
+    for name in args.engines:
+        engine = None if name in ("snapshot", "workers") and mapped is None else engines[name]()
+        if engine is None:
+            continue
+        try:
+            report["engines"][name] = replay(engine, loads)
+        finally:
+            if name in ("workers", "sharded"):
+                engine.close()
+
+    if "cached" in report["engines"]:
+        hit, raw = bench_cache_paging(native, loads["paged"])
+        report["engines"]["cached"]["paged_hit"] = hit
+        report["engines"].setdefault("native", {})["paged_hit"] = raw
+
+    report["peak_rss_mb"] = _peak_rss_mb()
+    return report
+
+
+def _sharded(poi_file, n, args):
+    shard_dir = os.path.join(args.data_dir, f"shards_{n}_{args.seed}")
+    if not os.path.exists(os.path.join(shard_dir, "manifest.json")):
+        ingest([poi_file], shard_dir, dedup_m=0, jobs=1, shard_deg=SHARD_DEG)
+    return ShardedEngine(shard_dir)
+
+
+def _live_with_edits(live, seed, edits=100):
+    """A live engine carrying a realistic delta of pending edits."""
+    rng = random.Random(seed)
+    for _ in range(edits):
+        lat, lon = rng.uniform(MIN_LAT, MAX_LAT), rng.uniform(MIN_LON, MAX_LON)
+        live.insert({"name": "Bench Edit", "type": rng.choice(CATEGORIES), "lat": lat, "lon": lon})
+    return live
+
+
+def _grid_graph(side, seed=SEED):
+    """side x side street grid, 100 m apart with jitter, as CampusGraph inputs."""
+    rng = random.Random(seed)
+    nodes, edges = {}, []
+    for r in range(side):
+        for c in range(side):
+            nodes[f"n{r}_{c}"] = (12.9 + r * 0.0009 + rng.uniform(-1e-4, 1e-4),
+                                  77.5 + c * 0.0009 + rng.uniform(-1e-4, 1e-4))
+    for r in range(side):
+        for c in range(side):
+            for r2, c2 in ((r + 1, c), (r, c + 1)):
+                if r2 < side and c2 < side and rng.random() < 0.9:
+                    a, b = f"n{r}_{c}", f"n{r2}_{c2}"
+                    edges.append((a, b, round(haversine(*nodes[a], *nodes[b]) * 1000, 1)))
+    return nodes, edges
+
+
+def bench_routing(count, seed=SEED):
+    rng = random.Random(seed)
+    rows = []
+    for side in (10, 32, 45, 100):
+        nodes, edges = _grid_graph(side, seed)
+        start = time.perf_counter()
+        graph = CampusGraph(nodes, edges, {})
+        build_s = time.perf_counter() - start
+        lats = [lat for lat, _ in nodes.values()]
+        lons = [lon for _, lon in nodes.values()]
+
+        def point():
+            return rng.uniform(min(lats), max(lats)), rng.uniform(min(lons), max(lons))
+
+        pairs = [(point(), point()) for _ in range(count)]
+        row = _time_calls([lambda a=a, b=b: graph.route(graph.snap(*a), graph.snap(*b))
+                           for a, b in pairs])
+        rows.append(dict(row, nodes=len(nodes), edges=len(edges), build_s=build_s))
+    return rows
+
+
+def bench_endpoint(count, seed=SEED):
+    try:
+        from fastapi.testclient import TestClient
+        import main
+    except ImportError as e:
+        return {"skipped": str(e)}
+    client = TestClient(main.app)
+    rng = random.Random(seed)
+    params = [{"lat": 12.97 + rng.uniform(-0.05, 0.05), "lon": 77.59 + rng.uniform(-0.05, 0.05),
+               "radius": rng.choice([1, 2, 5])} for _ in range(count)]
+    return _time_calls([lambda p=p: client.get("/search", params=p) for p in params])
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def cmd_run(args):
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "seed": args.seed,
+            "queries": args.queries,
+        },
+        "datasets": [],
+    }
+    for n in args.sizes:
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "_size", str(n),
+             "--queries", str(args.queries), "--seed", str(args.seed),
+             "--data-dir", args.data_dir, "--engines", ",".join(args.engines),
+             "--workers", str(args.workers)],
+            capture_output=True, text=True,
+        )
+        if child.returncode != 0:
+            print(child.stderr, file=sys.stderr)
+            return 1
+        size_report = json.loads(child.stdout.strip().splitlines()[-1])
+        report["datasets"].append(size_report)
+        print(f"{n:>10} POIs  build {size_report['build_s']:.3f}s  "
+              f"rss {size_report['peak_rss_mb'] or 0:.0f} MB", file=sys.stderr)
+        for engine, rows in size_report["engines"].items():
+            for workload, row in rows.items():
+                print(f"    {engine:8s} {workload:7s} p50 {row['p50_ms']:8.3f} ms  "
+                      f"p99 {row['p99_ms']:8.3f} ms  {row['qps']:10.0f} q/s", file=sys.stderr)
+
+    report["routing"] = bench_routing(min(args.queries, 1000), args.seed)
+    report["endpoint"] = bench_endpoint(min(args.queries, 500), args.seed)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+def _flatten(report):
+    """{(size, engine, workload): row} plus build rows, for comparing reports."""
+    rows = {}
+    for d in report["datasets"]:
+        rows[(d["size"], "build", "-")] = {"build_s": d["build_s"]}
+        for engine, loads in d["engines"].items():
+            for workload, row in loads.items():
+                rows[(d["size"], engine, workload)] = row
+    for r in report.get("routing", []):
+        rows[(r["nodes"], "routing", "route")] = r
+    return rows
+
+
+def cmd_compare(args):
+    with open(args.old) as f:
+        old = _flatten(json.load(f))
+    with open(args.new) as f:
+        new = _flatten(json.load(f))
+
+    # Higher is worse for times, lower is worse for throughput
+    metrics = {"build_s": 1, "p50_ms": 1, "p99_ms": 1, "qps": -1}
+    regressions = 0
+    for key in sorted(set(old) & set(new), key=str):
+        for metric, sign in metrics.items():
+            if metric not in old[key] or metric not in new[key] or not old[key][metric]:
+                continue
+            change = (new[key][metric] - old[key][metric]) / old[key][metric]
+            if sign * change > args.threshold:
+                regressions += 1
+                size, engine, workload = key
+                print(f"{size:>10} {engine:8s} {workload:7s} {metric:8s} "
+                      f"{old[key][metric]:12.4f} -> {new[key][metric]:12.4f} ({change:+.1%})")
+    print(f"{regressions} regression(s) over {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def _filtered(pois, type="all", query=None, **_):
+    names = {t.strip().lower() for t in (type or "all").split(",")}
+    q = (query or "").lower()
+    return [p for p in pois
+            if ("all" in names or p["type"].lower() in names)
+            and (not q or q in p["name"].lower() or q in p["type"].lower())]
+
+
+def _same_radius(got, pois, lat, lon, val, **filters):
+    """Engine radius results agree with a brute-force scan up to DIST_TOL."""
+    got_ids = {p["id"]: p["dist"] for p in got}
+    # Nothing outside this latitude band can be within val
+    band = val * (1 + DIST_TOL) / KM_PER_DEG + 1e-9
+    for poi in _filtered(pois, **filters):
+        if abs(poi["lat"] - lat) > band:
+            if poi["id"] in got_ids:
+                return False
+            continue
+        d = haversine(lat, lon, poi["lat"], poi["lon"])
+        near_edge = abs(d - val) <= DIST_TOL * max(val, 1e-3)
+        if poi["id"] in got_ids:
+            if abs(got_ids.pop(poi["id"]) - d) > DIST_TOL * max(d, 1e-3) + 1e-9:
+                return False
+            if d > val and not near_edge:
+                return False
+        elif d <= val and not near_edge:
+            return False
+    return not got_ids
+
+
+def _same_knn(got, pois, lat, lon, val, **filters):
+    want = heapq.nsmallest(int(val), (haversine(lat, lon, p["lat"], p["lon"])
+                                      for p in _filtered(pois, **filters)))
+    if len(got) != len(want):
+        return False
+    return all(abs(g["dist"] - d) <= DIST_TOL * max(d, 1e-3) + 1e-9 for g, d in zip(got, want))
+
+
+def cmd_check(args):
+    pois = [dict(zip(("id", "name", "type", "lat", "lon"), row))
+            for row in generate(args.size, args.seed)]
+    native = NativeEngine(pois=pois)
+    loads = workloads(args.size, args.queries, args.seed)
+    failures = {}
+
+    def expect(name, ok):
+        if not ok:
+            failures[name] = failures.get(name, 0) + 1
+
+    for name, queries in loads.items():
+        for q in queries:
+            q = dict(q, limit=None)
+            got = native.search(**q)
+            if q.get("mode") == "knn":
+                expect(f"knn/{name}", _same_knn(got, pois, **q))
+            else:
+                expect(f"radius/{name}", _same_radius(got, pois, **q))
+
+    # Approximate kNN stays within 1 + epsilon of the exact neighbours, and
+    # a node budget is respected
+    for q in loads["knn"][:200]:
+        exact = native.search(**q)
+        for epsilon in (0.1, 1.0):
+            got = native.search(**q, epsilon=epsilon)
+            expect("knn/epsilon", len(got) == len(exact) and all(
+                g["dist"] <= (1 + epsilon) * e["dist"] + 1e-9 for g, e in zip(got, exact)))
+        stats = {}
+        got = native.search(**q, stats=stats, max_nodes=20)
+        expect("knn/max_nodes", stats["nodes_visited"] <= 20 and all(
+            a["dist"] <= b["dist"] for a, b in zip(got, got[1:])))
+
+    # Best-first pages walked with the cursor equal the full sorted result
+    for q in loads["paged"][:200]:
+        full = native.search(q["lat"], q["lon"], val=q["val"])
+        walked, after = [], None
+        while True:
+            page = native.search(q["lat"], q["lon"], val=q["val"], limit=7, after=after)
+            walked += page
+            if len(page) < 7:
+                break
+            after = (page[-1]["dist"], page[-1]["id"])
+        expect("paged", [p["id"] for p in walked] == [p["id"] for p in full])
+
+    # Radius results come back in traversal order, so those compare as sets
+    def ids(pois, q):
+        found = [p["id"] for p in pois]
+        return found if q.get("mode") == "knn" else sorted(found)
+
+    batch = loads["batch"]
+    for q, got in zip(batch, native.search_batch(batch)):
+        expect("batch", ids(got, q) == ids(native.search(**q), q))
+    radius = [q for q in loads["radius"] if q["val"] == 1.0][:200]
+    offsets, found, _ = native.search_points([q["lat"] for q in radius], [q["lon"] for q in radius],
+                                           val=1.0)
+    for i, q in enumerate(radius):
+        expect("points", sorted(found[offsets[i]:offsets[i + 1]])
+               == ids(native.search(q["lat"], q["lon"], val=1.0), q))
+
+    cached = CachedEngine(native)
+    for q in loads["radius"] + loads["knn"]:
+        a, b = cached.search(**q), native.search(**q)
+        expect("cache", len(a) == len(b) and all(
+            abs(x["dist"] - y["dist"]) <= DIST_TOL * max(y["dist"], 1e-3) for x, y in zip(a, b)))
+
+    # Area queries and clusters against a scan
+    rng = random.Random(args.seed)
+    for i, q in enumerate(loads["radius"][:200]):
+        lat, lon = q["lat"], q["lon"]
+        d = rng.uniform(0.005, 0.2)
+        bbox = (lat - d, lon - d, lat + d, lon + d)
+        polygon = None
+        if i % 2:
+            polygon = [(lat + d * rng.uniform(-1, 1), lon + d * rng.uniform(-1, 1))
+                       for _ in range(rng.randint(3, 8))]
+            bbox = None
+        box = region_box(bbox, polygon)
+        want = [p for p in pois if _in_region(p, box, polygon)]
+        got = native.search_region(bbox, polygon)
+        expect("region", sorted(p["id"] for p in got) == sorted(p["id"] for p in want))
+        cell = rng.choice([0.001, 0.01, 0.05])
+        counts = {}
+        for p in want:
+            key = cell_of(p["lat"], p["lon"], cell)
+            counts[key] = counts.get(key, 0) + 1
+        expect("clusters", {c["cell"]: c["count"] for c in native.clusters(bbox, polygon, cell)}
+               == counts)
+        # Too few output slots still reports every cell, each once
+        capacity = max(1, len(counts) // 3)
+        out = [(t * capacity)() for t in (ctypes.c_double, ctypes.c_double, ctypes.c_int,
+                                          ctypes.c_int)]
+        n = native.lib.kd_clusters(native.index, ctypes.byref(native._region(bbox, polygon)),
+                                   cell, b"all", None, *out, capacity, None)
+        expect("clusters/overflow", n == len(counts))
+
+    # Live edits against a tree rebuilt from the edited data
+    live = LiveEngine(native, compact_threshold=10 ** 9, compact_interval=0)
+    edited = {p["id"]: p for p in pois}
+    for _ in range(300):
+        poi_id = rng.choice(list(edited))
+        action = rng.random()
+        if action < 0.3:
+            live.delete(poi_id)
+            del edited[poi_id]
+        elif action < 0.6:
+            lat = edited[poi_id]["lat"] + rng.uniform(-0.01, 0.01)
+            edited[poi_id] = live.update(poi_id, lat=lat)
+        else:
+            poi = live.insert({"name": "Check Edit", "type": rng.choice(CATEGORIES),
+                               "lat": rng.uniform(MIN_LAT, MAX_LAT),
+                               "lon": rng.uniform(MIN_LON, MAX_LON)})
+            edited[poi["id"]] = poi
+    truth = NativeEngine(pois=list(edited.values()))
+    for q in loads["radius"][:300] + loads["knn"][:300] + loads["type"][:300]:
+        expect("live", ids(live.search(**q), q) == ids(truth.search(**q), q))
+
+    if os.path.exists(C_EXE_PATH):
+        data_dir = args.data_dir
+        poi_file, _ = dataset(args.size, data_dir, args.seed)
+        campus_file = _empty_campus(data_dir)
+        snapshot = os.path.join(data_dir, f"pois_{args.size}_{args.seed}.kdb")
+        subprocess.run([C_EXE_PATH, "--compile", snapshot, poi_file, campus_file], check=True,
+                       capture_output=True)
+        mapped = NativeEngine(poi_file=poi_file, campus_file=campus_file, snapshot_file=snapshot)
+        workers = WorkerPoolEngine(2, poi_file=poi_file, campus_file=campus_file,
+                                   snapshot_file=None)
+        try:
+            for q in loads["radius"][:200] + loads["knn"][:200] + loads["text"][:200]:
+                want = ids(native.search(**q), q)
+                expect("snapshot", ids(mapped.search(**q), q) == want)
+                expect("workers", ids(workers.search(**q), q) == want)
+            # k the worker cannot cast to int is refused, not truncated
+            for k in (0, 1e30, math.nan):
+                try:
+                    workers.search(0.0, 0.0, val=k, mode="knn")
+                    expect("workers/bad-k", False)
+                except EngineError:
+                    pass
+            # An over-long query is bad input, and the worker stays up
+            try:
+                workers.search(0.0, 0.0, query="x" * (MAX_QUERY_BYTES + 1))
+                expect("workers/long-query", False)
+            except ValueError:
+                pass
+            expect("workers/long-query", workers.search(0.0, 0.0, query="x" * MAX_QUERY_BYTES)
+                   == [])
+        finally:
+            workers.close()
+
+        # A cached pool answers from the new data once its file changes
+        small, _ = dataset(1000, data_dir, args.seed)
+        live_file = os.path.join(data_dir, "pois_reload.csv")
+        shutil.copyfile(poi_file, live_file)
+        cached = CachedEngine(WorkerPoolEngine(2, poi_file=live_file, campus_file=campus_file,
+                                               snapshot_file=None))
+        try:
+            qs = loads["radius"][:50] + loads["knn"][:50]
+            for q in qs:
+                cached.search(**q)
+            shutil.copyfile(small, live_file)
+            os.utime(live_file, (time.time() + 10, time.time() + 10))
+            truth = NativeEngine(poi_file=small, campus_file=campus_file, snapshot_file=None)
+            for q in qs:
+                expect("workers/reload", ids(cached.search(**q), q) == ids(truth.search(**q), q))
+            truth.close()
+        finally:
+            cached.close()
+            os.remove(live_file)
+
+        # Damaged snapshots are refused, and the engine falls back to the CSVs
+        with open(snapshot, "rb") as f:
+            good = f.read()
+        name_off = struct.unpack_from("=Q", good, 48 + 8 * 5)[0]
+        damaged = {
+            "truncated": good[:len(good) // 2],
+            "count": good[:20] + struct.pack("=i", args.size + 1) + good[24:],
+            "name_off": good[:name_off] + struct.pack("=I", 2 ** 31) + good[name_off + 4:],
+        }
+        bad = snapshot + ".bad"
+        for name, data in damaged.items():
+            with open(bad, "wb") as f:
+                f.write(data)
+            index = native.lib.kd_open_snapshot(bad.encode("utf-8"))
+            expect(f"snapshot/{name}", not index)
+            if index:
+                native.lib.kd_close(index)
+        fallback = NativeEngine(poi_file=poi_file, campus_file=campus_file, snapshot_file=bad)
+        expect("snapshot/fallback", fallback.lib.kd_size(fallback.index) == args.size)
+        fallback.close()
+        os.remove(bad)
+
+    # Shards with a budget that forces evictions, against the single tree
+    poi_file, _ = dataset(args.size, args.data_dir, args.seed)
+    sharded = _sharded(poi_file, args.size, args)
+    sharded.max_bytes = sum(s.size for s in sharded.shards) // 4
+    try:
+        for q in loads["radius"][:200] + loads["knn"][:200] + loads["text"][:200]:
+            expect("sharded", ids(sharded.search(**q), q) == ids(native.search(**q), q))
+        for q in loads["paged"][:100]:
+            page = sharded.search(q["lat"], q["lon"], val=q["val"], limit=7, offset=3)
+            expect("sharded/paged", [p["id"] for p in page] == [
+                p["id"] for p in native.search(q["lat"], q["lon"], val=q["val"], limit=7,
+                                               offset=3)])
+        for q in loads["radius"][:100]:
+            bbox = (q["lat"] - 0.2, q["lon"] - 0.2, q["lat"] + 0.2, q["lon"] + 0.2)
+            expect("sharded/region", sorted(p["id"] for p in sharded.search_region(bbox))
+                   == sorted(p["id"] for p in native.search_region(bbox)))
+            expect("sharded/clusters",
+                   {c["cell"]: c["count"] for c in sharded.clusters(bbox, None, 0.05)}
+                   == {c["cell"]: c["count"] for c in native.clusters(bbox, None, 0.05)})
+    finally:
+        sharded.close()
+
+    # Routing tables against a plain Dijkstra, snapping against a scan
+    nodes, edges = _grid_graph(20, args.seed)
+    graph = CampusGraph(nodes, edges, {})
+    for _ in range(50):
+        s = rng.randrange(len(graph.names))
+        dist = {s: 0.0}
+        heap = [(0.0, s)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for e in range(graph.offsets[u], graph.offsets[u + 1]):
+                v, nd = graph.targets[e], d + graph.weights[e]
+                if nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        expect("dijkstra", all(abs(graph.distance(s, t) - dist.get(t, math.inf)) < 1e-6
+                               or graph.distance(s, t) == dist.get(t, math.inf)
+                               for t in range(len(graph.names))))
+        lat, lon = nodes[graph.names[s]]
+        lat += rng.uniform(-0.001, 0.001)
+        lon += rng.uniform(-0.001, 0.001)
+        snap = graph.snap(lat, lon)
+        best = min(haversine(lat, lon, *graph._project(lat, lon, e)[1:])
+                   for e in range(len(graph.edges)))
+        expect("snap", abs(snap.offset_km - best) < 1e-9)
+
+    for name, count in sorted(failures.items()):
+        print(f"MISMATCH {name}: {count}")
+    print("all fast paths agree with the references" if not failures else
+          f"{sum(failures.values())} mismatch(es)")
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    data_dir = os.path.join(tempfile.gettempdir(), "kdtree-bench")
+
+    run = sub.add_parser("run", help="benchmark every size and write a JSON report")
+    run.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                     help="comma-separated POI counts, e.g. 1000,10000000")
+    run.add_argument("--out", help="report file (default: stdout)")
+    for p, size_arg in ((run, None), (sub.add_parser("_size"), "size")):
+        if size_arg:
+            p.add_argument(size_arg, type=int)
+        p.add_argument("--queries", type=int, default=DEFAULT_QUERIES)
+        p.add_argument("--seed", type=int, default=SEED)
+        p.add_argument("--data-dir", default=data_dir)
+        p.add_argument("--engines", default="native,live,cached,workers")
+        p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+
+    compare = sub.add_parser("compare", help="list regressions between two reports")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=0.10)
+
+    check = sub.add_parser("check", help="compare fast paths with brute-force references")
+    check.add_argument("--size", type=int, default=20000)
+    check.add_argument("--queries", type=int, default=300)
+    check.add_argument("--seed", type=int, default=SEED)
+    check.add_argument("--data-dir", default=data_dir)
+
+    args = parser.parse_args(argv)
+    if hasattr(args, "engines"):
+        args.engines = [e for e in args.engines.split(",") if e]
+    if args.command == "run":
+        args.sizes = [int(s) for s in args.sizes.split(",") if s]
+        return cmd_run(args)
+    if args.command == "_size":
+        print(json.dumps(bench_size(args.size, args)))
+        return 0
+    if args.command == "compare":
+        return cmd_compare(args)
+    return cmd_check(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""Search result cache in front of an engine.
+
+Queries are keyed on the grid tile holding the query point, at a tile size
+derived from the radius, plus the mode, radius or k, the type filter and
+the normalized text query. A miss stores every POI that could answer any
+query from that tile: for a radius r, the matches within r + h of the tile
+centre, h being the tile's half diagonal; for knn, the matches within
+d_k + 2h, d_k being the centre's k-th nearest distance. A hit measures the
+stored POIs from the exact query point, so nearby requests share an entry
+without getting each other's answers.
+
+Paged and cursor requests skip the cache: the engine's bounded-heap path
+returns a page without measuring a whole tile's candidates.
+
+Entries are evicted least recently used under a byte budget, and the
+whole cache is dropped whenever the engine's dataset version changes.
+"""
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from engine import _page
+from geo import KM_PER_DEG, haversine_batch
+
+CACHE_MAX_BYTES = int(float(os.getenv("KDTREE_CACHE_MB", "64")) * 1024 * 1024)
+
+# Tiles are at most this fraction of the radius across, so a superset
+# covers (1 + TILE_FRACTION)^2 of the area actually searched
+TILE_FRACTION = 0.1
+# Fixed tile size for knn, whose reach is not known up front
+KNN_TILE_KM = 0.25
+# Larger searches go straight to the engine
+MAX_RADIUS_KM = 25.0
+MAX_K = 100
+# Covers the C core's fast-path distance error at the edge of a superset
+REACH_SLACK = 1.001
+# Rough in-memory cost of an entry and of each POI dict it holds
+ENTRY_BYTES = 512
+POI_BYTES = 400
+# Radius that covers the whole Earth
+WORLD_KM = math.pi * 6371.0
+
+
+def _tile(lat, lon, size_km):
+    """(zoom, row, col) of the power-of-two grid tile no wider than size_km."""
+    zoom = max(0, math.ceil(math.log2(360.0 * KM_PER_DEG / size_km)))
+    deg = 360.0 / 2 ** zoom
+    return zoom, math.floor(lat / deg), math.floor(lon / deg)
+
+
+def _tile_centre(zoom, row, col):
+    deg = 360.0 / 2 ** zoom
+    return (row + 0.5) * deg, (col + 0.5) * deg, deg * KM_PER_DEG * math.sqrt(0.5)
+
+
+def _normalize_types(type):
+    names = sorted({t.strip().lower() for t in (type or "all").split(",") if t.strip()})
+    return "all" if "all" in names or not names else ",".join(names)
+
+
+def _normalize_query(query):
+    query = (query or "").strip().lower()
+    return query or None
+
+
+class CachedEngine:
+    """Wraps an engine; search() is cached, everything else passes through."""
+
+    def __init__(self, engine, max_bytes=CACHE_MAX_BYTES):
+        self.engine = engine
+        self.name = engine.name
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def search(self, lat, lon, type="all", val=5.0, query=None, mode="radius", stats=None,
+               limit=None, offset=0, after=None, epsilon=0.0, max_nodes=0):
+        knn = mode == "knn"
+        # Approximate answers are cheap already and must not be served as exact ones
+        if (self.max_bytes <= 0 or epsilon or max_nodes or limit is not None or after is not None
+                or not (0 < int(val) <= MAX_K if knn else 0 <= val <= MAX_RADIUS_KM)):
+            return self.engine.search(lat, lon, type, val, query, mode, stats, limit, offset, after,
+                                      epsilon, max_nodes)
+
+        val = int(val) if knn else float(val)
+        tile = _tile(lat, lon, KNN_TILE_KM if knn else max(val, 1e-3) * TILE_FRACTION)
+        key = (mode, tile, val, _normalize_types(type), _normalize_query(query))
+        candidates = self._lookup(key)
+        if candidates is None:
+            candidates = self._fill(key, tile, type, val, query, knn)
+
+        dists = haversine_batch(lat, lon, [p["lat"] for p in candidates],
+                                [p["lon"] for p in candidates])
+        if stats is not None:
+            stats["nodes_visited"] = 0
+            stats["distance_evals"] = len(candidates)
+        if knn:
+            pois = _page([dict(p, dist=d) for p, d in zip(candidates, dists)], val)
+        else:
+            pois = [dict(p, dist=d) for p, d in zip(candidates, dists) if d <= val]
+        return _page(pois, limit, offset, after)
+
+    def _lookup(self, key):
+        version = self.engine.version
+        with self._lock:
+            if version != self._version:
+                # The dataset changed under every entry
+                self._entries.clear()
+                self._bytes = 0
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _fill(self, key, tile, type, val, query, knn):
+        version = self.engine.version
+        lat, lon, half_diag = _tile_centre(*tile)
+        if knn:
+            nearest = self.engine.search(lat, lon, type, val, query, "knn")
+            reach = nearest[-1]["dist"] + 2 * half_diag if len(nearest) == val else WORLD_KM
+        else:
+            reach = val + half_diag
+        reach *= REACH_SLACK
+        candidates = [
+            {k: v for k, v in poi.items() if k != "dist"}
+            for poi in self.engine.search(lat, lon, type, reach, query, "radius")
+        ]
+
+        size = ENTRY_BYTES + POI_BYTES * len(candidates)
+        if size > self.max_bytes:
+            return candidates
+        with self._lock:
+            if version != self._version:
+                return candidates
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[0]
+            self._entries[key] = (size, candidates)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+        return candidates
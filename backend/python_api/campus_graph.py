@@ -0,0 +1,228 @@
+"""Campus routing graph, compiled once at import.
+
+Nodes are numbered in CAMPUS_NODES order and the undirected edges are kept
+as a CSR adjacency (offsets / targets / weights). Shortest-path distances
+and predecessor trees from every node are precomputed, so a route is a
+table lookup plus unwinding the predecessors. Larger graphs compute a
+source's row on first use instead of holding n^2 tables.
+
+Coordinates snap onto the nearest point of any edge. Nodes and edge
+midpoints are held in KD-trees built by the C core, so snapping stays
+logarithmic on real road networks; without the shared library it falls
+back to linear scans.
+"""
+import heapq
+from collections import namedtuple
+from functools import lru_cache
+from math import cos, radians
+
+from campus_paths import BUILDING_TO_NODE, CAMPUS_EDGES, CAMPUS_NODES
+from engine import EngineError, NativeEngine
+from geo import KM_PER_DEG, haversine
+
+APSP_MAX_NODES = 2048
+
+CAMPUS_BOUNDS = {
+    'lat_min': 12.9220,
+    'lat_max': 12.9245,
+    'lon_min': 77.5000,
+    'lon_max': 77.5020
+}
+
+INF = float("inf")
+
+# A point on the graph: on edge `edge` at fraction t from its first node
+# (edge -1 = exactly on a node), offset_km away from the snapped coordinate.
+# ends lists the (node, meters along the edge) ways onto the graph.
+Snap = namedtuple("Snap", ["edge", "t", "lat", "lon", "offset_km", "ends"])
+
+
+def is_on_campus(lat, lon):
+    return (CAMPUS_BOUNDS['lat_min'] <= lat <= CAMPUS_BOUNDS['lat_max'] and
+            CAMPUS_BOUNDS['lon_min'] <= lon <= CAMPUS_BOUNDS['lon_max'])
+
+
+class CampusGraph:
+    def __init__(self, nodes, edges, buildings):
+        self.names = list(nodes)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.coords = [nodes[name] for name in self.names]
+        n = len(self.names)
+
+        dangling = sorted({a for a, b, _ in edges if a not in self.index} |
+                          {b for a, b, _ in edges if b not in self.index})
+        if dangling:
+            raise ValueError(f"Campus edges reference unknown nodes: {', '.join(dangling)}")
+        dangling = sorted(b for b, node in buildings.items() if node not in self.index)
+        if dangling:
+            raise ValueError(f"BUILDING_TO_NODE maps to unknown nodes: {', '.join(dangling)}")
+        negative = [(a, b) for a, b, w in edges if w < 0]
+        if negative:
+            raise ValueError(f"Campus edges with negative length: {negative}")
+
+        degree = [0] * (n + 1)
+        for a, b, _ in edges:
+            degree[self.index[a] + 1] += 1
+            degree[self.index[b] + 1] += 1
+        for i in range(n):
+            degree[i + 1] += degree[i]
+        self.offsets = degree
+        self.targets = [0] * degree[n]
+        self.weights = [0.0] * degree[n]
+        fill = degree[:n]
+        for a, b, w in edges:
+            u, v = self.index[a], self.index[b]
+            for src, dst in ((u, v), (v, u)):
+                self.targets[fill[src]] = dst
+                self.weights[fill[src]] = float(w)
+                fill[src] += 1
+
+        self.edges = [(self.index[a], self.index[b], float(w)) for a, b, w in edges]
+        self.buildings = {name: self.index[node] for name, node in buildings.items()}
+        self._spatial = None
+
+        if n <= APSP_MAX_NODES:
+            rows = [self._dijkstra(s) for s in range(n)]
+            self._row = rows.__getitem__
+        else:
+            self._row = lru_cache(maxsize=APSP_MAX_NODES)(self._dijkstra)
+
+    def _dijkstra(self, source):
+        """Distances and predecessors from source over the CSR adjacency."""
+        dist = [INF] * len(self.names)
+        pred = [-1] * len(self.names)
+        dist[source] = 0.0
+        pq = [(0.0, source)]
+        offsets, targets, weights = self.offsets, self.targets, self.weights
+        while pq:
+            d, u = heapq.heappop(pq)
+            if d > dist[u]:
+                continue
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                nd = d + weights[e]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    pred[v] = u
+                    heapq.heappush(pq, (nd, v))
+        return dist, pred
+
+    def distance(self, start, end):
+        """Shortest path length in meters between two node ids."""
+        return self._row(start)[0][end]
+
+    def path(self, start, end):
+        """Node ids from start to end, or None when end is unreachable."""
+        dist, pred = self._row(start)
+        if dist[end] == INF:
+            return None
+        path = [end]
+        while path[-1] != start:
+            path.append(pred[path[-1]])
+        path.reverse()
+        return path
+
+    def _indexes(self):
+        """KD-trees over the nodes and the edge midpoints, or None without the C core."""
+        if self._spatial is None:
+            nodes = [
+                {"id": i, "name": name, "type": "node", "lat": lat, "lon": lon}
+                for i, (name, (lat, lon)) in enumerate(zip(self.names, self.coords))
+            ]
+            mids = []
+            self._max_half_km = 0.0
+            for e, (u, v, _) in enumerate(self.edges):
+                (lat1, lon1), (lat2, lon2) = self.coords[u], self.coords[v]
+                mids.append({"id": e, "name": "", "type": "edge",
+                             "lat": (lat1 + lat2) / 2, "lon": (lon1 + lon2) / 2})
+                self._max_half_km = max(self._max_half_km, haversine(lat1, lon1, lat2, lon2) / 2)
+            try:
+                self._spatial = (NativeEngine(pois=nodes), NativeEngine(pois=mids))
+            except (OSError, EngineError):
+                self._spatial = False
+        return self._spatial or None
+
+    def nearest_node(self, lat, lon):
+        """(node id, km) of the closest node."""
+        indexes = self._indexes()
+        if indexes:
+            hits = indexes[0].search(lat, lon, "all", 1, mode="knn")
+            if hits:
+                return hits[0]["id"], hits[0]["dist"]
+        best = min(range(len(self.coords)), key=lambda i: haversine(lat, lon, *self.coords[i]))
+        return best, haversine(lat, lon, *self.coords[best])
+
+    def _project(self, lat, lon, e):
+        """Closest point of edge e to (lat, lon) as (t, lat, lon), in a local planar frame."""
+        u, v, _ = self.edges[e]
+        (lat1, lon1), (lat2, lon2) = self.coords[u], self.coords[v]
+        kx = cos(radians(lat)) * KM_PER_DEG
+        ax, ay = (lon1 - lon) * kx, (lat1 - lat) * KM_PER_DEG
+        bx, by = (lon2 - lon) * kx, (lat2 - lat) * KM_PER_DEG
+        dx, dy = bx - ax, by - ay
+        length2 = dx * dx + dy * dy
+        t = 0.0 if length2 == 0 else min(1.0, max(0.0, -(ax * dx + ay * dy) / length2))
+        return t, lat1 + t * (lat2 - lat1), lon1 + t * (lon2 - lon1)
+
+    def snap(self, lat, lon):
+        """Snap a coordinate to the closest point on any edge."""
+        node, best = self.nearest_node(lat, lon)
+        if not self.edges:
+            return self.node_snap(node, haversine(lat, lon, *self.coords[node]))
+
+        # An edge whose closest point is within best has its midpoint within
+        # best + half its length, so that radius (plus slack for the C core's
+        # distance kernel) holds every candidate
+        indexes = self._indexes()
+        if indexes:
+            radius = (best + self._max_half_km) * 1.001
+            candidates = [hit["id"] for hit in indexes[1].search(lat, lon, "all", radius)]
+        else:
+            candidates = range(len(self.edges))
+
+        snap = None
+        for e in candidates:
+            t, snap_lat, snap_lon = self._project(lat, lon, e)
+            offset = haversine(lat, lon, snap_lat, snap_lon)
+            if snap is None or offset < snap.offset_km:
+                u, v, w = self.edges[e]
+                snap = Snap(e, t, snap_lat, snap_lon, offset, [(u, t * w), (v, (1 - t) * w)])
+        return snap or self.node_snap(node, best)
+
+    def node_snap(self, node, offset_km=0.0):
+        lat, lon = self.coords[node]
+        return Snap(-1, 0.0, lat, lon, offset_km, [(node, 0.0)])
+
+    def route(self, start, end):
+        """Shortest way between two snaps: (node ids, meters along the graph).
+
+        The meters include the partial edges at both ends; node ids is None
+        when there is no path.
+        """
+        best, nodes = self._best_ends(start, end)
+        if nodes is None:
+            return None, INF
+        if start.edge >= 0 and start.edge == end.edge:
+            direct = abs(start.t - end.t) * self.edges[start.edge][2]
+            if direct <= best:
+                return [], direct
+        return self.path(*nodes), best
+
+    def route_distance(self, start, end):
+        """Meters along the graph between two snaps, without building the path."""
+        best, _ = self._best_ends(start, end)
+        if start.edge >= 0 and start.edge == end.edge:
+            best = min(best, abs(start.t - end.t) * self.edges[start.edge][2])
+        return best
+
+    def _best_ends(self, start, end):
+        best, nodes = INF, None
+        for a, da in start.ends:
+            for b, db in end.ends:
+                d = da + self.distance(a, b) + db
+                if d < best:
+                    best, nodes = d, (a, b)
+        return best, nodes
+
+
+CAMPUS_GRAPH = CampusGraph(CAMPUS_NODES, CAMPUS_EDGES, BUILDING_TO_NODE)
@@ -146,59 +146,7 @@ CAMPUS_EXITS = {
 
 
 BUILDING_TO_NODE = {
-    "Pattanagere Metro Station": "pattanagere_metro",
     "Main Campus Gate": "main_gate",
     "RV Vidyaniketan Post Office": "rv_road_1",
-    "Ground Parking": "north_parking",
     "Orchard International School": "main_gate",
-    "Bangalore Institute of Management Studies": "pattanagere_metro",
-    
-    "Innovation Center": "innovation_area",
-    "DTL Huddle": "west_2",
-    "RVCE Administrative Office": "west_2",
-    
-    "Old Sports Block": "north_int_1",
-    "Medical Centre Hostel": "north_int_2",
-    "Telecommunication Department": "north_int_3",
-    "New Library": "east_1",
-    "Library Annexe": "east_1",
-    
-    "CS LAB 9 and 10": "central_hub_1",
-    "Central Computer Hub": "central_hub_2",
-    "Campus Cafeteria": "central_hub_1",
-    "Student Activity Center": "central_hub_1",
-    "Administration Block": "north_int_2",
-    "RV University Main Building": "central_hub_1",
-    "Campus Central Plaza": "central_hub_2",
-    "Kriakalpa": "central_hub_1",
-    
-    "A Block": "central_hub_2",
-    "B Block": "central_hub_3",
-    "C Block": "east_2",
-    "Cauvery Block": "north_int_3",
-    "Cognitive Centre": "north_int_4",
-    "Academic Block 2": "east_2",
-    "RVU A Block": "east_2",
-    
-    "Electrical and Electronics Department": "north_int_4",
-    "Electronics and Communication Department": "east_1",
-    "Telecommunication Department": "east_1",
-    "Aerospace and Information Science": "east_2",
-    "Aerospace Workshop": "east_3",
-    
-    "VRL Bus Depot": "central_hub_3",
-    "Diamond Jubli Hostel": "east_1",
-    "Chamundi Hostel": "south_int_4",
-    "Krishna Hostel": "east_2",
-    "Cauvery Block": "north_int_3",
-    
-    "Mechanical Engineering Block": "west_3",
-    "Aircraft Model Display": "west_2",
-    "Biotechnology BLOCK": "biotech_area",
-    "AIML Biotechnology BLOCK": "south_int_1",
-    "AIML BLOCK": "south_int_1",
-    "Biotech Quadrangle": "biotech_area",
-    "Gymnatorium": "gym_area",
-    "Engineering Block": "south_int_2",
-    "Science Block": "south_int_3",
 }
@@ -0,0 +1,95 @@
+"""Response encodings for search results.
+
+Results are serialized once, straight from the engine's result lists. The
+default is JSON rows, encoded with orjson. Clients that send
+`Accept: application/x-msgpack` get MessagePack instead, laid out as
+columns: ids as int32, lat/lon/dist as float64, each packed into one
+little-endian binary field, and types as uint16 indexes into a type_names
+list. Batches add an int32 offsets column; query i owns rows
+offsets[i]:offsets[i + 1]. Both packages are in requirements.txt; without
+msgpack, a request that accepts only MessagePack gets a 406.
+"""
+import json
+import sys
+from array import array
+
+from fastapi import HTTPException, Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_TYPES = ("application/x-msgpack", "application/msgpack", "application/vnd.msgpack")
+
+
+def _packed(typecode, values):
+    arr = array(typecode, values)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def columns(pois, offsets=None):
+    """One result list (or a concatenated batch) as a dict of columns."""
+    type_index = {}
+    types = [type_index.setdefault(p["type"], len(type_index)) for p in pois]
+    cols = {
+        "count": len(pois),
+        "id": _packed("i", [p["id"] for p in pois]),
+        "lat": _packed("d", [p["lat"] for p in pois]),
+        "lon": _packed("d", [p["lon"] for p in pois]),
+        "dist": _packed("d", [p["dist"] for p in pois]),
+        "name": [p["name"] for p in pois],
+        "type": _packed("H", types),
+        "type_names": list(type_index),
+    }
+    if offsets is not None:
+        cols["offsets"] = _packed("i", offsets)
+    return cols
+
+
+def _asks_msgpack(accept):
+    return any(t in (accept or "") for t in MSGPACK_TYPES)
+
+
+def wants_msgpack(accept):
+    return msgpack is not None and _asks_msgpack(accept)
+
+
+def check_accept(accept):
+    """406 when MessagePack is the only acceptable encoding and msgpack is missing."""
+    if (msgpack is None and _asks_msgpack(accept)
+            and not any(t in accept for t in ("application/json", "*/*"))):
+        raise HTTPException(status_code=406, detail="MessagePack responses are not available")
+
+
+def json_response(content, headers=None):
+    if orjson is not None:
+        body = orjson.dumps(content)
+    else:
+        body = json.dumps(content, separators=(",", ":")).encode("utf-8")
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def results_response(pois, accept=None, headers=None):
+    if wants_msgpack(accept):
+        return Response(msgpack.packb(columns(pois)), media_type="application/x-msgpack",
+                        headers=headers)
+    return json_response(pois, headers)
+
+
+def batch_response(results, accept=None, headers=None):
+    if wants_msgpack(accept):
+        offsets = [0]
+        for pois in results:
+            offsets.append(offsets[-1] + len(pois))
+        rows = [poi for pois in results for poi in pois]
+        return Response(msgpack.packb(columns(rows, offsets)),
+                        media_type="application/x-msgpack", headers=headers)
+    return json_response(results, headers)
@@ -0,0 +1,802 @@
+import ctypes
+import itertools
+import json
+import logging
+import math
+import os
+import queue
+import struct
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import stage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+C_CORE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../c_core"))
+C_SRC_DIR = os.path.join(C_CORE_DIR, "src")
+DATA_DIR = os.getenv("KDTREE_DATA_DIR", os.path.join(C_CORE_DIR, "data"))
+
+POI_FILE = os.path.join(DATA_DIR, "pois.csv")
+CAMPUS_FILE = os.path.join(DATA_DIR, "rv_university_campus.csv")
+# Compiled with `kdtree --compile`; used instead of the CSVs while it is current
+SNAPSHOT_FILE = os.getenv("KDTREE_SNAPSHOT", os.path.join(DATA_DIR, "pois.kdb"))
+
+if sys.platform == "win32":
+    C_EXE_PATH = os.path.join(C_SRC_DIR, "kdtree.exe")
+    C_LIB_PATH = os.path.join(C_SRC_DIR, "kdtree.dll")
+elif sys.platform == "darwin":
+    C_EXE_PATH = os.path.join(C_SRC_DIR, "kdtree")
+    C_LIB_PATH = os.path.join(C_SRC_DIR, "libkdtree.dylib")
+else:
+    C_EXE_PATH = os.path.join(C_SRC_DIR, "kdtree")
+    C_LIB_PATH = os.path.join(C_SRC_DIR, "libkdtree.so")
+
+C_EXE_PATH = os.getenv("KDTREE_EXE", C_EXE_PATH)
+C_LIB_PATH = os.getenv("KDTREE_LIB", C_LIB_PATH)
+
+# Server mode wire format, see main.c
+_LEN = struct.Struct("=I")
+_REQ_HEADER = struct.Struct("=BdddHH")
+_COUNT = struct.Struct("=i")
+_RESULT = struct.Struct("=iddd")
+_STR_LEN = struct.Struct("=H")
+MODE_RADIUS = 0
+MODE_KNN = 1
+# Longest type and query strings main.c accepts (MAX_LINE_LEN, MAX_NAME_LEN)
+MAX_TYPE_BYTES = 1023
+MAX_QUERY_BYTES = 255
+
+
+class EngineError(Exception):
+    pass
+
+
+class ResultSet(ctypes.Structure):
+    _fields_ = [
+        ("items", ctypes.POINTER(ctypes.c_int)),
+        ("dists", ctypes.POINTER(ctypes.c_double)),
+        ("count", ctypes.c_int),
+        ("capacity", ctypes.c_int),
+        ("total", ctypes.c_int),
+        ("fixed", ctypes.c_int),
+    ]
+
+
+class KdStats(ctypes.Structure):
+    _fields_ = [
+        ("nodes_visited", ctypes.c_int64),
+        ("distance_evals", ctypes.c_int64),
+    ]
+
+
+class KdQuery(ctypes.Structure):
+    _fields_ = [
+        ("lat", ctypes.c_double),
+        ("lon", ctypes.c_double),
+        ("val", ctypes.c_double),
+        ("mode", ctypes.c_int),
+        ("type_filter", ctypes.c_char_p),
+        ("query", ctypes.c_char_p),
+    ]
+
+
+class KdRegion(ctypes.Structure):
+    _fields_ = [
+        ("min_lat", ctypes.c_double),
+        ("max_lat", ctypes.c_double),
+        ("min_lon", ctypes.c_double),
+        ("max_lon", ctypes.c_double),
+        ("poly_lat", ctypes.POINTER(ctypes.c_double)),
+        ("poly_lon", ctypes.POINTER(ctypes.c_double)),
+        ("poly_n", ctypes.c_int),
+    ]
+
+
+def region_box(bbox=None, polygon=None):
+    """(min_lat, min_lon, max_lat, max_lon) of a query area.
+
+    A polygon ([(lat, lon), ...]) is clipped to bbox when both are given.
+    """
+    if polygon:
+        lats = [lat for lat, _ in polygon]
+        lons = [lon for _, lon in polygon]
+        box = (min(lats), min(lons), max(lats), max(lons))
+        if bbox is None:
+            return box
+        return (max(box[0], bbox[0]), max(box[1], bbox[1]),
+                min(box[2], bbox[2]), min(box[3], bbox[3]))
+    return tuple(bbox)
+
+
+def cell_of(lat, lon, cell_deg):
+    """Grid cell (row, col) of a point, as kd_clusters assigns it."""
+    return math.floor(lat / cell_deg), math.floor(lon / cell_deg)
+
+
+def _batch_args(q):
+    """search() keyword arguments for one batch entry (a dict)."""
+    return {
+        "lat": q["lat"],
+        "lon": q["lon"],
+        "type": q.get("type", "all"),
+        "val": q.get("val", 5.0),
+        "query": q.get("query"),
+        "mode": q.get("mode", "radius"),
+    }
+
+
+def _page(pois, limit=None, offset=0, after=None):
+    """Order results by (dist, id) and cut out one page.
+
+    after is the (dist, id) of the last result of the previous page.
+    """
+    pois.sort(key=lambda p: (p["dist"], p["id"]))
+    if after is not None:
+        after = tuple(after)
+        pois = [p for p in pois if (p["dist"], p["id"]) > after]
+    end = None if limit is None else offset + limit
+    return pois[offset:end]
+
+
+# Every index a NativeEngine loads or builds gets its own dataset version
+_versions = itertools.count(1)
+
+
+def _data_version(*files):
+    """Modification times of the data files, for engines that read them per search."""
+    return tuple(os.path.getmtime(f) if os.path.exists(f) else None for f in files)
+
+
+def _decode(raw):
+    return raw.decode("utf-8", errors="replace")
+
+
+def _usable_snapshot(snapshot_file, *sources):
+    """True when the snapshot exists and is newer than every source CSV."""
+    if not snapshot_file or not os.path.exists(snapshot_file):
+        return False
+    built = os.path.getmtime(snapshot_file)
+    if any(src and os.path.exists(src) and os.path.getmtime(src) > built for src in sources):
+        logger.warning("Snapshot %s is older than the CSV data, loading the CSVs instead",
+                       snapshot_file)
+        return False
+    return True
+
+
+def _encode_query(query):
+    if query and query.strip() != "":
+        return query.encode("utf-8")
+    return None
+
+
+class _SearchBuffers(threading.local):
+    """Per-thread result buffers handed to the C core, grown on demand."""
+
+    def __init__(self):
+        self.reserve(256)
+
+    def reserve(self, capacity):
+        self.capacity = capacity
+        self.positions = (ctypes.c_int * capacity)()
+        self.dists = (ctypes.c_double * capacity)()
+
+
+class NativeEngine:
+    """KD-tree held in process through the C core's shared library.
+
+    The dataset is loaded and the tree built once in the constructor; every
+    search afterwards only runs the traversal. A current snapshot is mapped
+    instead of parsing the CSVs.
+
+    Searches are reentrant and fill per-thread buffers, and ctypes drops the
+    GIL for the duration of each C call, so searches from a thread pool run
+    in parallel.
+    """
+
+    name = "native"
+
+    def __init__(self, lib_path=C_LIB_PATH, poi_file=POI_FILE, campus_file=CAMPUS_FILE,
+                 snapshot_file=SNAPSHOT_FILE, pois=None):
+        self.lib_path = lib_path
+        self.lib = ctypes.CDLL(lib_path)
+        self._bind()
+        if pois is not None:
+            with stage("build"):
+                self.index = self._build(pois)
+        else:
+            self.index = None
+            if _usable_snapshot(snapshot_file, poi_file, campus_file):
+                with stage("load"):
+                    self.index = self.lib.kd_open_snapshot(snapshot_file.encode("utf-8"))
+            # A snapshot from an older build is refused; the CSVs still work
+            if not self.index and poi_file:
+                with stage("load"):
+                    self.index = self.lib.kd_load(poi_file.encode("utf-8"),
+                                                  campus_file.encode("utf-8"))
+                if self.index:
+                    with stage("build"):
+                        self.lib.build_kdtree(self.index)
+        if not self.index:
+            raise EngineError(f"Could not load POI data from {poi_file or snapshot_file}")
+        self.version = next(_versions)
+        self._buffers = _SearchBuffers()
+
+    def __del__(self):
+        # Swapped-out indexes are released once the last reader drops them
+        self.close()
+
+    def _build(self, pois):
+        n = len(pois)
+        ids = (ctypes.c_int * n)(*(p["id"] for p in pois))
+        lats = (ctypes.c_double * n)(*(p["lat"] for p in pois))
+        lons = (ctypes.c_double * n)(*(p["lon"] for p in pois))
+        names = (ctypes.c_char_p * n)(*(p["name"].encode("utf-8") for p in pois))
+        types = (ctypes.c_char_p * n)(*(p["type"].encode("utf-8") for p in pois))
+        return self.lib.kd_build(n, ids, lats, lons, names, types)
+
+    def _bind(self):
+        lib = self.lib
+        lib.kd_load.argtypes = [ctypes.c_char_p, ctypes.c_char_p]
+        lib.kd_load.restype = ctypes.c_void_p
+        lib.build_kdtree.argtypes = [ctypes.c_void_p]
+        lib.build_kdtree.restype = None
+        lib.kd_open_snapshot.argtypes = [ctypes.c_char_p]
+        lib.kd_open_snapshot.restype = ctypes.c_void_p
+        lib.kd_build.argtypes = [
+            ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_char_p),
+            ctypes.POINTER(ctypes.c_char_p),
+        ]
+        lib.kd_build.restype = ctypes.c_void_p
+        lib.kd_size.argtypes = [ctypes.c_void_p]
+        lib.kd_size.restype = ctypes.c_int
+        lib.kd_find_id.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.kd_find_id.restype = ctypes.c_int
+        lib.kd_range_into.argtypes = [
+            ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double,
+            ctypes.c_char_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(ctypes.c_double), ctypes.c_int, ctypes.POINTER(KdStats),
+        ]
+        lib.kd_range_into.restype = ctypes.c_int
+        lib.kd_range_sorted.argtypes = [
+            ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_double,
+            ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_double, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(KdStats),
+        ]
+        lib.kd_range_sorted.restype = ctypes.c_int
+        lib.kd_knn_sorted.argtypes = [
+            ctypes.c_void_p, ctypes.c_double, ctypes.c_double, ctypes.c_int,
+            ctypes.c_char_p, ctypes.c_char_p, ctypes.c_double, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(KdStats),
+        ]
+        lib.kd_knn_sorted.restype = ctypes.c_int
+        lib.kd_batch.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(KdQuery), ctypes.c_int,
+            ctypes.POINTER(ResultSet), ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(KdStats),
+        ]
+        lib.kd_batch.restype = ctypes.c_int
+        lib.kd_batch_points.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.c_double), ctypes.c_int, ctypes.c_int,
+            ctypes.c_double, ctypes.c_char_p, ctypes.c_char_p,
+            ctypes.POINTER(ResultSet), ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(KdStats),
+        ]
+        lib.kd_batch_points.restype = ctypes.c_int
+        lib.kd_region.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(KdRegion), ctypes.c_char_p, ctypes.c_char_p,
+            ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.POINTER(KdStats),
+        ]
+        lib.kd_region.restype = ctypes.c_int
+        lib.kd_clusters.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(KdRegion), ctypes.c_double, ctypes.c_char_p,
+            ctypes.c_char_p, ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+            ctypes.POINTER(KdStats),
+        ]
+        lib.kd_clusters.restype = ctypes.c_int
+        lib.kd_fetch.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_char_p),
+            ctypes.POINTER(ctypes.c_char_p),
+        ]
+        lib.kd_fetch.restype = None
+        lib.kd_results_free.argtypes = [ctypes.POINTER(ResultSet)]
+        lib.kd_results_free.restype = None
+        lib.kd_close.argtypes = [ctypes.c_void_p]
+        lib.kd_close.restype = None
+
+    def search(self, lat, lon, type="all", val=5.0, query=None, mode="radius", stats=None,
+               limit=None, offset=0, after=None, epsilon=0.0, max_nodes=0):
+        """Radius or kNN search, nearest first.
+
+        For knn, epsilon > 0 allows answers within (1 + epsilon) of the true
+        distances and max_nodes > 0 caps the tree nodes visited; both trade
+        exactness for latency.
+        """
+        counters = KdStats()
+        type_bytes = type.encode("utf-8")
+        query_bytes = _encode_query(query)
+        buf = self._buffers
+
+        if mode != "knn" and limit is not None:
+            # Best-first with a bounded heap: only offset + limit results exist,
+            # and never more than the index holds
+            want = min(offset + limit, self.lib.kd_size(self.index))
+            if want > buf.capacity:
+                buf.reserve(want)
+            after_dist, after_id = after if after is not None else (-1.0, 0)
+            with stage("traversal"):
+                n = self.lib.kd_range_sorted(self.index, lat, lon, float(val), type_bytes,
+                                             query_bytes, want, after_dist, after_id,
+                                             buf.positions, buf.dists, ctypes.byref(counters))
+            if stats is not None:
+                stats["nodes_visited"] = counters.nodes_visited
+                stats["distance_evals"] = counters.distance_evals
+            return self._fetch(buf.positions, n, buf.dists)[offset:]
+
+        if mode == "knn":
+            # Large k costs no more than the whole index
+            k = min(int(val), self.lib.kd_size(self.index))
+            if k > buf.capacity:
+                buf.reserve(k)
+            with stage("traversal"):
+                n = self.lib.kd_knn_sorted(self.index, lat, lon, k, type_bytes, query_bytes,
+                                           float(epsilon), int(max_nodes), buf.positions,
+                                           buf.dists, ctypes.byref(counters))
+        else:
+            with stage("traversal"):
+                while True:
+                    n = self.lib.kd_range_into(self.index, lat, lon, float(val), type_bytes,
+                                               query_bytes, buf.positions, buf.dists,
+                                               buf.capacity, ctypes.byref(counters))
+                    if n <= buf.capacity:
+                        break
+                    buf.reserve(n)
+                    counters = KdStats()
+
+        if stats is not None:
+            stats["nodes_visited"] = counters.nodes_visited
+            stats["distance_evals"] = counters.distance_evals
+        return _page(self._fetch(buf.positions, n, buf.dists), limit, offset, after)
+
+    def search_batch(self, queries, stats=None):
+        """Run many searches in one call; returns one result list per query.
+
+        Each query is a dict of search() arguments. The C core orders the
+        queries spatially and resolves each distinct filter once.
+        """
+        n = len(queries)
+        batch = (KdQuery * n)()
+        for i, q in enumerate(queries):
+            args = _batch_args(q)
+            batch[i] = KdQuery(
+                args["lat"], args["lon"], float(args["val"]),
+                MODE_KNN if args["mode"] == "knn" else MODE_RADIUS,
+                args["type"].encode("utf-8"), _encode_query(args["query"]),
+            )
+
+        results = ResultSet()
+        counters = KdStats()
+        offsets = (ctypes.c_int * (n + 1))()
+        try:
+            with stage("traversal"):
+                total = self.lib.kd_batch(self.index, batch, n, ctypes.byref(results), offsets,
+                                          ctypes.byref(counters))
+            if stats is not None:
+                stats["nodes_visited"] = counters.nodes_visited
+                stats["distance_evals"] = counters.distance_evals
+            pois = self._fetch(results.items, total, results.dists)
+            return [pois[offsets[i]:offsets[i + 1]] for i in range(n)]
+        finally:
+            self.lib.kd_results_free(ctypes.byref(results))
+
+    def search_points(self, lats, lons, type="all", val=5.0, query=None, mode="radius", stats=None):
+        """The same search from many points, for offline jobs.
+
+        lats and lons may be NumPy arrays, which are handed to the C core
+        without a per-point Python step. Returns (offsets, ids, dists); the
+        results of point i are ids[offsets[i]:offsets[i + 1]], nearest first
+        for knn. These are NumPy arrays when NumPy is installed, else lists.
+        """
+        n = len(lats)
+        if len(lons) != n:
+            raise ValueError("lats and lons must have the same length")
+
+        dbl_p = ctypes.POINTER(ctypes.c_double)
+        int_p = ctypes.POINTER(ctypes.c_int)
+        if np is not None:
+            lat_arr = np.ascontiguousarray(lats, dtype=np.float64)
+            lon_arr = np.ascontiguousarray(lons, dtype=np.float64)
+            offsets = np.zeros(n + 1, dtype=np.intc)
+            lat_ptr = lat_arr.ctypes.data_as(dbl_p)
+            lon_ptr = lon_arr.ctypes.data_as(dbl_p)
+            off_ptr = offsets.ctypes.data_as(int_p)
+        else:
+            lat_ptr = (ctypes.c_double * n)(*lats)
+            lon_ptr = (ctypes.c_double * n)(*lons)
+            offsets = off_ptr = (ctypes.c_int * (n + 1))()
+
+        results = ResultSet()
+        counters = KdStats()
+        try:
+            with stage("traversal"):
+                total = self.lib.kd_batch_points(
+                    self.index, lat_ptr, lon_ptr, n,
+                    MODE_KNN if mode == "knn" else MODE_RADIUS, float(val),
+                    type.encode("utf-8"), _encode_query(query),
+                    ctypes.byref(results), off_ptr, ctypes.byref(counters),
+                )
+            if stats is not None:
+                stats["nodes_visited"] = counters.nodes_visited
+                stats["distance_evals"] = counters.distance_evals
+
+            if np is not None:
+                ids = np.empty(total, dtype=np.intc)
+                dists = np.empty(total, dtype=np.float64)
+                if total:
+                    self.lib.kd_fetch(self.index, results.items, total, ids.ctypes.data_as(int_p),
+                                      None, None, None, None)
+                    dists[:] = np.ctypeslib.as_array(results.dists, shape=(total,))
+                return offsets, ids, dists
+
+            ids = (ctypes.c_int * total)()
+            self.lib.kd_fetch(self.index, results.items, total, ids, None, None, None, None)
+            return list(offsets), list(ids), results.dists[:total]
+        finally:
+            self.lib.kd_results_free(ctypes.byref(results))
+
+    def _region(self, bbox, polygon):
+        min_lat, min_lon, max_lat, max_lon = region_box(bbox, polygon)
+        region = KdRegion(min_lat, max_lat, min_lon, max_lon)
+        if polygon:
+            n = len(polygon)
+            region.poly_lat = (ctypes.c_double * n)(*(lat for lat, _ in polygon))
+            region.poly_lon = (ctypes.c_double * n)(*(lon for _, lon in polygon))
+            region.poly_n = n
+        return region
+
+    def search_region(self, bbox=None, polygon=None, type="all", query=None, limit=None,
+                      stats=None):
+        """POIs inside bbox (min_lat, min_lon, max_lat, max_lon), a polygon
+        ([(lat, lon), ...]) or both, in tree order; at most limit of them."""
+        region = self._region(bbox, polygon)
+        counters = KdStats()
+        buf = self._buffers
+        with stage("traversal"):
+            while True:
+                capacity = buf.capacity if limit is None else min(limit, buf.capacity)
+                n = self.lib.kd_region(self.index, ctypes.byref(region), type.encode("utf-8"),
+                                       _encode_query(query), buf.positions, capacity,
+                                       ctypes.byref(counters))
+                if n <= capacity or capacity == limit:
+                    break
+                buf.reserve(n if limit is None else min(n, limit))
+                counters = KdStats()
+
+        if stats is not None:
+            stats["nodes_visited"] = counters.nodes_visited
+            stats["distance_evals"] = counters.distance_evals
+        n = min(n, capacity)
+        pois = self._fetch(buf.positions, n, [0.0] * n)
+        for poi in pois:
+            del poi["dist"]
+        return pois
+
+    def clusters(self, bbox=None, polygon=None, cell_deg=0.01, type="all", query=None,
+                 stats=None):
+        """Matches in the area counted per grid cell of cell_deg degrees.
+
+        Returns [{"cell", "lat", "lon", "count", "poi"}] with the centroid of
+        each cell's matches; poi is the match itself when count is 1.
+        Subtrees that fall in one cell are counted without visiting their
+        points, so the cost follows the number of cells, not of POIs.
+        """
+        region = self._region(bbox, polygon)
+        min_cell = cell_of(region.min_lat, region.min_lon, cell_deg)
+        max_cell = cell_of(region.max_lat, region.max_lon, cell_deg)
+        capacity = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+        lats = (ctypes.c_double * capacity)()
+        lons = (ctypes.c_double * capacity)()
+        counts = (ctypes.c_int * capacity)()
+        samples = (ctypes.c_int * capacity)()
+        counters = KdStats()
+        with stage("traversal"):
+            n = self.lib.kd_clusters(self.index, ctypes.byref(region), cell_deg,
+                                     type.encode("utf-8"), _encode_query(query), lats, lons,
+                                     counts, samples, capacity, ctypes.byref(counters))
+        if stats is not None:
+            stats["nodes_visited"] = counters.nodes_visited
+            stats["distance_evals"] = counters.distance_evals
+
+        # The samples' stored coordinates give the cells exactly as C saw them
+        n = min(n, capacity)
+        sample_lats = (ctypes.c_double * n)()
+        sample_lons = (ctypes.c_double * n)()
+        self.lib.kd_fetch(self.index, samples, n, None, sample_lats, sample_lons, None, None)
+        singles = [i for i in range(n) if counts[i] == 1]
+        single_pois = self._fetch((ctypes.c_int * len(singles))(*(samples[i] for i in singles)),
+                                  len(singles), [0.0] * len(singles))
+        for poi in single_pois:
+            del poi["dist"]
+        single_pois = dict(zip(singles, single_pois))
+        return [
+            {
+                "cell": cell_of(sample_lats[i], sample_lons[i], cell_deg),
+                "lat": lats[i],
+                "lon": lons[i],
+                "count": counts[i],
+                "poi": single_pois.get(i),
+            }
+            for i in range(n)
+        ]
+
+    def get(self, poi_id):
+        """The POI with this id, or None."""
+        pos = self.lib.kd_find_id(self.index, poi_id)
+        if pos < 0:
+            return None
+        poi = self._fetch((ctypes.c_int * 1)(pos), 1, [0.0])[0]
+        del poi["dist"]
+        return poi
+
+    def pois(self):
+        """Every POI in the index, in tree order."""
+        n = self.lib.kd_size(self.index)
+        pois = self._fetch((ctypes.c_int * n)(*range(n)), n, [0.0] * n)
+        for poi in pois:
+            del poi["dist"]
+        return pois
+
+    def rebuild(self, pois):
+        """A new engine over the given POIs; this one is left untouched."""
+        return NativeEngine(self.lib_path, pois=pois)
+
+    def _fetch(self, positions, n, dists):
+        ids = (ctypes.c_int * n)()
+        lats = (ctypes.c_double * n)()
+        lons = (ctypes.c_double * n)()
+        names = (ctypes.c_char_p * n)()
+        types = (ctypes.c_char_p * n)()
+        with stage("fetch"):
+            self.lib.kd_fetch(self.index, positions, n, ids, lats, lons, names, types)
+            return [
+                {
+                    "id": ids[i],
+                    "name": _decode(names[i]),
+                    "type": _decode(types[i]),
+                    "lat": round(lats[i], 6),
+                    "lon": round(lons[i], 6),
+                    "dist": dists[i],
+                }
+                for i in range(n)
+            ]
+
+    def close(self):
+        if getattr(self, "index", None):
+            self.lib.kd_close(self.index)
+            self.index = None
+
+
+class SubprocessEngine:
+    """Fallback that runs the kdtree executable once per search."""
+
+    name = "subprocess"
+
+    def __init__(self, exe_path=C_EXE_PATH):
+        self.exe_path = exe_path
+        self.cwd = os.path.dirname(exe_path)
+
+    @property
+    def version(self):
+        # Every search re-reads the data files
+        return _data_version(POI_FILE, CAMPUS_FILE, SNAPSHOT_FILE)
+
+    def search(self, lat, lon, type="all", val=5.0, query=None, mode="radius", stats=None,
+               limit=None, offset=0, after=None, epsilon=0.0, max_nodes=0):
+        # Always exact: epsilon and max_nodes only bound the in-process search
+        query_str = query if query and query.strip() != "" else "NULL_QUERY"
+        cmd = [self.exe_path, str(lat), str(lon), type, str(val), query_str, mode]
+
+        try:
+            with stage("spawn"):
+                result = subprocess.run(
+                    cmd,
+                    capture_output=True,
+                    text=True,
+                    cwd=self.cwd,
+                    check=True
+                )
+        except subprocess.CalledProcessError as e:
+            raise EngineError(e.stderr) from e
+
+        output = result.stdout.strip()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("C output (first 500 chars): %s", output[:500])
+
+        if not output:
+            return []
+
+        try:
+            return _page(json.loads(output), limit, offset, after)
+        except json.JSONDecodeError as e:
+            logger.error("Malformed C output (%s): %s", e, output)
+            return []
+
+    def search_batch(self, queries, stats=None):
+        return [self.search(**_batch_args(q)) for q in queries]
+
+    def close(self):
+        pass
+
+
+class _Worker:
+    def __init__(self, exe_path, poi_file, campus_file):
+        self.proc = subprocess.Popen(
+            [exe_path, "--serve", poi_file, campus_file],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(exe_path),
+        )
+
+    def _read(self, n):
+        data = self.proc.stdout.read(n)
+        if len(data) != n:
+            raise EngineError(f"KD-tree worker {self.proc.pid} exited")
+        return data
+
+    def request(self, payload):
+        self.proc.stdin.write(_LEN.pack(len(payload)) + payload)
+        self.proc.stdin.flush()
+        (length,) = _LEN.unpack(self._read(_LEN.size))
+        return self._read(length)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        if self.alive():
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+def _parse_response(data):
+    (count,) = _COUNT.unpack_from(data, 0)
+    if count < 0:
+        raise EngineError("KD-tree worker rejected the request")
+
+    pos = _COUNT.size
+    pois = []
+    for _ in range(count):
+        poi_id, lat, lon, dist = _RESULT.unpack_from(data, pos)
+        pos += _RESULT.size
+        (n,) = _STR_LEN.unpack_from(data, pos)
+        pos += _STR_LEN.size
+        name = _decode(data[pos:pos + n])
+        pos += n
+        (n,) = _STR_LEN.unpack_from(data, pos)
+        pos += _STR_LEN.size
+        poi_type = _decode(data[pos:pos + n])
+        pos += n
+        pois.append({
+            "id": poi_id,
+            "name": name,
+            "type": poi_type,
+            "lat": round(lat, 6),
+            "lon": round(lon, 6),
+            "dist": dist,
+        })
+    return pois
+
+
+class WorkerPoolEngine:
+    """Pool of long-running `kdtree --serve` processes.
+
+    Each worker builds the tree once and answers queries over its
+    stdin/stdout, so a crash in the C core only takes down that worker,
+    which is respawned on the next request. Once `version` sees the data
+    files change, workers are respawned on the new files the same way.
+    """
+
+    name = "workers"
+
+    def __init__(self, size=None, exe_path=C_EXE_PATH, poi_file=POI_FILE, campus_file=CAMPUS_FILE,
+                 snapshot_file=SNAPSHOT_FILE):
+        if _usable_snapshot(snapshot_file, poi_file, campus_file):
+            poi_file = snapshot_file
+        self.args = (exe_path, poi_file, campus_file)
+        self._files = _data_version(poi_file, campus_file)
+        self._generation = next(_versions)
+        self._lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.size = 0
+        for _ in range(size or os.cpu_count() or 1):
+            self.idle.put(self._spawn())
+            self.size += 1
+
+    def __del__(self):
+        self.close()
+
+    def _spawn(self):
+        worker = _Worker(*self.args)
+        worker.generation = self._generation
+        return worker
+
+    @property
+    def version(self):
+        # A change to the files retires every worker; each is respawned on
+        # the new files before its next search, so answers match the version
+        files = _data_version(*self.args[1:])
+        with self._lock:
+            if files != self._files:
+                self._files = files
+                self._generation = next(_versions)
+            return self._generation
+
+    def search(self, lat, lon, type="all", val=5.0, query=None, mode="radius", stats=None,
+               limit=None, offset=0, after=None, epsilon=0.0, max_nodes=0):
+        # Always exact: the wire format has no room for epsilon or max_nodes
+        type_bytes = type.encode("utf-8")
+        query_bytes = _encode_query(query) or b""
+        # The worker would reject these as malformed; they are bad input, not a crash
+        if len(type_bytes) > MAX_TYPE_BYTES or len(query_bytes) > MAX_QUERY_BYTES:
+            raise ValueError(f"type is limited to {MAX_TYPE_BYTES} bytes and query to "
+                             f"{MAX_QUERY_BYTES}")
+        payload = _REQ_HEADER.pack(
+            MODE_KNN if mode == "knn" else MODE_RADIUS,
+            lat, lon, float(val), len(type_bytes), len(query_bytes),
+        ) + type_bytes + query_bytes
+
+        worker = self.idle.get()
+        try:
+            if worker.generation != self._generation:
+                worker.close()
+                worker = self._spawn()
+            with stage("worker"):
+                data = worker.request(payload)
+        except (OSError, EngineError) as e:
+            worker.close()
+            worker = self._spawn()
+            raise EngineError(str(e)) from e
+        finally:
+            self.idle.put(worker)
+        return _page(_parse_response(data), limit, offset, after)
+
+    def search_batch(self, queries, stats=None):
+        """Spread a batch over the pool; results come back in input order."""
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(lambda q: self.search(**_batch_args(q)), queries))
+
+    def close(self):
+        # Waits for in-flight requests, since busy workers are not idle
+        while getattr(self, "size", 0):
+            self.idle.get().close()
+            self.size -= 1
+
+
+def load_engine():
+    """Load the configured engine, falling back to the executable."""
+    mode = os.getenv("KDTREE_ENGINE", "native")
+    if mode == "native":
+        try:
+            return NativeEngine()
+        except (OSError, EngineError) as e:
+            logger.warning("Native KD-tree engine unavailable (%s), using subprocess fallback", e)
+    elif mode == "workers":
+        try:
+            return WorkerPoolEngine(int(os.getenv("KDTREE_WORKERS", "0")) or None)
+        except OSError as e:
+            logger.warning("KD-tree worker pool unavailable (%s), using subprocess fallback", e)
+    return SubprocessEngine()
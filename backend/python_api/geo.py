@@ -0,0 +1,71 @@
+"""Great-circle distance helpers shared with the C core.
+
+The constants and formulas mirror c_core/src/geo.h so that distances
+computed here (routing estimates, campus snapping) agree with the ones the
+KD-tree returns. test_geo.py checks the accuracy contract.
+"""
+import ctypes
+from math import asin, cos, radians, sin, sqrt
+
+from engine import C_LIB_PATH
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG = radians(EARTH_RADIUS_KM)
+
+FAST_PATH_MAX_KM = 20.0
+FAST_PATH_MAX_LAT = 80.0
+FAST_PATH_REL_ERR = 2e-5
+
+# Spherical haversine against the WGS84 ellipsoid: the flattening alone puts
+# the two up to ~0.56% apart, so 0.6% is the contract for the exact kernel.
+SPHERE_REL_ERR = 0.006
+
+_lib = None
+
+
+def _kernel():
+    global _lib
+    if _lib is None:
+        try:
+            lib = ctypes.CDLL(C_LIB_PATH)
+        except OSError:
+            _lib = False
+            return None
+        dbl = ctypes.c_double
+        lib.geo_haversine_km.argtypes = [dbl, dbl, dbl, dbl]
+        lib.geo_haversine_km.restype = dbl
+        lib.geo_equirect_km.argtypes = [dbl, dbl, dbl, dbl, dbl, dbl]
+        lib.geo_equirect_km.restype = dbl
+        lib.geo_haversine_batch.argtypes = [
+            dbl, dbl, ctypes.POINTER(dbl), ctypes.POINTER(dbl),
+            ctypes.POINTER(dbl), ctypes.c_int, ctypes.POINTER(dbl),
+        ]
+        lib.geo_haversine_batch.restype = None
+        _lib = lib
+    return _lib or None
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    s_lat = sin(radians(lat2 - lat1) / 2)
+    s_lon = sin(radians(lon2 - lon1) / 2)
+    a = s_lat * s_lat + cos(radians(lat1)) * cos(radians(lat2)) * s_lon * s_lon
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(min(a, 1.0)))
+
+
+def equirect(lat1, lon1, lat2, lon2):
+    x = (lon2 - lon1) * (cos(radians(lat1)) + cos(radians(lat2))) / 2
+    y = lat2 - lat1
+    return KM_PER_DEG * sqrt(x * x + y * y)
+
+
+def haversine_batch(lat, lon, lats, lons):
+    """Distances from one origin to many points, in the C kernel when loaded."""
+    n = len(lats)
+    lib = _kernel()
+    if lib is None:
+        return [haversine(lat, lon, la, lo) for la, lo in zip(lats, lons)]
+
+    arr = ctypes.c_double * n
+    out = arr()
+    lib.geo_haversine_batch(lat, lon, arr(*lats), arr(*lons), None, n, out)
+    return list(out)
@@ -0,0 +1,480 @@
+"""Streaming POI ingestion: CSV or NDJSON dumps in, a compiled index out.
+
+    python ingest.py ../c_core/data/pois.csv ../c_core/data/rv_university_campus.csv \
+        --out ../c_core/data/pois.kdb
+    python ingest.py country.geojsonseq.gz --map id= --shard-deg 0.5 --out shards/
+    python ingest.py extract.geojsonseq.gz --map type=amenity,shop --out region.kdb \
+        --csv-out region.csv
+
+Inputs are read in chunks of records that a pool of processes parses and
+validates, with only a few chunks in flight, so memory holds the compact
+C index being filled rather than the raw text. Columns (or NDJSON keys;
+GeoJSON features use their properties and point geometry) are found by
+the names in FIELDS, or as given with --map; a field mapped to several
+columns takes the first non-empty one. Names keep their commas and quotes,
+since the C loader reads quoted CSV. Rows with no name or type or with
+coordinates out of range are counted and dropped. Rows without an id get
+ids after the largest one seen before their file.
+
+Once everything is loaded, POIs that repeat an earlier id, or that have
+the type and name of an earlier POI within --dedup-m meters of it, are
+removed. The tree is then built and saved as a snapshot that the API maps
+at startup; --csv-out also writes the result as a canonical POI CSV. With
+--shard-deg, --out is a directory that gets one snapshot per tile of that
+many degrees and a manifest, served by shards.py.
+"""
+import argparse
+import csv
+import ctypes
+import gzip
+import json
+import math
+import os
+import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from engine import C_LIB_PATH, cell_of
+from shards import MANIFEST
+
+FIELDS = {
+    "id": ["id", "poi_id"],
+    "name": ["name", "name:en", "title"],
+    "type": ["type", "category", "amenity", "shop", "tourism", "leisure", "healthcare",
+             "office", "public_transport", "railway"],
+    "lat": ["lat", "latitude", "@lat", "y"],
+    "lon": ["lon", "lng", "longitude", "@lon", "x"],
+}
+REQUIRED = ("name", "type", "lat", "lon")
+
+CHUNK_ROWS = 50000
+DEDUP_M = 25.0
+MAX_ID = 2 ** 31 - 1
+# Longer text would overflow the C loader's line buffer in the CSV output
+MAX_NAME_BYTES = 255
+MAX_TYPE_BYTES = 99
+
+NDJSON_SUFFIXES = (".ndjson", ".jsonl", ".geojsonl", ".geojsons", ".geojsonseq")
+
+
+class IngestError(Exception):
+    pass
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace", newline="")
+    return open(path, encoding="utf-8", errors="replace", newline="")
+
+
+def _format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    if name.endswith(NDJSON_SUFFIXES):
+        return "ndjson"
+    return "tsv" if name.endswith(".tsv") else "csv"
+
+
+def _text(value):
+    """Whitespace-collapsed text, or "" for empty and non-text values."""
+    if value is None or isinstance(value, (dict, list)):
+        return ""
+    return " ".join(str(value).split())
+
+
+def _first(row, keys):
+    for key in keys:
+        value = _text(row.get(key) if isinstance(row, dict) else
+                      row[key] if key < len(row) else None)
+        if value:
+            return value
+    return ""
+
+
+def _validate(row, columns, rejects):
+    """(id, name, type, lat, lon) from one record, or None after counting why."""
+    name = _first(row, columns["name"])
+    type = _first(row, columns["type"])
+    if not name or not type:
+        rejects["missing name or type"] += 1
+        return None
+    if "\0" in name or "\0" in type or len(name.encode("utf-8")) > MAX_NAME_BYTES \
+            or len(type.encode("utf-8")) > MAX_TYPE_BYTES:
+        rejects["bad name or type"] += 1
+        return None
+    try:
+        lat = float(_first(row, columns["lat"]))
+        lon = float(_first(row, columns["lon"]))
+    except ValueError:
+        rejects["bad coordinates"] += 1
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90
+            and -180 <= lon <= 180):
+        rejects["bad coordinates"] += 1
+        return None
+
+    poi_id = 0
+    raw_id = _first(row, columns["id"])
+    if raw_id:
+        try:
+            value = float(raw_id)
+        except ValueError:
+            value = math.nan
+        if not (math.isfinite(value) and value == int(value) and 0 < value <= MAX_ID):
+            rejects["bad id"] += 1
+            return None
+        poi_id = int(value)
+    return poi_id, name, type, lat, lon
+
+
+def parse_chunk(job):
+    """Parse and validate one chunk of lines; runs in a worker process.
+
+    Returns (ids, names, types, lats, lons, rejects), with id 0 for rows
+    that have none.
+    """
+    fmt, columns, lines = job
+    out = ([], [], [], [], [])
+    rejects = Counter()
+    if fmt == "ndjson":
+        records = []
+        for line in lines:
+            line = line.strip().lstrip("\x1e")
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                rejects["bad json"] += 1
+                continue
+            if not isinstance(record, dict):
+                rejects["bad json"] += 1
+                continue
+            if record.get("type") == "Feature":
+                properties = dict(record.get("properties") or {})
+                geometry = record.get("geometry") or {}
+                if geometry.get("type") == "Point":
+                    coords = geometry.get("coordinates") or []
+                    if len(coords) >= 2:
+                        properties.setdefault("lon", coords[0])
+                        properties.setdefault("lat", coords[1])
+                # Feature ids are usually OSM ids such as "node/123", so
+                # only an id property is used
+                record = properties
+            records.append(record)
+    else:
+        delimiter = "\t" if fmt == "tsv" else ","
+        records = (row for row in csv.reader(lines, delimiter=delimiter)
+                   if row and not row[0].startswith("#"))
+
+    for record in records:
+        poi = _validate(record, columns, rejects)
+        if poi is not None:
+            for column, value in zip(out, poi):
+                column.append(value)
+    return out + (rejects,)
+
+
+def _columns(fields, mapping):
+    """{field: [columns]} for one input; fields are header names or NDJSON keys."""
+    lowered = {}
+    for i, name in enumerate(fields):
+        lowered.setdefault(name.strip().lower(), i)
+    columns = {}
+    for field, aliases in FIELDS.items():
+        if field in mapping:
+            names = mapping[field]
+        else:
+            names = aliases
+        columns[field] = [lowered[n.lower()] for n in names if n.lower() in lowered]
+    return columns
+
+
+def _chunks(path, mapping, chunk_rows):
+    """Yields parse_chunk jobs for one input, reading it once, a chunk at a time."""
+    fmt = _format(path)
+    with _open(path) as f:
+        if fmt == "ndjson":
+            # Keys are looked up per record, so map every alias (or --map) to itself
+            columns = {field: list(mapping.get(field, aliases))
+                       for field, aliases in FIELDS.items()}
+            lines = []
+            for line in f:
+                lines.append(line)
+                if len(lines) >= chunk_rows:
+                    yield fmt, columns, lines
+                    lines = []
+            if lines:
+                yield fmt, columns, lines
+            return
+
+        header = None
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                header = next(csv.reader([line], delimiter="\t" if fmt == "tsv" else ","))
+                break
+        if header is None:
+            return
+        columns = _columns(header, mapping)
+        missing = [field for field in REQUIRED if not columns[field]]
+        if missing:
+            raise IngestError(f"{path}: no column for {', '.join(missing)} "
+                              f"(header: {','.join(header)}); use --map")
+
+        # A chunk only ends where no quoted field is left open, so records
+        # with embedded newlines stay whole
+        lines, quotes = [], 0
+        for line in f:
+            lines.append(line)
+            quotes += line.count('"')
+            if len(lines) >= chunk_rows and quotes % 2 == 0:
+                yield fmt, columns, lines
+                lines, quotes = [], 0
+        if lines:
+            yield fmt, columns, lines
+
+
+def _bounded_map(fn, jobs, pool, window):
+    """fn over jobs in order, with at most window jobs submitted ahead."""
+    if pool is None:
+        for job in jobs:
+            yield fn(job)
+        return
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.submit(fn, job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class IndexWriter:
+    """An unbuilt C index filled in chunks, then deduplicated, built and saved."""
+
+    def __init__(self, lib_path=C_LIB_PATH):
+        self.lib = lib = ctypes.CDLL(lib_path)
+        int_p = ctypes.POINTER(ctypes.c_int)
+        dbl_p = ctypes.POINTER(ctypes.c_double)
+        str_p = ctypes.POINTER(ctypes.c_char_p)
+        lib.kd_create.argtypes = []
+        lib.kd_create.restype = ctypes.c_void_p
+        lib.kd_append.argtypes = [ctypes.c_void_p, ctypes.c_int, int_p, dbl_p, dbl_p, str_p,
+                                  str_p]
+        lib.kd_append.restype = ctypes.c_int
+        lib.kd_dedup.argtypes = [ctypes.c_void_p, ctypes.c_double]
+        lib.kd_dedup.restype = ctypes.c_int
+        lib.build_kdtree.argtypes = [ctypes.c_void_p]
+        lib.build_kdtree.restype = None
+        lib.kd_save_snapshot.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        lib.kd_save_snapshot.restype = ctypes.c_int
+        lib.kd_size.argtypes = [ctypes.c_void_p]
+        lib.kd_size.restype = ctypes.c_int
+        lib.kd_fetch.argtypes = [ctypes.c_void_p, int_p, ctypes.c_int, int_p, dbl_p, dbl_p,
+                                 str_p, str_p]
+        lib.kd_fetch.restype = None
+        lib.kd_close.argtypes = [ctypes.c_void_p]
+        lib.kd_close.restype = None
+        self.index = lib.kd_create()
+        if not self.index:
+            raise MemoryError("Could not allocate an index")
+        self.max_id = 0
+
+    def append(self, ids, names, types, lats, lons):
+        n = len(ids)
+        added = self.lib.kd_append(
+            self.index, n, (ctypes.c_int * n)(*ids), (ctypes.c_double * n)(*lats),
+            (ctypes.c_double * n)(*lons),
+            (ctypes.c_char_p * n)(*(name.encode("utf-8") for name in names)),
+            (ctypes.c_char_p * n)(*(type.encode("utf-8") for type in types)),
+        )
+        self.max_id = max(self.max_id, max(ids, default=0))
+        return added
+
+    def dedup(self, radius_km):
+        return self.lib.kd_dedup(self.index, radius_km)
+
+    def __len__(self):
+        return self.lib.kd_size(self.index)
+
+    def rows(self, chunk_rows=CHUNK_ROWS):
+        """(id, name, type, lat, lon) of every POI in input order, fetched in chunks."""
+        n = len(self)
+        for start in range(0, n, chunk_rows):
+            count = min(chunk_rows, n - start)
+            ids = (ctypes.c_int * count)()
+            lats = (ctypes.c_double * count)()
+            lons = (ctypes.c_double * count)()
+            names = (ctypes.c_char_p * count)()
+            types = (ctypes.c_char_p * count)()
+            positions = (ctypes.c_int * count)(*range(start, start + count))
+            self.lib.kd_fetch(self.index, positions, count, ids, lats, lons, names, types)
+            for i in range(count):
+                yield (ids[i], names[i].decode("utf-8", errors="replace"),
+                       types[i].decode("utf-8", errors="replace"), lats[i], lons[i])
+
+    def write_csv(self, path, chunk_rows=CHUNK_ROWS):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["id", "name", "type", "lat", "lon"])
+            writer.writerows(self.rows(chunk_rows))
+
+    def save(self, path):
+        self.lib.build_kdtree(self.index)
+        tmp = path + ".tmp"
+        if self.lib.kd_save_snapshot(self.index, tmp.encode("utf-8")) != 0:
+            raise IngestError(f"Could not write {path}")
+        # Readers never see a half-written snapshot
+        os.replace(tmp, path)
+
+    def close(self):
+        if self.index:
+            self.lib.kd_close(self.index)
+            self.index = None
+
+
+def write_shards(writer, out_dir, tile_deg, chunk_rows=CHUNK_ROWS, lib_path=C_LIB_PATH):
+    """Split the loaded POIs into one snapshot per tile of tile_deg degrees,
+    plus the manifest shards.py reads; returns the number of shards."""
+    os.makedirs(out_dir, exist_ok=True)
+    tiles = {}
+    # Per tile: [min_lat, min_lon, max_lat, max_lon, min_id, max_id]
+    bounds = {}
+    try:
+        for chunk in _batched(writer.rows(chunk_rows), chunk_rows):
+            by_tile = {}
+            for row in chunk:
+                by_tile.setdefault(cell_of(row[3], row[4], tile_deg), []).append(row)
+            for tile, rows in by_tile.items():
+                ids, names, types, lats, lons = zip(*rows)
+                if tile not in tiles:
+                    tiles[tile] = IndexWriter(lib_path)
+                    bounds[tile] = [math.inf, math.inf, -math.inf, -math.inf, MAX_ID, 0]
+                tiles[tile].append(list(ids), names, types, lats, lons)
+                b = bounds[tile]
+                bounds[tile] = [min(b[0], *lats), min(b[1], *lons), max(b[2], *lats),
+                                max(b[3], *lons), min(b[4], *ids), max(b[5], *ids)]
+
+        shards = []
+        for (row, col), tile_writer in sorted(tiles.items()):
+            name = f"tile_{row}_{col}.kdb"
+            path = os.path.join(out_dir, name)
+            n = len(tile_writer)
+            tile_writer.save(path)
+            b = bounds[row, col]
+            shards.append({"file": name, "tile": [row, col], "pois": n, "bbox": b[:4],
+                           "ids": b[4:], "bytes": os.path.getsize(path)})
+    finally:
+        for tile_writer in tiles.values():
+            tile_writer.close()
+
+    manifest = os.path.join(out_dir, MANIFEST)
+    with open(manifest + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"tile_deg": tile_deg, "pois": len(writer), "shards": shards}, f, indent=1)
+    # Written last, so a reader only sees shards that are complete
+    os.replace(manifest + ".tmp", manifest)
+    return len(shards)
+
+
+def _batched(rows, n):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ingest(paths, out=None, csv_out=None, mapping=None, dedup_m=DEDUP_M, jobs=None,
+           chunk_rows=CHUNK_ROWS, lib_path=C_LIB_PATH, shard_deg=None):
+    """Load every input into one index; returns a report of what was kept and dropped."""
+    mapping = mapping or {}
+    jobs = jobs or os.cpu_count() or 1
+    writer = IndexWriter(lib_path)
+    report = {"inputs": {}, "rejected": Counter()}
+    pool = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    try:
+        for path in paths:
+            read = kept = 0
+            next_id = None
+            for ids, names, types, lats, lons, rejects in _bounded_map(
+                    parse_chunk, _chunks(path, mapping, chunk_rows), pool, 2 * jobs):
+                if 0 in ids:
+                    # Rows without an id are numbered after everything so far
+                    if next_id is None:
+                        next_id = writer.max_id + 1
+                    for i, poi_id in enumerate(ids):
+                        if not poi_id:
+                            ids[i] = next_id
+                            next_id += 1
+                kept += writer.append(ids, names, types, lats, lons)
+                read += len(ids) + sum(rejects.values())
+                report["rejected"] += rejects
+            report["inputs"][path] = {"read": read, "loaded": kept}
+
+        report["duplicates"] = writer.dedup(dedup_m / 1000.0)
+        report["pois"] = len(writer)
+        if not report["pois"]:
+            raise IngestError("No valid POIs in the input")
+        if csv_out:
+            writer.write_csv(csv_out, chunk_rows)
+        if out and shard_deg:
+            report["shards"] = write_shards(writer, out, shard_deg, chunk_rows, lib_path)
+        elif out:
+            writer.save(out)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        writer.close()
+    report["rejected"] = dict(report["rejected"])
+    return report
+
+
+def _parse_map(values):
+    mapping = {}
+    for value in values or []:
+        field, sep, names = value.partition("=")
+        if not sep or field not in FIELDS:
+            raise argparse.ArgumentTypeError(
+                f"--map expects field=column[,column...] with field one of {', '.join(FIELDS)}")
+        mapping[field] = [n for n in names.split(",") if n]
+    return mapping
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("inputs", nargs="+", help="CSV/TSV or NDJSON/GeoJSON-seq files, optionally .gz")
+    parser.add_argument("--out", help="compiled index (.kdb) to write, or with --shard-deg "
+                                      "the directory of shards")
+    parser.add_argument("--csv-out", help="canonical id,name,type,lat,lon CSV to write")
+    parser.add_argument("--map", action="append", metavar="FIELD=COLUMN[,COLUMN]",
+                        help="source column(s) of a field; `id=` ignores source ids")
+    parser.add_argument("--dedup-m", type=float, default=DEDUP_M,
+                        help="same type and name within this many meters is a duplicate (0: off)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--shard-deg", type=float,
+                        help="write one snapshot per tile of this many degrees")
+    args = parser.parse_args(argv)
+    if not args.out and not args.csv_out:
+        parser.error("nothing to write: give --out and/or --csv-out")
+    try:
+        report = ingest(args.inputs, args.out, args.csv_out, _parse_map(args.map), args.dedup_m,
+                        args.jobs, args.chunk_rows, shard_deg=args.shard_deg)
+    except (argparse.ArgumentTypeError, IngestError, OSError) as e:
+        print(f"ingest: {e}", file=sys.stderr)
+        return 1
+
+    for path, counts in report["inputs"].items():
+        print(f"{path}: {counts['loaded']} of {counts['read']} rows loaded")
+    for reason, count in sorted(report["rejected"].items()):
+        print(f"  rejected, {reason}: {count}")
+    print(f"{report['duplicates']} duplicates removed, {report['pois']} POIs written")
+    if "shards" in report:
+        print(f"{report['shards']} shards written to {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""Live POI edits on top of the immutable in-process KD-tree.
+
+Edits go to a small delta that shadows the base index by POI id: each entry
+is the POI's new record, or None once it is deleted. A search reads one
+immutable (base, delta) state, asks the base for enough extra results to
+cover the shadowed ids, drops those and merges in the matching delta POIs.
+When the delta grows past a threshold, or on a timer, a background thread
+compacts base and delta into a fresh tree and swaps the state in one
+assignment, so readers never wait on writers.
+"""
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from engine import _batch_args, _page, cell_of, region_box
+from geo import haversine
+
+logger = logging.getLogger(__name__)
+
+COMPACT_THRESHOLD = int(os.getenv("KDTREE_COMPACT_THRESHOLD", "256"))
+COMPACT_INTERVAL = float(os.getenv("KDTREE_COMPACT_INTERVAL", "300"))
+
+# version counts the edits applied, so caches can tell the data changed
+_State = namedtuple("_State", ["base", "delta", "version"])
+_MISSING = object()
+
+
+def _type_matches(poi, type_filter):
+    names = {t.strip().lower() for t in (type_filter or "all").split(",")}
+    return "all" in names or poi["type"].lower() in names
+
+
+def _text_matches(poi, query):
+    if not query or not query.strip():
+        return True
+    query = query.lower()
+    return query in poi["name"].lower() or query in poi["type"].lower()
+
+
+def _in_region(poi, box, polygon):
+    lat, lon = poi["lat"], poi["lon"]
+    if not (box[0] <= lat <= box[2] and box[1] <= lon <= box[3]):
+        return False
+    if not polygon or len(polygon) < 3:
+        return True
+    # Even-odd test, as in the C core
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        (yi, xi), (yj, xj) = polygon[i], polygon[j]
+        if (yi > lat) != (yj > lat) and lon < xi + (lat - yi) * (xj - xi) / (yj - yi):
+            inside = not inside
+        j = i
+    return inside
+
+
+class LiveEngine:
+    """NativeEngine wrapper that accepts inserts, moves and deletes."""
+
+    name = "live"
+
+    def __init__(self, base, compact_threshold=COMPACT_THRESHOLD, compact_interval=COMPACT_INTERVAL):
+        self._state = _State(base, {}, 0)
+        self._write_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._compacting = False
+        self._next_id = None
+        self.compact_threshold = compact_threshold
+        self._stop = threading.Event()
+        if compact_interval > 0:
+            threading.Thread(target=self._compact_periodically, args=(compact_interval,),
+                             daemon=True).start()
+
+    @property
+    def version(self):
+        return self._state.version
+
+    def search(self, lat, lon, type="all", val=5.0, query=None, mode="radius", stats=None,
+               limit=None, offset=0, after=None, epsilon=0.0, max_nodes=0):
+        state = self._state
+        delta = state.delta
+        if not delta:
+            return state.base.search(lat, lon, type, val, query, mode, stats, limit, offset, after,
+                                     epsilon, max_nodes)
+
+        # Each shadowed id hides at most one base result
+        extra = len(delta)
+        if mode == "knn":
+            k = int(val)
+            base = state.base.search(lat, lon, type, k + extra, query, mode, stats,
+                                     epsilon=epsilon, max_nodes=max_nodes)
+        else:
+            base_limit = None if limit is None else offset + limit + extra
+            base = state.base.search(lat, lon, type, val, query, mode, stats,
+                                     limit=base_limit, after=after)
+
+        merged = [poi for poi in base if poi["id"] not in delta]
+        for poi in delta.values():
+            if poi is None or not _type_matches(poi, type) or not _text_matches(poi, query):
+                continue
+            dist = haversine(lat, lon, poi["lat"], poi["lon"])
+            if mode != "knn" and dist > val:
+                continue
+            merged.append(dict(poi, dist=dist))
+
+        if mode == "knn":
+            merged = _page(merged, k)
+        return _page(merged, limit, offset, after)
+
+    def search_batch(self, queries, stats=None):
+        state = self._state
+        if not state.delta:
+            return state.base.search_batch(queries, stats)
+        return [self.search(**_batch_args(q)) for q in queries]
+
+    def search_region(self, bbox=None, polygon=None, type="all", query=None, limit=None,
+                      stats=None):
+        state = self._state
+        delta = state.delta
+        base_limit = None if limit is None or not delta else limit + len(delta)
+        pois = state.base.search_region(bbox, polygon, type, query, base_limit, stats)
+        if not delta:
+            return pois
+
+        box = region_box(bbox, polygon)
+        pois = [poi for poi in pois if poi["id"] not in delta]
+        pois += [dict(poi) for poi in delta.values()
+                 if poi is not None and _in_region(poi, box, polygon)
+                 and _type_matches(poi, type) and _text_matches(poi, query)]
+        return pois[:limit]
+
+    def clusters(self, bbox=None, polygon=None, cell_deg=0.01, type="all", query=None,
+                 stats=None):
+        state = self._state
+        cells = state.base.clusters(bbox, polygon, cell_deg, type, query, stats)
+        if not state.delta:
+            return cells
+
+        # Take each shadowed base POI out of its cell and put the edits in
+        box = region_box(bbox, polygon)
+        cells = {cell["cell"]: cell for cell in cells}
+        touched = {}
+        for poi_id, poi in state.delta.items():
+            for record, sign in ((state.base.get(poi_id), -1), (poi, 1)):
+                if (record is None or not _in_region(record, box, polygon)
+                        or not _type_matches(record, type) or not _text_matches(record, query)):
+                    continue
+                key = cell_of(record["lat"], record["lon"], cell_deg)
+                if key not in touched:
+                    cell = cells.get(key, {"count": 0, "lat": 0.0, "lon": 0.0})
+                    touched[key] = [cell["count"], cell["lat"] * cell["count"],
+                                    cell["lon"] * cell["count"]]
+                sums = touched[key]
+                sums[0] += sign
+                sums[1] += sign * record["lat"]
+                sums[2] += sign * record["lon"]
+
+        for key, (count, sum_lat, sum_lon) in touched.items():
+            if count <= 0:
+                cells.pop(key, None)
+                continue
+            poi = None
+            if count == 1:
+                cell_box = (max(box[0], key[0] * cell_deg), max(box[1], key[1] * cell_deg),
+                            min(box[2], (key[0] + 1) * cell_deg),
+                            min(box[3], (key[1] + 1) * cell_deg))
+                hits = [p for p in self.search_region(cell_box, polygon, type, query)
+                        if cell_of(p["lat"], p["lon"], cell_deg) == key]
+                poi = hits[0] if hits else None
+            cells[key] = {"cell": key, "lat": sum_lat / count, "lon": sum_lon / count,
+                          "count": count, "poi": poi}
+        return list(cells.values())
+
+    def get(self, poi_id):
+        state = self._state
+        poi = state.delta.get(poi_id, _MISSING)
+        if poi is not _MISSING:
+            return dict(poi) if poi is not None else None
+        return state.base.get(poi_id)
+
+    def insert(self, poi):
+        """Add a POI; a missing id is assigned. Raises ValueError if the id is taken."""
+        with self._write_lock:
+            poi = dict(poi)
+            if poi.get("id") is not None and self.get(poi["id"]) is not None:
+                raise ValueError(f"POI {poi['id']} already exists")
+            poi["id"] = self._reserve_id(poi.get("id"))
+            self._apply(poi["id"], poi)
+            return dict(poi)
+
+    def update(self, poi_id, **fields):
+        """Change some fields of a POI, e.g. lat/lon to move it. Raises KeyError if missing."""
+        with self._write_lock:
+            current = self.get(poi_id)
+            if current is None:
+                raise KeyError(poi_id)
+            poi = dict(current, **fields, id=poi_id)
+            self._apply(poi_id, poi)
+            return dict(poi)
+
+    def delete(self, poi_id):
+        with self._write_lock:
+            if self.get(poi_id) is None:
+                raise KeyError(poi_id)
+            self._apply(poi_id, None)
+
+    def _reserve_id(self, poi_id=None):
+        # Assigned ids start past every id seen so far, explicit ones included
+        if self._next_id is None:
+            state = self._state
+            ids = [poi["id"] for poi in state.base.pois()] + list(state.delta)
+            self._next_id = max(ids, default=0) + 1
+        if poi_id is None:
+            poi_id = self._next_id
+        self._next_id = max(self._next_id, poi_id + 1)
+        return poi_id
+
+    def _apply(self, poi_id, poi):
+        # Copy-on-write: readers keep whichever state they already loaded
+        state = self._state
+        delta = dict(state.delta)
+        delta[poi_id] = poi
+        self._state = _State(state.base, delta, state.version + 1)
+        if len(delta) >= self.compact_threshold and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self._compact_in_background, daemon=True).start()
+
+    def compact(self):
+        """Fold the delta into a freshly built base tree and swap it in."""
+        with self._compact_lock:
+            start = self._state
+            if not start.delta:
+                return
+            pois = [poi for poi in start.base.pois() if poi["id"] not in start.delta]
+            pois += [poi for poi in start.delta.values() if poi is not None]
+            base = start.base.rebuild(pois)
+
+            with self._write_lock:
+                # Keep only the edits made while the new tree was being built
+                delta = {
+                    poi_id: poi for poi_id, poi in self._state.delta.items()
+                    if start.delta.get(poi_id, _MISSING) is not poi
+                }
+                self._state = _State(base, delta, self._state.version)
+
+    def _compact_in_background(self):
+        try:
+            # Edits that arrived during a compaction may already need another
+            while True:
+                self.compact()
+                if len(self._state.delta) < self.compact_threshold:
+                    break
+        except Exception as e:
+            logger.error("Compaction failed: %s", e)
+        finally:
+            self._compacting = False
+
+    def _compact_periodically(self, interval):
+        while not self._stop.wait(interval):
+            if self._state.delta:
+                self._compact_in_background()
+
+    def close(self):
+        self._stop.set()
+        self._state.base.close()
@@ -1,17 +1,29 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import subprocess
-import json
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+import logging
 import os
-import requests
+import time
 from typing import List, Optional
-import heapq
-from math import radians, cos, sin, asin, sqrt
-from campus_paths import CAMPUS_NODES, CAMPUS_EDGES, BUILDING_TO_NODE, CAMPUS_EXITS
+from cache import CachedEngine
+from campus_graph import CAMPUS_GRAPH, is_on_campus
+from encoding import batch_response, check_accept, results_response
+from engine import EngineError, NativeEngine, load_engine, region_box
+from geo import haversine
+from live import LiveEngine
+from matrix import PROFILE_SPEED_KMH, stream_matrix
+from metrics import REQUEST_SECONDS, count, render, stage, trace
+from ors_client import OrsClient
+from shards import SHARD_DIR, load_shards
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../../.env'))
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="SmartPOI Finder API")
 
 app.add_middleware(
@@ -20,178 +32,309 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "X-Search-Stats"],
 )
 
-C_EXE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../c_core/src/kdtree.exe"))
-C_CWD = os.path.dirname(C_EXE_PATH)
+# Requests sent with this header get their stage timings back in
+# Server-Timing and their engine counters in X-Search-Stats
+TRACE_HEADER = "X-Trace"
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    start = time.perf_counter()
+    if request.headers.get(TRACE_HEADER):
+        with trace() as current:
+            response = await call_next(request)
+        response.headers["Server-Timing"] = current.server_timing()
+        response.headers["X-Search-Stats"] = current.counter_header()
+    else:
+        response = await call_next(request)
+    # Route templates, not raw paths, keep the label set small
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(route.path if route else "unmatched", time.perf_counter() - start)
+    return response
+
+engine = load_shards(SHARD_DIR) if SHARD_DIR else load_engine()
+# POI edits are applied in memory on top of the native engine's tree
+if isinstance(engine, NativeEngine):
+    engine = LiveEngine(engine)
+engine = CachedEngine(engine)
+
+MAX_BATCH_QUERIES = 1000
+MAX_K = 10000
+MAX_QUERY_LEN = 255
+# Radius matches come back a page at a time; deeper pages are reached
+# through the keyset cursor
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_OFFSET = 1000
+MAX_MATRIX_CELLS = 10000
+
+# Below CLUSTER_MAX_ZOOM the map gets per-cell counts instead of POIs, with
+# CLUSTER_CELLS_PER_TILE cells across each 256 px map tile
+CLUSTER_MAX_ZOOM = 16
+CLUSTER_CELLS_PER_TILE = 4
+MAX_CLUSTER_CELLS = 4096
+MAX_REGION_POIS = 1000
+MAX_POLYGON_VERTICES = 1000
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 ORS_API_KEY = os.getenv("ORS_API_KEY")
-ORS_BASE_URL = "https://api.openrouteservice.org/v2/directions"
-
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    return R * c
-
-def build_graph():
-    graph = {}
-    for node in CAMPUS_NODES:
-        graph[node] = []
-    
-    for node1, node2, dist in CAMPUS_EDGES:
-        graph[node1].append((node2, dist))
-        graph[node2].append((node1, dist))
-    
-    return graph
-
-def dijkstra(graph, start, end):
-    distances = {node: float('inf') for node in graph}
-    distances[start] = 0
-    previous = {node: None for node in graph}
-    pq = [(0, start)]
-    visited = set()
-    
-    while pq:
-        current_dist, current = heapq.heappop(pq)
-        
-        if current in visited:
-            continue
-        visited.add(current)
-        
-        if current == end:
-            break
-        
-        for neighbor, weight in graph[current]:
-            distance = current_dist + weight
-            if distance < distances[neighbor]:
-                distances[neighbor] = distance
-                previous[neighbor] = current
-                heapq.heappush(pq, (distance, neighbor))
-    
-    path = []
-    current = end
-    while current is not None:
-        path.append(current)
-        current = previous[current]
-    path.reverse()
-    
-    return path, distances[end]
-
-def find_nearest_node(lat, lon):
-    min_dist = float('inf')
-    nearest = None
-    for node, (node_lat, node_lon) in CAMPUS_NODES.items():
-        dist = haversine(lat, lon, node_lat, node_lon)
-        if dist < min_dist:
-            min_dist = dist
-            nearest = node
-    return nearest, min_dist
+ors_client = OrsClient(ORS_API_KEY)
 
 def get_campus_route(start_lat, start_lon, end_lat, end_lon, start_building=None, end_building=None):
-    graph = build_graph()
-    
-    if start_building and start_building in BUILDING_TO_NODE:
-        start_node = BUILDING_TO_NODE[start_building]
+    # Points snap onto the closest edge; buildings start from their node
+    if start_building and start_building in CAMPUS_GRAPH.buildings:
+        start = CAMPUS_GRAPH.node_snap(CAMPUS_GRAPH.buildings[start_building])
+        start = start._replace(offset_km=haversine(start_lat, start_lon, start.lat, start.lon))
     else:
-        start_node, _ = find_nearest_node(start_lat, start_lon)
+        start = CAMPUS_GRAPH.snap(start_lat, start_lon)
     
-    if end_building and end_building in BUILDING_TO_NODE:
-        end_node = BUILDING_TO_NODE[end_building]
+    if end_building and end_building in CAMPUS_GRAPH.buildings:
+        end = CAMPUS_GRAPH.node_snap(CAMPUS_GRAPH.buildings[end_building])
+        end = end._replace(offset_km=haversine(end_lat, end_lon, end.lat, end.lon))
     else:
-        end_node, _ = find_nearest_node(end_lat, end_lon)
+        end = CAMPUS_GRAPH.snap(end_lat, end_lon)
     
-    path_nodes, total_dist_m = dijkstra(graph, start_node, end_node)
+    path_nodes, total_dist_m = CAMPUS_GRAPH.route(start, end)
+    if path_nodes is None:
+        raise ValueError("No campus path between the two points")
     
     path_coords = []
     path_coords.append([start_lat, start_lon])
+    path_coords.append([start.lat, start.lon])
     for node in path_nodes:
-        lat, lon = CAMPUS_NODES[node]
+        lat, lon = CAMPUS_GRAPH.coords[node]
         path_coords.append([lat, lon])
+    path_coords.append([end.lat, end.lon])
     path_coords.append([end_lat, end_lon])
     
     total_dist_km = total_dist_m / 1000.0
-    total_dist_km += haversine(start_lat, start_lon, CAMPUS_NODES[path_nodes[0]][0], CAMPUS_NODES[path_nodes[0]][1])
-    total_dist_km += haversine(end_lat, end_lon, CAMPUS_NODES[path_nodes[-1]][0], CAMPUS_NODES[path_nodes[-1]][1])
+    total_dist_km += start.offset_km
+    total_dist_km += end.offset_km
     
     return path_coords, total_dist_km
 
-
 @app.get("/")
 def read_root():
     return {"status": "active", "message": "SmartPOI Finder API - Intelligent Location Discovery"}
 
+def parse_cursor(cursor):
+    try:
+        dist, poi_id = cursor.split(":")
+        return float(dist), int(poi_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @app.get("/search")
-def search_pois(lat: float, lon: float, type: str = "all", radius: float = 5.0, query: Optional[str] = None, mode: str = "radius", k: int = 3):
+def search_pois(lat: float, lon: float, type: List[str] = Query(["all"]), radius: float = 5.0, query: Optional[str] = Query(None, max_length=MAX_QUERY_LEN), mode: str = "radius", k: int = Query(3, ge=1, le=MAX_K),
+                limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0, le=MAX_OFFSET), cursor: Optional[str] = None,
+                epsilon: float = Query(0.0, ge=0), max_nodes: int = Query(0, ge=0),
+                accept: Optional[str] = Header(None)):
+    after = parse_cursor(cursor) if cursor else None
+    check_accept(accept)
     try:
-        query_str = query if query and query.strip() != "" else "NULL_QUERY"
-        
         val = radius
         if mode == "knn":
             val = k
-            
-        cmd = [C_EXE_PATH, str(lat), str(lon), type, str(val), query_str, mode]
-        
-        result = subprocess.run(
-            cmd, 
-            capture_output=True, 
-            text=True, 
-            cwd=C_CWD,
-            check=True
-        )
-        
-        output = result.stdout.strip()
-        print(f"DEBUG: C Output (First 500 chars): {output[:500]}")
-        
-        if not output:
-            return []
-            
-        try:
-            pois = json.loads(output)
-            return pois
-        except json.JSONDecodeError as e:
-            print(f"JSON Error: {e}")
-            print(f"Full malformed output: {output}")
-            return []
-
-    except subprocess.CalledProcessError as e:
-        print(f"C Error: {e.stderr}")
+        elif limit is None:
+            limit = DEFAULT_PAGE_SIZE
+
+        # type may be repeated and/or comma-separated: type=hospital,clinic
+        types = ",".join(type)
+
+        stats = {}
+        with stage("engine"):
+            results = engine.search(lat, lon, types, val, query, mode, stats=stats, limit=limit,
+                                    offset=offset, after=after, epsilon=epsilon,
+                                    max_nodes=max_nodes)
+        count(stats, len(results))
+        # Results are ordered by (dist, id); a full page links to the next one
+        headers = {}
+        if limit is not None and len(results) == limit:
+            last = results[-1]
+            headers["X-Next-Cursor"] = f"{last['dist']!r}:{last['id']}"
+        with stage("serialize"):
+            return results_response(results, accept, headers)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except EngineError as e:
+        logger.error("C error: %s", e)
+        raise HTTPException(status_code=500, detail="Internal Server Error (C Module)")
+    except Exception:
+        logger.exception("Unexpected error in /search")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+class BatchQuery(BaseModel):
+    lat: float
+    lon: float
+    mode: str = "radius"
+    radius: float = 5.0
+    k: int = Field(3, ge=1, le=MAX_K)
+    type: List[str] = ["all"]
+    query: Optional[str] = Field(None, max_length=MAX_QUERY_LEN)
+
+@app.post("/search/batch")
+def search_pois_batch(queries: List[BatchQuery], accept: Optional[str] = Header(None)):
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_QUERIES} queries per batch")
+    check_accept(accept)
+    try:
+        batch = [
+            {
+                "lat": q.lat,
+                "lon": q.lon,
+                "type": ",".join(q.type),
+                "val": q.k if q.mode == "knn" else q.radius,
+                "query": q.query,
+                "mode": q.mode,
+            }
+            for q in queries
+        ]
+        stats = {}
+        with stage("engine"):
+            results = engine.search_batch(batch, stats)
+        count(stats, sum(len(pois) for pois in results))
+        with stage("serialize"):
+            return batch_response(results, accept)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except EngineError as e:
+        logger.error("C error: %s", e)
         raise HTTPException(status_code=500, detail="Internal Server Error (C Module)")
-    except Exception as e:
-        print(f"Unexpected Error: {e}")
+    except Exception:
+        logger.exception("Unexpected error in /search/batch")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
+def cluster_cell_deg(zoom, box):
+    cell = 360.0 / (2 ** zoom) / CLUSTER_CELLS_PER_TILE
+    # Oversized viewports get coarser cells rather than more of them
+    while ((box[2] - box[0]) / cell + 1) * ((box[3] - box[1]) / cell + 1) > MAX_CLUSTER_CELLS:
+        cell *= 2
+    return cell
+
+def search_region(bbox, polygon, zoom, type, query):
+    if not hasattr(engine, "clusters"):
+        raise HTTPException(status_code=503, detail="Area search needs the native engine")
+    types = ",".join(type)
+    box = region_box(bbox, polygon)
+    if box[0] > box[2] or box[1] > box[3]:
+        raise HTTPException(status_code=400, detail="Empty search area")
+    stats = {}
+    try:
+        if zoom < CLUSTER_MAX_ZOOM:
+            with stage("engine"):
+                cells = engine.clusters(bbox, polygon, cluster_cell_deg(zoom, box), types, query,
+                                        stats)
+            count(stats, len(cells))
+            return {
+                "clusters": [
+                    {"lat": round(c["lat"], 6), "lon": round(c["lon"], 6), "count": c["count"]}
+                    for c in cells if c["count"] > 1
+                ],
+                "pois": [c["poi"] for c in cells if c["count"] == 1 and c["poi"]],
+                "truncated": False,
+            }
+        with stage("engine"):
+            pois = engine.search_region(bbox, polygon, types, query, limit=MAX_REGION_POIS + 1,
+                                        stats=stats)
+        count(stats, len(pois))
+        return {"clusters": [], "pois": pois[:MAX_REGION_POIS], "truncated": len(pois) > MAX_REGION_POIS}
+
+    except EngineError as e:
+        logger.error("C error: %s", e)
+        raise HTTPException(status_code=500, detail="Internal Server Error (C Module)")
+
+@app.get("/search/bbox")
+def search_bbox(min_lat: float, min_lon: float, max_lat: float, max_lon: float, zoom: int = Query(CLUSTER_MAX_ZOOM, ge=0, le=22),
+                type: List[str] = Query(["all"]), query: Optional[str] = None):
+    return search_region((min_lat, min_lon, max_lat, max_lon), None, zoom, type, query)
+
+class PolygonQuery(BaseModel):
+    polygon: List[List[float]]
+    zoom: int = CLUSTER_MAX_ZOOM
+    type: List[str] = ["all"]
+    query: Optional[str] = None
+
+@app.post("/search/polygon")
+def search_polygon(q: PolygonQuery):
+    if not 3 <= len(q.polygon) <= MAX_POLYGON_VERTICES or any(len(p) != 2 for p in q.polygon):
+        raise HTTPException(status_code=400, detail=f"Polygon needs 3 to {MAX_POLYGON_VERTICES} [lat, lon] vertices")
+    if not 0 <= q.zoom <= 22:
+        raise HTTPException(status_code=400, detail="zoom must be between 0 and 22")
+    return search_region(None, [tuple(p) for p in q.polygon], q.zoom, q.type, q.query)
+
+@app.get("/cache/stats")
+def cache_stats():
+    return engine.stats()
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(render(), media_type="text/plain; version=0.0.4")
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+    if not isinstance(engine.engine, LiveEngine):
+        raise HTTPException(status_code=503, detail="POI updates need the native engine")
+
+class PoiIn(BaseModel):
+    id: Optional[int] = None
+    name: str
+    type: str
+    lat: float
+    lon: float
+
+class PoiPatch(BaseModel):
+    name: Optional[str] = None
+    type: Optional[str] = None
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+@app.post("/admin/pois", dependencies=[Depends(require_admin)])
+def create_poi(poi: PoiIn):
+    try:
+        return engine.insert(poi.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.patch("/admin/pois/{poi_id}", dependencies=[Depends(require_admin)])
+def update_poi(poi_id: int, patch: PoiPatch):
+    fields = {key: value for key, value in patch.dict().items() if value is not None}
+    try:
+        return engine.update(poi_id, **fields)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="POI not found")
+
+@app.delete("/admin/pois/{poi_id}", dependencies=[Depends(require_admin)])
+def delete_poi(poi_id: int):
+    try:
+        engine.delete(poi_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="POI not found")
+    return {"deleted": poi_id}
+
+@app.post("/admin/compact", dependencies=[Depends(require_admin)])
+def compact_pois():
+    engine.compact()
+    return {"status": "compacted"}
+
 @app.get("/route")
 def get_route(start_lat: float, start_lon: float, end_lat: float, end_lon: float):
-    print(f"\n=== ROUTE REQUEST ===")
-    print(f"Start: ({start_lat}, {start_lon})")
-    print(f"End: ({end_lat}, {end_lon})")
-    
-    CAMPUS_BOUNDS = {
-        'lat_min': 12.9220,
-        'lat_max': 12.9245,
-        'lon_min': 77.5000,
-        'lon_max': 77.5020
-    }
-    
-    def is_on_campus(lat, lon):
-        return (CAMPUS_BOUNDS['lat_min'] <= lat <= CAMPUS_BOUNDS['lat_max'] and
-                CAMPUS_BOUNDS['lon_min'] <= lon <= CAMPUS_BOUNDS['lon_max'])
-    
     both_on_campus = is_on_campus(start_lat, start_lon) and is_on_campus(end_lat, end_lon)
     start_on_campus = is_on_campus(start_lat, start_lon)
     end_on_campus = is_on_campus(end_lat, end_lon)
     
-    print(f"Start on campus: {start_on_campus}")
-    print(f"End on campus: {end_on_campus}")
-    print(f"Both on campus: {both_on_campus}")
+    logger.debug("Route (%s, %s) -> (%s, %s), start on campus: %s, end on campus: %s",
+                 start_lat, start_lon, end_lat, end_lon, start_on_campus, end_on_campus)
     
     if both_on_campus:
-        print("Using Dijkstra routing for on-campus route")
+        logger.debug("Using Dijkstra routing for on-campus route")
         try:
-            path, dist_km = get_campus_route(start_lat, start_lon, end_lat, end_lon)
+            with stage("campus_route"):
+                path, dist_km = get_campus_route(start_lat, start_lon, end_lat, end_lon)
             
             walking_time = (dist_km / 5.0) * 60
             cycling_time = (dist_km / 15.0) * 60
@@ -217,15 +360,14 @@ def get_route(start_lat: float, start_lon: float, end_lat: float, end_lon: float
             
             return results
         except Exception as e:
-            print(f"Campus routing error: {e}")
-            print("Falling back to ORS")
+            logger.warning("Campus routing error: %s, falling back to ORS", e)
     
     if start_on_campus and not end_on_campus:
-        print("Using HYBRID routing: Campus to External (via ORS)")
+        logger.debug("Using HYBRID routing: Campus to External (via ORS)")
     elif end_on_campus and not start_on_campus:
-        print("Using HYBRID routing: External to Campus (via ORS)")
+        logger.debug("Using HYBRID routing: External to Campus (via ORS)")
     else:
-        print("Using OpenRouteService for external routing")
+        logger.debug("Using OpenRouteService for external routing")
     
     profiles = {
         "driving-car": {"label": "Car", "emission_factor": 120.0},
@@ -235,55 +377,28 @@ def get_route(start_lat: float, start_lon: float, end_lat: float, end_lon: float
     
     results = []
     
-    headers = {
-        'Authorization': ORS_API_KEY,
-        'Content-Type': 'application/json'
-    }
-    
+    routes = ors_client.directions((start_lat, start_lon), (end_lat, end_lon), profiles)
     for profile, info in profiles.items():
-        try:
-            url = f"{ORS_BASE_URL}/{profile}"
-            params = {
-                "api_key": ORS_API_KEY,
-                "start": f"{start_lon},{start_lat}",
-                "end": f"{end_lon},{end_lat}"
-            }
-            
-            response = requests.get(url, params=params, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                feature = data['features'][0]
-                props = feature['properties']
-                geometry = feature['geometry']['coordinates']
-                
-                path = [[p[1], p[0]] for p in geometry]
-                
-                dist_m = props['summary']['distance']
-                dur_s = props['summary']['duration']
-                
-                dist_km = dist_m / 1000.0
-                dur_min = dur_s / 60.0
-                
-                co2 = dist_km * info['emission_factor']
-                
-                results.append({
-                    "profile": profile,
-                    "label": info['label'],
-                    "distance_km": round(dist_km, 2),
-                    "duration_min": round(dur_min, 1),
-                    "co2_grams": round(co2, 1),
-                    "geometry": path
-                })
-            else:
-                print(f"ORS Error {profile}: {response.text}")
-                pass
-
-        except Exception as e:
-            print(f"Exception for {profile}: {e}")
+        if profile not in routes:
+            continue
+        dist_m, dur_s, path = routes[profile]
+        
+        dist_km = dist_m / 1000.0
+        dur_min = dur_s / 60.0
+        
+        co2 = dist_km * info['emission_factor']
+        
+        results.append({
+            "profile": profile,
+            "label": info['label'],
+            "distance_km": round(dist_km, 2),
+            "duration_min": round(dur_min, 1),
+            "co2_grams": round(co2, 1),
+            "geometry": path
+        })
 
     if not results:
-        print("Using fallback routing (API unavailable)")
+        logger.info("Using fallback routing (API unavailable)")
         dist_km = haversine(start_lat, start_lon, end_lat, end_lon)
         
         results = [
@@ -317,6 +432,25 @@ def get_route(start_lat: float, start_lon: float, end_lat: float, end_lon: float
     
     return results
 
+class MatrixRequest(BaseModel):
+    origins: List[List[float]]
+    destinations: List[List[float]]
+    profile: str = "driving-car"
+
+@app.post("/matrix")
+def get_matrix(req: MatrixRequest):
+    if req.profile not in PROFILE_SPEED_KMH:
+        raise HTTPException(status_code=400, detail=f"Unknown profile {req.profile}")
+    if any(len(p) != 2 for p in req.origins + req.destinations):
+        raise HTTPException(status_code=400, detail="Points must be [lat, lon] pairs")
+    if len(req.origins) * len(req.destinations) > MAX_MATRIX_CELLS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_MATRIX_CELLS} cells per matrix")
+
+    origins = [tuple(p) for p in req.origins]
+    destinations = [tuple(p) for p in req.destinations]
+    return StreamingResponse(stream_matrix(origins, destinations, req.profile, ors_client),
+                             media_type="application/x-ndjson")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,91 @@
+"""Many-to-many travel distances for POST /matrix.
+
+Every cell starts as a straight-line estimate from the batched haversine
+kernel. Pairs with both ends on campus are replaced by graph distances:
+each point is snapped once, and every origin reads its distances to all
+destinations from that node's precomputed shortest-path row. The
+remaining pairs go to ORS in matrix blocks. Rows are streamed as NDJSON
+in the order their blocks complete, each tagged with its origin index.
+"""
+import json
+
+from campus_graph import CAMPUS_GRAPH, INF, is_on_campus
+from geo import haversine_batch
+from ors_client import MATRIX_CHUNK
+
+# Used for estimates and campus paths, as in /route
+PROFILE_SPEED_KMH = {
+    "foot-walking": 5.0,
+    "cycling-regular": 15.0,
+    "driving-car": 40.0,
+}
+
+
+def _estimates(origins, destinations):
+    lats = [lat for lat, _ in destinations]
+    lons = [lon for _, lon in destinations]
+    return [haversine_batch(lat, lon, lats, lons) for lat, lon in origins]
+
+
+def _campus_distances(origins, destinations):
+    """{(i, j): km} for the pairs with both ends on campus and a path between them."""
+    def snaps(points):
+        return {i: CAMPUS_GRAPH.snap(lat, lon)
+                for i, (lat, lon) in enumerate(points) if is_on_campus(lat, lon)}
+
+    origin_snaps, destination_snaps = snaps(origins), snaps(destinations)
+    campus = {}
+    for i, start in origin_snaps.items():
+        for j, end in destination_snaps.items():
+            meters = CAMPUS_GRAPH.route_distance(start, end)
+            if meters < INF:
+                campus[i, j] = meters / 1000.0 + start.offset_km + end.offset_km
+    return campus
+
+
+def stream_matrix(origins, destinations, profile, ors_client, chunk=MATRIX_CHUNK):
+    """Yield one NDJSON line per origin row of the distance/duration matrix."""
+    speed = PROFILE_SPEED_KMH[profile]
+    dist_km = _estimates(origins, destinations)
+    source = [["estimate"] * len(destinations) for _ in origins]
+    for (i, j), km in _campus_distances(origins, destinations).items():
+        dist_km[i][j] = km
+        source[i][j] = "campus"
+    dur_min = [[km / speed * 60 for km in row] for row in dist_km]
+
+    def line(i):
+        return json.dumps({
+            "origin": i,
+            "distances_km": [round(km, 2) for km in dist_km[i]],
+            "durations_min": [round(m, 1) for m in dur_min[i]],
+            "sources": source[i],
+        }) + "\n"
+
+    def all_campus(i, j, rows, cols):
+        return all(source[i + a][j + b] == "campus" for a in range(rows) for b in range(cols))
+
+    # Row blocks stream once all of their column blocks are in
+    remaining = {}
+    for i in range(0, len(origins), chunk):
+        rows = len(origins[i:i + chunk])
+        remaining[i] = sum(not all_campus(i, j, rows, len(destinations[j:j + chunk]))
+                           for j in range(0, len(destinations), chunk))
+    for i, count in remaining.items():
+        if count == 0:
+            for row in range(i, min(i + chunk, len(origins))):
+                yield line(row)
+
+    blocks = ors_client.matrix(profile, origins, destinations, skip=all_campus, chunk=chunk)
+    for i, j, tables in blocks:
+        if tables is not None:
+            for a, (dists, durs) in enumerate(zip(*tables)):
+                for b, (meters, seconds) in enumerate(zip(dists, durs)):
+                    if meters is None or seconds is None or source[i + a][j + b] == "campus":
+                        continue
+                    dist_km[i + a][j + b] = meters / 1000.0
+                    dur_min[i + a][j + b] = seconds / 60.0
+                    source[i + a][j + b] = "ors"
+        remaining[i] -= 1
+        if remaining[i] == 0:
+            for row in range(i, min(i + chunk, len(origins))):
+                yield line(row)
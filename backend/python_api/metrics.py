@@ -0,0 +1,121 @@
+"""Stage timings and engine counters, exported in Prometheus text format.
+
+Code paths time themselves with `with stage("traversal"):`, and searches
+report their engine counters through count(). Both are aggregated into
+histograms for GET /metrics. While a trace() is active, which main.py
+starts for requests sent with an X-Trace header, the same observations
+are also summed per request so the breakdown can be returned inline.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, 100 us to 10 s
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Nodes, distance evaluations or results per search
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one label."""
+
+    def __init__(self, name, help, label, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # Per-bucket counts (the last is +Inf), then the sum
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            label = f'{self.label}="{key}"'
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), values):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return "\n".join(lines)
+
+
+STAGE_SECONDS = Histogram("kdtree_stage_seconds", "Time spent per stage", "stage")
+REQUEST_SECONDS = Histogram("kdtree_request_seconds", "Request latency per route", "route")
+SEARCH_WORK = Histogram("kdtree_search_work", "Engine counters per search call", "counter",
+                        COUNT_BUCKETS)
+REGISTRY = [REQUEST_SECONDS, STAGE_SECONDS, SEARCH_WORK]
+
+
+class Trace:
+    """Per-request sums of stage seconds and engine counters."""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+
+    def server_timing(self):
+        """Stages as a Server-Timing header value, durations in ms."""
+        return ", ".join(f"{name};dur={seconds * 1000:.3f}"
+                         for name, seconds in self.stages.items())
+
+    def counter_header(self):
+        return ", ".join(f"{name}={value}" for name, value in self.counters.items())
+
+
+@contextmanager
+def trace():
+    current = Trace()
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+
+
+def record(name, seconds):
+    STAGE_SECONDS.observe(name, seconds)
+    current = _trace.get()
+    if current is not None:
+        current.stages[name] = current.stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def count(stats, results):
+    """Engine counters of one search: the stats dict it filled and its result count."""
+    work = dict(stats, results=results)
+    current = _trace.get()
+    for name in ("nodes_visited", "distance_evals", "results"):
+        if name in work:
+            SEARCH_WORK.observe(name, work[name])
+            if current is not None:
+                current.counters[name] = current.counters.get(name, 0) + work[name]
+
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
@@ -0,0 +1,256 @@
+"""OpenRouteService client used by /route and /matrix.
+
+All profiles of a route are requested concurrently over one pooled
+keep-alive session. Answers are cached by profile and snapped endpoints,
+and a circuit breaker stops calling ORS for a while after repeated
+failures so /route can go straight to its estimate. Matrices are split
+into blocks that fit one ORS matrix request and fetched in parallel.
+ORS_BASE_URL and ORS_MATRIX_URL may point at a local stand-in server, as
+test_ors_client.py does.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://api.openrouteservice.org/v2/directions"
+DEFAULT_MATRIX_URL = "https://api.openrouteservice.org/v2/matrix"
+
+# Sources and destinations per matrix request, 50 locations in all
+MATRIX_CHUNK = 25
+
+# Endpoints are rounded to this many decimals (~11 m) for the cache key
+SNAP_DECIMALS = 4
+CACHE_SIZE = 1024
+CACHE_TTL = 600.0
+
+BREAKER_FAILURES = 3
+BREAKER_RESET = 30.0
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl seconds."""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failures; lets one trial call
+    through once `reset` seconds have passed."""
+
+    def __init__(self, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self._count = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._trial and time.monotonic() - self._opened_at >= self.reset:
+                self._trial = True
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self._count = 0
+                self._opened_at = None
+            else:
+                self._count += 1
+                if self._count >= self.failures or self._trial:
+                    self._opened_at = time.monotonic()
+            self._trial = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+
+class OrsClient:
+    def __init__(self, api_key, base_url=None, matrix_url=None, timeout=None, max_workers=8):
+        # Read at construction so settings loaded from .env apply
+        base_url = base_url or os.getenv("ORS_BASE_URL", DEFAULT_BASE_URL)
+        matrix_url = matrix_url or os.getenv("ORS_MATRIX_URL", DEFAULT_MATRIX_URL)
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.matrix_url = matrix_url.rstrip("/")
+        self.timeout = timeout or float(os.getenv("ORS_TIMEOUT", "10"))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key:
+            self.session.headers["Authorization"] = api_key
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache = TTLCache()
+        self.breaker = CircuitBreaker()
+
+    def _key(self, profile, start, end):
+        snap = lambda p: (round(p[0], SNAP_DECIMALS), round(p[1], SNAP_DECIMALS))
+        return profile, snap(start), snap(end)
+
+    def _fetch(self, profile, start, end):
+        """One directions call; returns (healthy, route).
+
+        route is (distance_m, duration_s, [[lat, lon], ...]) or None, and
+        healthy is None when the breaker refused the call. The caller feeds
+        healthy to the breaker, so an abandoned call is counted only once.
+        """
+        if not self.breaker.allow():
+            return None, None
+        try:
+            response = self.session.get(
+                f"{self.base_url}/{profile}",
+                params={
+                    "api_key": self.api_key,
+                    "start": f"{start[1]},{start[0]}",
+                    "end": f"{end[1]},{end[0]}",
+                },
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            logger.warning("Exception for %s: %s", profile, e)
+            return False, None
+
+        # Only an unhealthy upstream trips the breaker, not an unroutable pair
+        healthy = response.status_code < 500 and response.status_code != 429
+        if response.status_code != 200:
+            logger.warning("ORS error %s: %s", profile, response.text)
+            return healthy, None
+        try:
+            feature = response.json()["features"][0]
+            summary = feature["properties"]["summary"]
+            path = [[p[1], p[0]] for p in feature["geometry"]["coordinates"]]
+            return healthy, (summary["distance"], summary["duration"], path)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            logger.warning("Malformed ORS response for %s: %s", profile, e)
+            return healthy, None
+
+    def directions(self, start, end, profiles):
+        """Route start -> end ((lat, lon) pairs) for every profile at once.
+
+        Returns {profile: (distance_m, duration_s, path)} for the profiles
+        that answered within the timeout.
+        """
+        results = {}
+        pending = {}
+        for profile in profiles:
+            key = self._key(profile, start, end)
+            cached = self.cache.get(key)
+            if cached is not None:
+                results[profile] = cached
+            else:
+                pending[self.executor.submit(self._fetch, profile, start, end)] = (profile, key)
+
+        done = set()
+        if pending:
+            # Wall time spent waiting on ORS, however many profiles were sent
+            with stage("ors"):
+                done, _ = wait(pending, timeout=self.timeout)
+        for future, (profile, key) in pending.items():
+            if future not in done:
+                # Queued calls are dropped; a running one is abandoned and
+                # counts against the breaker, so a hung ORS soon stops
+                # taking executor threads
+                if not future.cancel():
+                    self.breaker.record(False)
+                continue
+            healthy, route = future.result()
+            if healthy is not None:
+                self.breaker.record(healthy)
+            if route is not None:
+                self.cache.put(key, route)
+                results[profile] = route
+        return results
+
+    def _fetch_matrix(self, profile, sources, destinations):
+        """One matrix call; returns (distances_m, durations_s) tables or None."""
+        if not self.breaker.allow():
+            return None
+        locations = [[lon, lat] for lat, lon in list(sources) + list(destinations)]
+        try:
+            with stage("ors_matrix"):
+                response = self.session.post(
+                    f"{self.matrix_url}/{profile}",
+                    json={
+                        "locations": locations,
+                        "sources": list(range(len(sources))),
+                        "destinations": list(range(len(sources), len(locations))),
+                        "metrics": ["distance", "duration"],
+                    },
+                    timeout=self.timeout,
+                )
+        except requests.RequestException as e:
+            logger.warning("Exception for %s matrix: %s", profile, e)
+            self.breaker.record(False)
+            return None
+
+        self.breaker.record(response.status_code < 500 and response.status_code != 429)
+        if response.status_code != 200:
+            logger.warning("ORS error %s matrix: %s", profile, response.text)
+            return None
+        try:
+            body = response.json()
+            return body["distances"], body["durations"]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Malformed ORS matrix response for %s: %s", profile, e)
+            return None
+
+    def matrix(self, profile, sources, destinations, skip=None, chunk=MATRIX_CHUNK):
+        """Sources x destinations ((lat, lon) lists) in blocks of chunk x chunk.
+
+        Yields (row, col, tables) as each block's request completes, where
+        tables is (distances_m, durations_s) for that block or None when ORS
+        did not answer. skip(row, col, rows, cols) can rule out blocks that
+        need no request; those are not yielded.
+        """
+        pending = {}
+        for i in range(0, len(sources), chunk):
+            for j in range(0, len(destinations), chunk):
+                block_sources = sources[i:i + chunk]
+                block_destinations = destinations[j:j + chunk]
+                if skip and skip(i, j, len(block_sources), len(block_destinations)):
+                    continue
+                future = self.executor.submit(
+                    self._fetch_matrix, profile, block_sources, block_destinations)
+                pending[future] = (i, j)
+        for future in as_completed(pending):
+            i, j = pending[future]
+            yield i, j, future.result()
@@ -0,0 +1,219 @@
+"""Spatially sharded index: one snapshot per map tile, opened on demand.
+
+`python ingest.py ... --shard-deg 0.5 --out shards/` cuts a dataset into
+tiles of that many degrees and writes one snapshot per non-empty tile plus
+a manifest with each shard's bounding box, id range and size. Shards are
+opened on first use, and once the open ones exceed KDTREE_SHARD_MB the
+least recently used are dropped; a search still holding an evicted shard
+keeps it until it finishes.
+
+A radius search goes only to the shards whose box comes within the
+radius. A kNN search visits shards nearest box first and stops when the
+next box is farther than the k-th result so far. Per-shard results are
+merged by (dist, id), so answers equal those of one tree over all shards.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from math import cos, radians, sqrt
+
+from engine import (
+    C_EXE_PATH, C_LIB_PATH, EngineError, NativeEngine, WorkerPoolEngine, _batch_args, _page,
+    _versions, region_box,
+)
+from geo import KM_PER_DEG
+
+MANIFEST = "manifest.json"
+SHARD_DIR = os.getenv("KDTREE_SHARDS")
+SHARD_MAX_BYTES = int(float(os.getenv("KDTREE_SHARD_MB", "1024")) * 1024 * 1024)
+SHARD_WORKERS = int(os.getenv("KDTREE_SHARD_WORKERS", "1"))
+
+# Same planar bound and slack the C core prunes tree nodes with
+PRUNE_SLACK = 0.995
+
+Shard = namedtuple("Shard", ["file", "box", "ids", "cos_lo", "size"])
+
+
+def box_lower_bound(lat, lon, shard):
+    """Lower bound in km on the distance from a point to any POI of a shard."""
+    min_lat, min_lon, max_lat, max_lon = shard.box
+    dlat = max(min_lat - lat, 0.0, lat - max_lat)
+    dlon = max(min_lon - lon, 0.0, lon - max_lon)
+    c = min(cos(radians(lat)), shard.cos_lo)
+    return KM_PER_DEG * sqrt(dlat * dlat + dlon * dlon * c * c) * PRUNE_SLACK
+
+
+def _add_stats(stats, part):
+    if stats is not None:
+        for key, value in part.items():
+            stats[key] = stats.get(key, 0) + value
+
+
+class _ShardSet:
+    """Manifest, LRU of open shards and query routing; load(shard) opens a shard."""
+
+    def __init__(self, shard_dir, load, max_bytes=SHARD_MAX_BYTES):
+        with open(os.path.join(shard_dir, MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.tile_deg = manifest["tile_deg"]
+        self.shards = [
+            Shard(os.path.join(shard_dir, s["file"]), tuple(s["bbox"]), tuple(s["ids"]),
+                  cos(radians(max(abs(s["bbox"][0]), abs(s["bbox"][2])))), s["bytes"])
+            for s in manifest["shards"]
+        ]
+        if not self.shards:
+            raise EngineError(f"No shards in {shard_dir}")
+        self._load = load
+        self.max_bytes = max_bytes
+        self._open = OrderedDict()
+        self._open_bytes = 0
+        self._lock = threading.Lock()
+        # Shards never change once written
+        self.version = next(_versions)
+
+    def _engine(self, shard):
+        with self._lock:
+            engine = self._open.get(shard)
+            if engine is not None:
+                self._open.move_to_end(shard)
+                return engine
+        # Opened outside the lock; if two searches race, the later copy is dropped
+        engine = self._load(shard)
+        evicted = []
+        with self._lock:
+            if shard in self._open:
+                return self._open[shard]
+            self._open[shard] = engine
+            self._open_bytes += shard.size
+            while self._open_bytes > self.max_bytes and len(self._open) > 1:
+                old, old_engine = self._open.popitem(last=False)
+                self._open_bytes -= old.size
+                evicted.append(old_engine)
+        # Closed, outside the lock, once no search holds them any more
+        del evicted
+        return engine
+
+    def open_shards(self):
+        with self._lock:
+            return len(self._open)
+
+    def _nearest_first(self, lat, lon):
+        return sorted((box_lower_bound(lat, lon, s), i) for i, s in enumerate(self.shards))
+
+    def search(self, lat, lon, type="all", val=5.0, query=None, mode="radius", stats=None,
+               limit=None, offset=0, after=None, epsilon=0.0, max_nodes=0):
+        merged = []
+        visited = 0
+        if mode == "knn":
+            k = int(val)
+            # max_nodes is a budget per shard
+            for bound, i in self._nearest_first(lat, lon):
+                if len(merged) == k and bound * (1 + epsilon) > merged[-1]["dist"]:
+                    break
+                part = {}
+                found = self._engine(self.shards[i]).search(lat, lon, type, k, query, mode,
+                                                            part, epsilon=epsilon,
+                                                            max_nodes=max_nodes)
+                merged = _page(merged + found, k)
+                _add_stats(stats, part)
+                visited += 1
+        else:
+            # Each shard's best offset + limit after the cursor cover the page
+            want = None if limit is None else offset + limit
+            for bound, i in self._nearest_first(lat, lon):
+                if bound > val:
+                    break
+                part = {}
+                merged += self._engine(self.shards[i]).search(lat, lon, type, val, query, mode,
+                                                              part, limit=want, after=after)
+                _add_stats(stats, part)
+                visited += 1
+        _add_stats(stats, {"shards": visited})
+        return _page(merged, limit, offset, after)
+
+    def search_batch(self, queries, stats=None):
+        return [self.search(**_batch_args(q), stats=stats) for q in queries]
+
+    def close(self):
+        with self._lock:
+            engines = list(self._open.values())
+            self._open.clear()
+            self._open_bytes = 0
+        for engine in engines:
+            engine.close()
+
+
+class ShardedEngine(_ShardSet):
+    """Shards memory-mapped in this process, one NativeEngine each."""
+
+    name = "sharded"
+
+    def __init__(self, shard_dir, max_bytes=SHARD_MAX_BYTES, lib_path=C_LIB_PATH):
+        super().__init__(shard_dir, lambda shard: NativeEngine(
+            lib_path, poi_file=None, campus_file=None, snapshot_file=shard.file), max_bytes)
+
+    def _overlapping(self, bbox, polygon):
+        min_lat, min_lon, max_lat, max_lon = region_box(bbox, polygon)
+        return [s for s in self.shards
+                if s.box[0] <= max_lat and s.box[2] >= min_lat
+                and s.box[1] <= max_lon and s.box[3] >= min_lon]
+
+    def search_region(self, bbox=None, polygon=None, type="all", query=None, limit=None,
+                      stats=None):
+        pois = []
+        for shard in self._overlapping(bbox, polygon):
+            part = {}
+            remaining = None if limit is None else limit - len(pois)
+            pois += self._engine(shard).search_region(bbox, polygon, type, query, remaining,
+                                                      part)
+            _add_stats(stats, part)
+            if limit is not None and len(pois) >= limit:
+                break
+        return pois
+
+    def clusters(self, bbox=None, polygon=None, cell_deg=0.01, type="all", query=None,
+                 stats=None):
+        # Cells that straddle a tile edge get counts from several shards
+        cells = {}
+        for shard in self._overlapping(bbox, polygon):
+            part = {}
+            for c in self._engine(shard).clusters(bbox, polygon, cell_deg, type, query, part):
+                merged = cells.get(c["cell"])
+                if merged is None:
+                    cells[c["cell"]] = c
+                    continue
+                n = merged["count"] + c["count"]
+                merged["lat"] = (merged["lat"] * merged["count"] + c["lat"] * c["count"]) / n
+                merged["lon"] = (merged["lon"] * merged["count"] + c["lon"] * c["count"]) / n
+                merged["count"] = n
+                merged["poi"] = None
+            _add_stats(stats, part)
+        return list(cells.values())
+
+    def get(self, poi_id):
+        for shard in self.shards:
+            if shard.ids[0] <= poi_id <= shard.ids[1]:
+                poi = self._engine(shard).get(poi_id)
+                if poi is not None:
+                    return poi
+        return None
+
+
+class ShardedWorkerEngine(_ShardSet):
+    """Each open shard served by its own pool of `kdtree --serve` processes."""
+
+    name = "sharded-workers"
+
+    def __init__(self, shard_dir, max_bytes=SHARD_MAX_BYTES, workers=SHARD_WORKERS,
+                 exe_path=C_EXE_PATH):
+        super().__init__(shard_dir, lambda shard: WorkerPoolEngine(
+            workers, exe_path, poi_file=shard.file, campus_file="", snapshot_file=None),
+            max_bytes)
+
+
+def load_shards(shard_dir=SHARD_DIR):
+    """Shards in worker processes with KDTREE_ENGINE=workers, else in process."""
+    if os.getenv("KDTREE_ENGINE", "native") == "workers":
+        return ShardedWorkerEngine(shard_dir)
+    return ShardedEngine(shard_dir)
@@ -0,0 +1,137 @@
+"""Accuracy contract of the distance kernels in geo.py and c_core/src/geo.c.
+
+Run with `python -m pytest` in backend/python_api. The C kernel tests are
+skipped when the shared library has not been built.
+"""
+import os
+import random
+import re
+from math import atan, atan2, cos, radians, sin, sqrt, tan
+
+import pytest
+
+import geo
+from engine import C_SRC_DIR
+
+SAMPLES = 20000
+SEED = 7
+
+
+def vincenty_km(lat1, lon1, lat2, lon2):
+    """Reference geodesic distance on the WGS84 ellipsoid (Vincenty inverse)."""
+    a = 6378.137
+    f = 1 / 298.257223563
+    b = a * (1 - f)
+    L = radians(lon2 - lon1)
+    U1 = atan((1 - f) * tan(radians(lat1)))
+    U2 = atan((1 - f) * tan(radians(lat2)))
+    sinU1, cosU1 = sin(U1), cos(U1)
+    sinU2, cosU2 = sin(U2), cos(U2)
+
+    lam = L
+    for _ in range(200):
+        sin_lam, cos_lam = sin(lam), cos(lam)
+        sin_sigma = sqrt((cosU2 * sin_lam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * cos_lam) ** 2)
+        if sin_sigma == 0:
+            return 0.0
+        cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+        sigma = atan2(sin_sigma, cos_sigma)
+        sin_alpha = cosU1 * cosU2 * sin_lam / sin_sigma
+        cos2_alpha = 1 - sin_alpha ** 2
+        cos_2sm = cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha if cos2_alpha else 0.0
+        C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        lam_prev = lam
+        lam = L + (1 - C) * f * sin_alpha * (
+            sigma + C * sin_sigma * (cos_2sm + C * cos_sigma * (-1 + 2 * cos_2sm ** 2)))
+        if abs(lam - lam_prev) < 1e-12:
+            break
+
+    u2 = cos2_alpha * (a * a - b * b) / (b * b)
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = B * sin_sigma * (cos_2sm + B / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sm ** 2)
+        - B / 6 * cos_2sm * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sm ** 2)))
+    return b * A * (sigma - delta_sigma)
+
+
+def _random_pair(rng, max_km, max_lat):
+    lat1 = rng.uniform(-max_lat, max_lat)
+    lon1 = rng.uniform(-180, 180)
+    d = rng.uniform(0.01, max_km)
+    theta = rng.uniform(0, 6.283185307179586)
+    lat2 = max(-max_lat, min(max_lat, lat1 + d * cos(theta) / geo.KM_PER_DEG))
+    lon2 = lon1 + d * sin(theta) / (geo.KM_PER_DEG * cos(radians(lat1)))
+    return lat1, lon1, lat2, lon2
+
+
+@pytest.fixture(scope="module")
+def kernel():
+    lib = geo._kernel()
+    if lib is None:
+        pytest.skip("C kernel not built")
+    return lib
+
+
+def _worst(pairs, distance, reference):
+    worst = 0.0
+    for pair in pairs:
+        ref = reference(*pair)
+        if ref > 0:
+            worst = max(worst, abs(distance(*pair) - ref) / ref)
+    return worst
+
+
+def test_vincenty_reference():
+    # Flinders Peak to Buninyong, Vincenty's (1975) worked example
+    d = vincenty_km(-37.95103342, 144.42486789, -37.65282114, 143.92649554)
+    assert d == pytest.approx(54.972271, abs=1e-6)
+
+
+def test_haversine_within_sphere_contract():
+    rng = random.Random(SEED)
+    pairs = [_random_pair(rng, 2000.0, 85.0) for _ in range(SAMPLES)]
+    assert _worst(pairs, geo.haversine, vincenty_km) <= geo.SPHERE_REL_ERR
+
+
+def test_equirect_within_fast_path_contract():
+    rng = random.Random(SEED)
+    pairs = [_random_pair(rng, geo.FAST_PATH_MAX_KM, geo.FAST_PATH_MAX_LAT)
+             for _ in range(SAMPLES)]
+    assert _worst(pairs, geo.equirect, geo.haversine) <= geo.FAST_PATH_REL_ERR
+
+
+def test_c_equirect_within_fast_path_contract(kernel):
+    rng = random.Random(SEED)
+    pairs = [_random_pair(rng, geo.FAST_PATH_MAX_KM, geo.FAST_PATH_MAX_LAT)
+             for _ in range(SAMPLES)]
+
+    def fast(lat1, lon1, lat2, lon2):
+        return kernel.geo_equirect_km(lat1, lon1, cos(radians(lat1)), lat2, lon2,
+                                      cos(radians(lat2)))
+
+    assert _worst(pairs, fast, geo.haversine) <= geo.FAST_PATH_REL_ERR
+
+
+def test_c_haversine_matches_python(kernel):
+    rng = random.Random(SEED)
+    pairs = [_random_pair(rng, 2000.0, 85.0) for _ in range(SAMPLES)]
+    assert _worst(pairs, kernel.geo_haversine_km, geo.haversine) <= 1e-12
+
+
+def test_haversine_batch_matches_haversine():
+    rng = random.Random(SEED)
+    lat, lon = 12.97, 77.59
+    lats = [rng.uniform(12.0, 14.0) for _ in range(1000)]
+    lons = [rng.uniform(76.5, 78.5) for _ in range(1000)]
+    for got, la, lo in zip(geo.haversine_batch(lat, lon, lats, lons), lats, lons):
+        assert got == pytest.approx(geo.haversine(lat, lon, la, lo), rel=1e-12)
+
+
+def test_constants_match_geo_h():
+    with open(os.path.join(C_SRC_DIR, "geo.h")) as f:
+        defines = dict(re.findall(r"#define (GEO_\w+) ([0-9.e-]+)\n", f.read()))
+    assert float(defines["GEO_EARTH_RADIUS_KM"]) == geo.EARTH_RADIUS_KM
+    assert float(defines["GEO_FAST_PATH_MAX_KM"]) == geo.FAST_PATH_MAX_KM
+    assert float(defines["GEO_FAST_PATH_MAX_LAT"]) == geo.FAST_PATH_MAX_LAT
+    assert float(defines["GEO_FAST_PATH_REL_ERR"]) == geo.FAST_PATH_REL_ERR
@@ -0,0 +1,42 @@
+"""Id assignment and edit shadowing of LiveEngine.
+
+Skipped when the shared library has not been built.
+"""
+import os
+
+import pytest
+
+from engine import C_LIB_PATH, NativeEngine
+from live import LiveEngine
+
+POIS = [
+    {"id": 1, "name": "Library", "type": "library", "lat": 12.9716, "lon": 77.5946},
+    {"id": 2, "name": "Cafe", "type": "cafe", "lat": 12.9720, "lon": 77.5950},
+]
+
+
+@pytest.fixture
+def live():
+    if not os.path.exists(C_LIB_PATH):
+        pytest.skip("shared library not built")
+    engine = LiveEngine(NativeEngine(pois=POIS), compact_interval=0)
+    yield engine
+    engine.close()
+
+
+def test_insert_assigns_next_id(live):
+    assert live.insert({"name": "Gym", "type": "gym", "lat": 12.97, "lon": 77.59})["id"] == 3
+
+
+def test_auto_insert_skips_explicit_id(live):
+    first = live.insert({"name": "Gym", "type": "gym", "lat": 12.97, "lon": 77.59})
+    explicit = live.insert({"id": first["id"] + 1, "name": "Lab", "type": "lab",
+                            "lat": 12.98, "lon": 77.60})
+    after = live.insert({"name": "Shop", "type": "shop", "lat": 12.99, "lon": 77.61})
+    assert after["id"] not in (first["id"], explicit["id"])
+    assert live.get(explicit["id"])["name"] == "Lab"
+
+
+def test_insert_taken_id_raises(live):
+    with pytest.raises(ValueError):
+        live.insert({"id": 2, "name": "Dup", "type": "cafe", "lat": 12.97, "lon": 77.59})
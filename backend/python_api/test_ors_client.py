@@ -0,0 +1,130 @@
+"""OrsClient against a local stand-in for the ORS directions API."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ors_client import CircuitBreaker, OrsClient
+
+PROFILES = ["driving-car", "cycling-regular", "foot-walking"]
+START = (12.9716, 77.5946)
+END = (12.9352, 77.6245)
+ROUTE = {
+    "features": [{
+        "properties": {"summary": {"distance": 5200.0, "duration": 600.0}},
+        "geometry": {"coordinates": [[77.5946, 12.9716], [77.6245, 12.9352]]},
+    }]
+}
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.status = 200
+        self.delay = 0.0
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.calls += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+        body = json.dumps(ROUTE if server.status == 200 else {"error": "down"}).encode()
+        self.send_response(server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ors():
+    server = StandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = OrsClient("key", base_url=server.url, timeout=1.0)
+    client.breaker = CircuitBreaker(failures=3, reset=0.2)
+    yield server, client
+    client.executor.shutdown(wait=False, cancel_futures=True)
+    server.shutdown()
+    server.server_close()
+
+
+def test_profiles_requested_concurrently(ors):
+    server, client = ors
+    server.delay = 0.3
+    start = time.monotonic()
+    routes = client.directions(START, END, PROFILES)
+    assert sorted(routes) == sorted(PROFILES)
+    assert server.max_active == len(PROFILES)
+    assert time.monotonic() - start < 0.3 * len(PROFILES)
+    assert routes["foot-walking"] == (5200.0, 600.0, [[12.9716, 77.5946], [12.9352, 77.6245]])
+
+
+def test_repeated_route_served_from_cache(ors):
+    server, client = ors
+    first = client.directions(START, END, PROFILES)
+    # Within the snapping precision, so the same cache keys
+    nearby = (START[0] + 1e-5, START[1] - 1e-5)
+    assert client.directions(nearby, END, PROFILES) == first
+    assert server.calls == len(PROFILES)
+
+
+def test_breaker_opens_after_failures(ors):
+    server, client = ors
+    server.status = 503
+    assert client.directions(START, END, PROFILES) == {}
+    assert client.breaker.is_open
+    assert client.directions(START, (12.90, 77.60), PROFILES) == {}
+    assert server.calls == len(PROFILES)
+
+
+def test_half_open_trial(ors):
+    server, client = ors
+    server.status = 503
+    client.directions(START, END, PROFILES)
+    time.sleep(0.25)
+    # One trial goes through; it fails, so the breaker opens again
+    client.directions(START, END, PROFILES)
+    assert server.calls == len(PROFILES) + 1
+    assert client.breaker.is_open
+
+    server.status = 200
+    time.sleep(0.25)
+    routes = client.directions(START, END, PROFILES)
+    assert len(routes) == 1
+    assert not client.breaker.is_open
+    assert len(client.directions(START, END, PROFILES)) == len(PROFILES)
+
+
+def test_timeouts_count_against_breaker(ors):
+    server, client = ors
+    client.timeout = 0.2
+    server.delay = 1.0
+    start = time.monotonic()
+    assert client.directions(START, END, PROFILES) == {}
+    assert time.monotonic() - start < 0.5
+    assert client.breaker.is_open
+    # Later routes do not queue behind the abandoned calls
+    calls = server.calls
+    assert client.directions(START, (12.90, 77.60), PROFILES) == {}
+    assert server.calls == calls